@@ -13,7 +13,12 @@ from ChiLaunch import ChiLaunch
 from ChiCreate import ChiCreate
 from ChiParticleSwarm import ChiParticleSwarm
 from ChiGeneticAlgorithm import ChiGeneticAlgorithm
-from ChiRun import ChiRun
+from ChiBayesOpt import ChiBayesOpt
+from ChiRefine import ChiRefine
+from ChiRun import ChiRun, state_specs, stale_states
+from ChiState import ChiStateStore
+from ChiMetrics import MetricsReport
+from ChiCache import ChiCache, parse_size
 from ChiLib import *
 
 '''
@@ -23,6 +28,16 @@ Input: To view options type Chi.py -h
 Output:
 '''
 
+def parse_shard(shard_str):
+    # Shard string i/N with 0 <= i < N
+    try:
+        i, n = [int(x) for x in shard_str.split('/')]
+    except ValueError:
+        raise argparse.ArgumentTypeError("shard '{}' is not of the form i/N".format(shard_str))
+    if n < 1 or not 0 <= i < n:
+        raise argparse.ArgumentTypeError("shard '{}' needs 0 <= i < N".format(shard_str))
+    return (i, n)
+
 def parse_args():
     # TODO Figure out how to make a choose functionality
     parser = argparse.ArgumentParser(prog='Chi.py')
@@ -41,6 +56,12 @@ def parse_args():
     parser.add_argument('-P', '--prep', action='store_true',
             help='Prepares sims to run with either states specified with -s or all argument states in -a ARG_FILES')
 
+    parser.add_argument('--import_state', action='store_true',
+            help='Reads the sim.<state>, .error and .running marker files of every seed in the workdir into a state journal (WORKDIR/chi_state.journal). From then on --prep, --remove, --launch and ChiRun use the journal.')
+
+    parser.add_argument('--metrics', nargs='?', const='', metavar='FILE',
+            help='Sums up the resources (wall and cpu time, max RSS, block I/O) each state used over all seeds in the workdir, from the chi_metrics.txt files ChiRun writes. With FILE all records are also written to FILE as csv.')
+
     # REMOVE options
     parser.add_argument('-rm', '--remove', nargs='+', metavar='FILE', type=str,
             help='Removes FILEs from seed directories.')
@@ -50,21 +71,48 @@ def parse_args():
             help='Launches all the seed directories in DIRS list. If no list is\
                     given all sim directories in the "simulations" directory will be launched.')
 
+    parser.add_argument('--pack', action='store_true',
+            help='Pack seeds into jobs by their runtimes from earlier runs (chi_metrics.txt in the seed directories) instead of in blocks of ntasks, so the tasks of a job finish at about the same time. Seeds run one after the other in a task as long as they fit in the walltime. (Used with --launch option only)')
+
+    parser.add_argument('--array', action='store_true',
+            help='Submit all seeds as one slurm job array instead of one job per block of seeds. The seed list and array script are written to WORKDIR/chi_array. (Used with --launch option only)')
+
+    parser.add_argument('--pilot', nargs='?', const=1, type=int, metavar='NJOBS',
+            help='Put the seeds in a work queue (WORKDIR/chi_array) and submit NJOBS (default 1) jobs whose tasks are ChiRun --worker pilots pulling seeds from the queue until it is empty or the walltime is close. (Used with --launch option only)')
+
+    parser.add_argument('--cache', type=str, metavar='DIR',
+            help='Results cache directory passed on to ChiRun (see ChiRun.py --cache). Prints the cache statistics when used without --launch.')
+    parser.add_argument('--cache_size', type=str,
+            help='Size limit of the --cache, e.g. 50G. Least recently used entries are removed beyond it.')
+
     # CREATE options only
     parser.add_argument('-C', '--create', metavar='PARAM_FILE', 
             nargs='+', type=str,
             help='Creates seed directories with simulation structure that can be launched with ChiLaunch.py.')
     parser.add_argument('-r','--replace', default=False, action='store_true',
             help='Replace simulation file instead of throwing and error if file already exists.(Used with --create option only)')
+    parser.add_argument('--shard', type=parse_shard, metavar='i/N',
+            help='Only create shard i (counting from 0) of N disjoint slices of the sweep, so several nodes can create one sweep together. (Used with --create option only)')
+    parser.add_argument('--state_store', action='store_true',
+            help='Record the run state of the new seeds in a state journal (WORKDIR/chi_state.journal) instead of sim.<state> marker files. (Used with --create or --shotgun option only)')
     parser.add_argument('-ny', '--non_yaml', nargs='+', default=[], type=str,
             help='Will add non-yaml files to seed directories when creating directory structure. (Used with --create or --shotgun option only)')
 
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+            help='Number of processes used to write the sim and seed directories. The resulting tree is the same as with one process. (Used with --create or --shotgun option only)')
+
+    parser.add_argument('--link-mode', choices=link_modes, default='copy',
+            help='How --non_yaml and --fluid_config files are put into seed directories. Falls back to copy when the file system does not support the mode. (Used with --create or --shotgun option only)')
+
+    parser.add_argument('--store', action='store_true',
+            help='Write yaml files that are the same for several seeds only once into a content-addressed store (WORKDIR/chi_store) and link them into the seed directories. Files holding the ChiSeed are still written per seed. Uses --link-mode for the links, hardlinks when that is copy. (Used with --create or --shotgun option only)')
+
     parser.add_argument('--fluid_config', default='',
             help='(DEPRICATED: use --non_yaml or -ny instead) Will add fluid.config file to seed directories when creating directory structure. Used with bulk simulations when all fluids start with the same configuration. (Used with --create or --shotgun option only)')
 
     parser.add_argument('-S', '--shotgun', metavar='PARAM_FILE', 
             nargs='+', type=str,
-            help='Creates seed directories with simulation structure that can be launched with ChiLaunch.py. PARAM_FILEs are copied into seed directories with ChiParams chosen according to the random distribution specified. Need -n to specify the number of random variants (default=10).')
+            help='Creates seed directories with simulation structure that can be launched with ChiLaunch.py. PARAM_FILEs are copied into seed directories with ChiParams chosen according to the random distribution specified. ChiParams with a LatinHypercube, Halton or Sobol exec_str are drawn jointly from one space filling design per design and seed. Need -n to specify the number of random variants (default=10).')
 
     parser.add_argument('-PSC', '--particleswarmcreate', metavar='PARAM_FILE', 
             nargs='+', type=str,
@@ -74,7 +122,27 @@ def parse_args():
             nargs='+', type=str,
             help='Genetic Algorithm Optimization Creation. Creates seed directories with simulation structure that can be launched with ChiLaunch.py. PARAM_FILEs are copied into seed directories with ChiParams chosen according to the random distribution specified. Need -n to specify the number of random population members (default=10).')
 
-    # RUN options only
+    parser.add_argument('-BOC', '--bayesoptcreate', metavar='PARAM_FILE', 
+            nargs='+', type=str,
+            help='Bayesian Optimization Creation. Creates a first generation of -n random parameter points (default=10) like --particleswarmcreate. ChiBayesOpt.py -P then fits a Gaussian process to all evaluated points and proposes the next -n points at once.')
+
+    parser.add_argument('-ARC', '--adaptiverefinecreate', metavar='PARAM_FILE', 
+            nargs='+', type=str,
+            help='Adaptive Refinement Creation. Creates the coarse grid of the LinearSlice/LogSlice ChiParams like --create. Once the sims are analyzed, ChiRefine.py -R reads a metric of each sim and bisects the -n grid intervals where it changes most (geometric midpoints for LogSlice), as many rounds as wanted.')
+
+    parser.add_argument('--rungs', type=int, default=1,
+            help='Successive halving with this many rungs: new candidates run with the --fidelity key scaled down by --eta per rung below the last, and procreating a generation promotes the best 1/eta of them to the next rung until the last one runs the full value. (Used with --particleswarmcreate or --geneticalgorithmcreate option only)')
+
+    parser.add_argument('--eta', type=float, default=3.,
+            help='Budget factor between rungs and inverse fraction of candidates promoted (default: 3). (Used with --rungs option only)')
+
+    parser.add_argument('--fidelity', type=str, default='n_steps',
+            help='Yaml key holding the budget of a sim (default: n_steps). (Used with --rungs option only)')
+
+    parser.add_argument('--fidelity_file', type=str, metavar='PARAM_FILE',
+            help='PARAM_FILE with the --fidelity key (default: the first one that has it). (Used with --rungs option only)')
+
+
     parser.add_argument('-R', '--run', action="store_true",
             help='Runs a singular seed directory. Need --args_file.')
 
@@ -138,24 +206,74 @@ class ChiMain(object):
             c = ChiGeneticAlgorithm(self.opts, self.opts.workdir, 0)
             c.Create(self.opts.geneticalgorithmcreate)
 
+        elif self.opts.bayesoptcreate:
+            c = ChiBayesOpt(self.opts, self.opts.workdir, 0)
+            c.Create(self.opts.bayesoptcreate)
+
+        elif self.opts.adaptiverefinecreate:
+            touch(os.path.join(wd, "run.not"))
+            c = ChiRefine(self.opts, self.opts.workdir, 0)
+            c.Create(self.opts.adaptiverefinecreate)
+
         elif self.opts.run:
+            # The state journal is only passed on by ChiLaunch
+            # (ChiRun.py --state_store WORKDIR)
+            self.opts.state_store = None
             c = ChiRun(self.opts)
             c.Run(self.opts)
 
+        elif self.opts.cache:
+            ChiCache(self.opts.cache, parse_size(self.opts.cache_size or 0)).Summary()
+
+        elif self.opts.metrics is not None:
+            MetricsReport(wd, self.opts.metrics)
+
+        elif self.opts.import_state:
+            store = ChiStateStore(wd)
+            n = store.ImportMarkers(list(find_seed_dirs(wd)))
+            print("Imported {0} markers into {1}".format(n, store.journal))
+            store.Summary()
+
         elif self.opts.prep:
-            seed_lst = find_seed_dirs(self.opts.workdir)
+            seed_lst = list(find_seed_dirs(self.opts.workdir))
+            store = ChiStateStore(wd) if ChiStateStore.Exists(wd) else None
+            # Only states that are not up to date (see ChiRun.state_current)
+            # are armed. Without declared outputs that is all of them.
+            specs = state_specs(CreateDictFromYamlFile(self.opts.args_file)) if self.opts.args_file else {}
+            armed = {}
             for sd_dir in seed_lst:
                 if self.opts.args_file: 
                     shutil.copy(self.opts.args_file, sd_dir)
+                states = stale_states(sd_dir, specs, self.opts.states)
+                armed[sd_dir] = states
+                if not store:
+                    for s in states:
+                        touch(os.path.join(sd_dir, 'sim.{}'.format(s)))
+            if store:
                 for s in self.opts.states:
-                    touch(os.path.join(sd_dir, 'sim.{}'.format(s)))
+                    store.Arm([sd for sd in seed_lst if s in armed[sd]], [s])
+                store.Compact()
+            nskip = sum([len(self.opts.states) - len(armed[sd]) for sd in seed_lst])
+            if nskip:
+                print("{} up to date states were not armed".format(nskip))
 
         elif self.opts.remove:
-            seed_lst = find_seed_dirs(self.opts.workdir)
+            seed_lst = list(find_seed_dirs(self.opts.workdir))
             for sd_dir in seed_lst:
                 for fn in self.opts.remove:
                     path = os.path.join(sd_dir, fn)
                     if os.path.exists(path): os.remove(path)
+            if ChiStateStore.Exists(wd):
+                # Removing a marker file means the same for the journal
+                store = ChiStateStore(wd).Load()
+                for fn in self.opts.remove:
+                    if fn.startswith('sim.'):
+                        store.Disarm(seed_lst, [fn.split('.')[-1]])
+                    elif fn == '.error':
+                        store.SetError(seed_lst, False)
+                    elif fn == '.running' or fn.endswith('-ing'):
+                        store.ClearRunning(seed_lst)
+                store.Compact()
 
 ##########################################
 if __name__ == "__main__":
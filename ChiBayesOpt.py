@@ -0,0 +1,357 @@
+#!/usr/bin/env python
+## Basic
+import sys
+import os
+import pdb
+import shutil
+import yaml
+import argparse
+import re
+## Analysis
+import numpy as np
+from scipy.linalg import cho_factor, cho_solve
+from scipy.optimize import minimize
+from scipy.special import ndtr
+from ChiCreate import ChiCreate
+from ChiParams import ChiParam, ChiSim, bayes_state
+from ChiCheckpoint import ChiCheckpoint
+from collections import OrderedDict
+from ChiLib import *
+
+'''
+Name: ChiBayesOpt.py
+Description: Creates simulations for a batch Bayesian optimization run(s).
+    A Gaussian process is fit to every parameter point evaluated so far and
+    the next generation of -n points is chosen by expected improvement, one
+    point after the other, each time adding the point with its predicted
+    fitness as if it were measured (kriging believer) so the batch spreads
+    out. Generations use the directory and database layout of the particle
+    swarm.
+'''
+
+class GaussianProcess(object):
+    """ Gaussian process regression with a squared exponential kernel with
+        one length scale per parameter (ARD) and observation noise. Inputs
+        are expected in the unit cube, outputs are standardized here.
+        Hyperparameters maximize the log marginal likelihood.
+    """
+    def __init__(self, restarts=3):
+        self.restarts = restarts
+        self.theta = None
+
+    def Kernel(self, A, B, lengths, signal):
+        d = (A[:, np.newaxis, :] - B[np.newaxis, :, :]) / lengths
+        return signal * np.exp(-0.5 * np.sum(d * d, axis=2))
+
+    def NegLogLikelihood(self, theta, X, y):
+        # -log p(y|X,theta) and its gradient in the log hyperparameters
+        nd = X.shape[1]
+        lengths = np.exp(theta[:nd])
+        signal = np.exp(theta[nd])
+        noise = np.exp(theta[nd + 1])
+        R = self.Kernel(X, X, lengths, 1.0)
+        K = signal * R + noise * np.eye(len(X))
+        try:
+            c = cho_factor(K, lower=True)
+        except np.linalg.LinAlgError:
+            return 1e25, np.zeros_like(theta)
+        alpha = cho_solve(c, y)
+        nll = 0.5 * y.dot(alpha) + np.sum(np.log(np.diag(c[0]))) + \
+            0.5 * len(X) * np.log(2 * np.pi)
+        W = np.outer(alpha, alpha) - cho_solve(c, np.eye(len(X)))
+        grad = np.empty_like(theta)
+        for j in range(nd):
+            D = (X[:, np.newaxis, j] - X[np.newaxis, :, j]) ** 2 / lengths[j] ** 2
+            grad[j] = -0.5 * np.sum(W * signal * R * D)
+        grad[nd] = -0.5 * np.sum(W * signal * R)
+        grad[nd + 1] = -0.5 * noise * np.trace(W)
+        return nll, grad
+
+    def Fit(self, X, y):
+        self.ymean = y.mean()
+        self.ystd = y.std() if y.std() > 0 else 1.0
+        ys = (y - self.ymean) / self.ystd
+        nd = X.shape[1]
+        bounds = [(np.log(1e-2), np.log(1e1))] * nd + \
+            [(np.log(1e-2), np.log(1e2)), (np.log(1e-6), np.log(1.0))]
+        starts = [np.concatenate([np.full(nd, np.log(0.5)), [0.0, np.log(1e-2)]])]
+        if self.theta is not None:
+            starts.append(self.theta)
+        for i in range(self.restarts):
+            starts.append(np.array([np.random.uniform(lo, hi) for lo, hi in bounds]))
+        best = None
+        for theta0 in starts:
+            res = minimize(self.NegLogLikelihood, theta0, args=(X, ys), jac=True,
+                           method='L-BFGS-B', bounds=bounds)
+            if best is None or res.fun < best.fun:
+                best = res
+        self.theta = best.x
+        self.Condition(X, y)
+        return self
+
+    def Condition(self, X, y):
+        # Factor the kernel of the training points for the current
+        # hyperparameters, used again for every believer point
+        nd = X.shape[1]
+        self.lengths = np.exp(self.theta[:nd])
+        self.signal = np.exp(self.theta[nd])
+        self.noise = np.exp(self.theta[nd + 1])
+        self.X = X
+        self.y = y
+        K = self.Kernel(X, X, self.lengths, self.signal) + self.noise * np.eye(len(X))
+        self.chol = cho_factor(K, lower=True)
+        self.alpha = cho_solve(self.chol, (y - self.ymean) / self.ystd)
+
+    def Predict(self, Xs):
+        # Mean and standard deviation of the latent function at Xs
+        Ks = self.Kernel(Xs, self.X, self.lengths, self.signal)
+        mu = Ks.dot(self.alpha)
+        v = cho_solve(self.chol, Ks.T)
+        var = np.maximum(self.signal - np.sum(Ks * v.T, axis=1), 1e-12)
+        return mu * self.ystd + self.ymean, np.sqrt(var) * self.ystd
+
+    def PredictGradient(self, x):
+        # Mean and standard deviation at the point x and their gradients
+        k = self.Kernel(x[np.newaxis], self.X, self.lengths, self.signal)[0]
+        dk = -k[:, np.newaxis] * (x - self.X) / self.lengths ** 2
+        v = cho_solve(self.chol, k)
+        var = max(self.signal - k.dot(v), 1e-12)
+        sigma = np.sqrt(var)
+        dmu = dk.T.dot(self.alpha)
+        dsigma = -dk.T.dot(v) / sigma
+        return (k.dot(self.alpha) * self.ystd + self.ymean, sigma * self.ystd,
+                dmu * self.ystd, dsigma * self.ystd)
+
+def expected_improvement(mu, sigma, best, xi=0.01):
+    # Expected amount by which a point beats the best fitness (maximizing)
+    imp = mu - best - xi
+    z = imp / sigma
+    return imp * ndtr(z) + sigma * np.exp(-0.5 * z * z) / np.sqrt(2 * np.pi)
+
+def neg_expected_improvement(x, gp, best, xi=0.01):
+    # -EI and its gradient at x for the local search
+    mu, sigma, dmu, dsigma = gp.PredictGradient(x)
+    z = (mu - best - xi) / sigma
+    pdf = np.exp(-0.5 * z * z) / np.sqrt(2 * np.pi)
+    ei = (mu - best - xi) * ndtr(z) + sigma * pdf
+    return -ei, -(ndtr(z) * dmu + pdf * dsigma)
+
+def min_distance(cand, X):
+    # Distance of every candidate to the closest of the points X
+    d = cand[:, np.newaxis, :] - X[np.newaxis, :, :]
+    return np.sqrt(np.min(np.sum(d * d, axis=2), axis=1))
+
+def propose_batch(gp, q, nd, ncand=None, spacing=1e-3):
+    """ q points in the unit cube by kriging believer: maximize expected
+        improvement, add the point with its predicted mean as an
+        observation, repeat. Points closer than spacing to a known point are
+        not taken (they would make the same sim directory), and when no
+        point is expected to improve the most uncertain one is taken.
+        Returns the points and their mean, standard deviation and expected
+        improvement when chosen.
+    """
+    if ncand is None:
+        ncand = max(1000, 200 * nd)
+    best = gp.y.max()
+    X, y = gp.X, gp.y
+    points = []
+    stats = []
+    for i in range(q):
+        # Random candidates and some near the best points, then a local
+        # search from the most promising ones
+        top = X[np.argsort(-y)[:5]]
+        local = top[np.random.randint(len(top), size=ncand // 4)] + \
+            np.random.normal(0.0, 0.05, (ncand // 4, nd))
+        cand = np.clip(np.concatenate([np.random.uniform(0.0, 1.0, (ncand, nd)), local]), 0.0, 1.0)
+        cand = cand[min_distance(cand, X) > spacing]
+        mu, sigma = gp.Predict(cand)
+        ei = expected_improvement(mu, sigma, best)
+        x_best, ei_best = cand[np.argmax(ei)], ei.max()
+        for x0 in cand[np.argsort(-ei)[:5]]:
+            res = minimize(neg_expected_improvement, x0, args=(gp, best), jac=True,
+                           method='L-BFGS-B', bounds=[(0.0, 1.0)] * nd)
+            x = np.clip(res.x, 0.0, 1.0)
+            if -res.fun > ei_best and min_distance(x[np.newaxis], X)[0] > spacing:
+                x_best, ei_best = x, -res.fun
+        if ei_best <= 1e-12 * gp.ystd:
+            x_best, ei_best = cand[np.argmax(sigma)], 0.0
+        mu, sigma = gp.Predict(x_best[np.newaxis])
+        points.append(x_best)
+        stats.append((mu[0], sigma[0], ei_best))
+        # Believe the prediction and condition on it, a believed point
+        # better than the best raises the bar for the rest of the batch
+        X = np.concatenate([X, x_best[np.newaxis]])
+        y = np.concatenate([y, mu])
+        gp.Condition(X, y)
+        best = max(best, mu[0])
+    return np.array(points), stats
+
+class ChiBayesOpt(ChiCreate):
+    def __init__(self, opts, cwd, generation):
+        self.generation = generation
+        ChiCreate.__init__(self, opts=opts, cwd=cwd)
+
+    ### Checkpoints (see ChiCheckpoint), the setup is written with generation 0
+    def savestate(self, sim_dir):
+        static = dict(self.__dict__)
+        static['Sim'] = self.Sim.Static(bayes_state)
+        ChiCheckpoint(sim_dir, 'bayes').Save(self.generation, static,
+                                             self.Sim.GetState(bayes_state),
+                                             write_static=(self.generation == 0))
+
+    def loadstate(self, sim_dir):
+        # Load the latest generation, returns its number
+        cp = ChiCheckpoint(sim_dir, 'bayes')
+        generation = cp.Latest()
+        static, state = cp.Load(generation)
+        self.__dict__.update(static)
+        self.Sim.SetState(bayes_state, state)
+        self.generation = generation
+        return generation
+
+    # Create has to have an additional step from ChiCreate
+    def Create(self, file_list):
+        # Make master yaml dictionary
+        self.MakeYmlDict(file_list)
+
+        # Get a list of all the ChiParam dictionsarys with key
+        # and value (ChiParam string) and put into a list
+        a = list(find_str_values(self.yml_files_dict))
+
+        # Turn list of dictionaries in to ChiParam objects
+        self.MakeChiParams(a)
+        self.CreateBayesOptData()
+        self.MakeDirectoryStruct()
+
+    # Directory creation, does work with updating generation
+    def MakeDirectoryStruct(self):
+        sim_dir_name = "generations/gen{0}".format(self.generation)
+        sim_dir = os.path.join(self.opts.workdir, sim_dir_name)
+
+        # Make run directory
+        if self.opts.replace and os.path.exists(sim_dir_name):
+            shutil.rmtree(sim_dir)
+            prune_manifest(self.opts.workdir, sim_dir)
+        if not os.path.exists(sim_dir_name):
+            os.makedirs(sim_dir)
+
+        # One sim per point of the batch
+        l = []
+        for i in range(self.opts.n):
+            l += [ [i]*len(self.ChiParams) ]
+
+        print(" -- Making Bayesian Optimization Generation {} -- ".format(self.generation))
+        linker = CreateLinker(self.opts)
+        recorders = self.MakeRecorders()
+        for il in l:
+            self.Sim.MakeSimDirectoryDatabase(sim_dir_name, self.generation, il, linker,
+                                              recorders)
+        for r in recorders:
+            r.Close()
+        linker.Report()
+
+        # Save myself off to the directory
+        self.savestate("generations")
+
+    ### Print functionality
+    def PrintBayes(self):
+        print("Bayesian Optimization Generation: {}".format(self.generation))
+        print("   batch size: {}".format(self.Sim.nparticles))
+        print("   evaluated points: {}".format(len(self.Sim.evalfit)))
+
+    def PrintBest(self):
+        str0 = "bestfit  "
+        for ichi in range(len(self.ChiParams)):
+            str0 += "{:>10s}    ".format(str(self.ChiParams[ichi]))
+        print(str0)
+        ibest = int(np.argmax(self.Sim.evalfit))
+        str1 = "{0:>6.3f} ".format(self.Sim.evalfit[ibest])
+        for ichi in range(len(self.ChiParams)):
+            str1 += " {0:10.3f}   ".format(self.Sim.evalpos[ibest][ichi])
+        print(str1)
+
+    ### Bayesian optimization specifics
+    def CreateBayesOptData(self):
+        self.Sim.CreateBayesOpt()
+        sim_dir_name = "generations/gen{0}".format(self.generation)
+        sim_dir = os.path.join(self.opts.workdir, sim_dir_name)
+        self.Sim.CreateParticleSwarmDatabase(sim_dir, self.generation) # Can just reuse this version
+
+    def GenerateFitnessInformation(self, dotest=False, jobs=None):
+        sim_dir_name = "generations/gen{0}".format(self.generation)
+        sim_dir = os.path.join(self.opts.workdir, sim_dir_name)
+        self.Sim.UpdateFitness(sim_dir, dotest, jobs)
+
+    def ProposeBatch(self):
+        """ Fits the surrogate to the evaluated points and sets the
+            particles to the next batch. Points are scaled to the unit cube
+            with the parameter bounds.
+        """
+        lowerb, upperb = self.Sim.SwarmBounds()
+        width = np.where(upperb != lowerb, upperb - lowerb, 1.0)
+        nd = len(self.ChiParams)
+        if len(self.Sim.evalfit) < 2:
+            # Nothing to fit yet, another random batch
+            print(" -- Fewer than 2 evaluated points, proposing random points -- ")
+            u = np.random.uniform(0.0, 1.0, (self.Sim.nparticles, nd))
+            self.Sim.SetSwarmPositions(lowerb + u * width)
+            return
+        X = (self.Sim.evalpos - lowerb) / width
+        gp = GaussianProcess().Fit(X, self.Sim.evalfit)
+        print("   length scales: {}".format(" ".join(["{:.3g}".format(l) for l in gp.lengths])))
+        print("   signal variance: {0:.3g}  noise variance: {1:.3g}".format(gp.signal, gp.noise))
+        u, stats = propose_batch(gp, self.Sim.nparticles, nd)
+        print("id     mean      std       EI")
+        for idx, (mu, sigma, ei) in enumerate(stats):
+            print("{0:<3d} {1:>8.3f} {2:>8.3f} {3:>8.3g}".format(idx, mu, sigma, ei))
+        self.Sim.SetSwarmPositions(lowerb + u * width)
+        self.Sim.fitness = [float('nan') for i in range(self.Sim.nparticles)]
+
+    # Procreate Functionality
+    def Procreate(self, dotest=False, jobs=None):
+        # Save off the information about the opts, path, etc
+        cur_cwd = self.cwd
+
+        # Load self from the latest checkpoint
+        self.maxgen = self.loadstate('generations')
+        self.nextgen = self.maxgen + 1
+        self.cwd = cur_cwd
+
+        self.PrintBayes()
+        print(" -- Bayesian Optimization Procreating from max generation {}".format(self.maxgen))
+        self.GenerateFitnessInformation(dotest, jobs)
+        nadded = self.Sim.UpdateEvaluated()
+        print(" -- {0} of {1} points evaluated, {2} in total -- ".format(
+            nadded, self.Sim.nparticles, len(self.Sim.evalfit)))
+        if len(self.Sim.evalfit):
+            print(" -- Best Parameters -- ")
+            self.PrintBest()
+        print(" -- Fitting Surrogate and Proposing Batch -- ")
+        self.ProposeBatch()
+
+        # Write the new information
+        self.generation = self.nextgen
+        self.MakeDirectoryStruct()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(prog='ChiBayesOpt.py')
+
+    parser.add_argument('-P', '--procreate', nargs='+', type=str, metavar='DIRS',
+            help='Procreates based on most recent generation in DIRS list.')
+
+    parser.add_argument('-T', '--test', action='store_true',
+            help='Test the Bayesian optimization')
+
+    parser.add_argument('-j', '--jobs', type=int,
+            help='Number of SpindleAnalysis fitness evaluations run at once when procreating (default: number of cpus)')
+
+    opts = parser.parse_args()
+    return opts
+
+### Main function to test stuff?
+if __name__ == "__main__":
+    opts = parse_args()
+    c = ChiBayesOpt(opts, os.getcwd(), 0)
+    if opts.procreate:
+        c.Procreate(opts.test, opts.jobs)
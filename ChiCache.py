@@ -0,0 +1,251 @@
+#!/usr/bin/env python
+import sys
+import os
+import re
+import glob
+import time
+import shutil
+import hashlib
+import fcntl
+from ChiLib import *
+
+'''
+Name: ChiCache.py
+Description: Results cache shared between sweeps. The outputs of a state are
+    stored under a key hashed from the seed's yaml files, the state's inputs,
+    its arguments and its program, so a rerun of the same parameter point
+    (repeated grid points, surviving GA elites, PSO particles at a bound)
+    copies the outputs instead of running the program again.
+Input: ChiCache.py CACHE_DIR prints the cache size and statistics
+'''
+
+STATS_NAME = 'chi_cache_stats.txt'
+stats_keys = ['hits', 'misses', 'stores', 'evictions', 'bytes_restored']
+
+def parse_size(size_str):
+    # Size like 500M or 20G in bytes, plain numbers are bytes
+    m = re.match(r'^\s*([0-9.]+)\s*([kKmMgGtT]?)[bB]?\s*$', str(size_str))
+    if not m:
+        raise ValueError("size '{}' is not a number with an optional K, M, G or T".format(size_str))
+    factor = {'': 1, 'k': 1 << 10, 'm': 1 << 20, 'g': 1 << 30, 't': 1 << 40}
+    return int(float(m.group(1)) * factor[m.group(2).lower()])
+
+class ChiCache(object):
+    """ Content-addressed cache of state outputs. An entry is the directory
+        <cache_dir>/<key[:2]>/<key> holding the output files and a meta
+        file. Hits refresh the entry's mtime and eviction removes the
+        entries with the oldest mtime first (LRU) until the cache fits in
+        max_bytes. Restores, evictions and the statistics hold an flock on
+        the cache's lock file.
+    """
+    def __init__(self, cache_dir, max_bytes=0):
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.max_bytes = max_bytes
+        self.lock = os.path.join(self.cache_dir, '.lock')
+        self.linker = FileLinker('reflink')
+        self.prog_hashes = {}
+        if not os.path.isdir(self.cache_dir):
+            try:
+                os.makedirs(self.cache_dir)
+            except OSError:
+                if not os.path.isdir(self.cache_dir):
+                    raise
+
+    def Locked(self):
+        lf = open(self.lock, 'a')
+        fcntl.flock(lf, fcntl.LOCK_EX)
+        return lf
+
+    ### Keys
+    def FileHash(self, path):
+        h = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                h.update(chunk)
+        return h.hexdigest()
+
+    def ProgramHash(self, path):
+        # Programs are big and the same for every seed, hash each once
+        st = os.stat(path)
+        k = (path, st.st_mtime, st.st_size)
+        if k not in self.prog_hashes:
+            self.prog_hashes[k] = self.FileHash(path)
+        return self.prog_hashes[k]
+
+    def Key(self, seed_dir, state, spec, args_file=None):
+        """ Hash of the state name and arguments, its program, and the
+            contents of the seed's yaml files (the args file excepted) and
+            of the state's declared inputs.
+        """
+        h = hashlib.sha1()
+        h.update(state.encode('utf-8') + b'\0')
+        for a in spec['args']:
+            h.update(a.encode('utf-8') + b'\0')
+        prog = spec['args'][0] if spec['args'] else None
+        if prog:
+            if os.path.isfile(os.path.join(seed_dir, prog)):
+                prog = os.path.join(seed_dir, prog)
+            else:
+                prog = shutil.which(prog)
+        if prog:
+            h.update(b'prog\0' + self.ProgramHash(prog).encode('utf-8'))
+        files = set(glob.glob(os.path.join(seed_dir, '*.yaml')))
+        if args_file:
+            files.discard(os.path.join(seed_dir, args_file))
+        for pat in spec['inputs']:
+            files.update(glob.glob(os.path.join(seed_dir, pat)))
+        for fn in sorted(files):
+            h.update(os.path.relpath(fn, seed_dir).encode('utf-8') + b'\0')
+            h.update(self.FileHash(fn).encode('utf-8'))
+        return h.hexdigest()
+
+    def EntryDir(self, key):
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    ### Lookup and store
+    def Restore(self, key, seed_dir):
+        """ Copies (reflinks where possible) the cached outputs into the
+            seed directory. Returns False on a miss. Holds the cache lock so
+            the entry can not be evicted while it is being restored, and
+            leaves the seed's outputs alone unless every file of the entry
+            is there.
+        """
+        entry = self.EntryDir(key)
+        meta = os.path.join(entry, 'meta')
+        nbytes = None
+        with self.Locked():
+            if os.path.isfile(meta):
+                with open(meta, 'r') as f:
+                    names = [l.rstrip('\n')[len('output\t'):] for l in f if l.startswith('output\t')]
+                srcs = [os.path.join(entry, 'files', name) for name in names]
+                if all([os.path.isfile(src) for src in srcs]):
+                    nbytes = 0
+                    for name, src in zip(names, srcs):
+                        dst = os.path.join(seed_dir, name)
+                        if os.path.lexists(dst):
+                            os.remove(dst)
+                        if not os.path.isdir(os.path.dirname(dst)):
+                            os.makedirs(os.path.dirname(dst))
+                        self.linker.Place(src, os.path.dirname(dst))
+                        nbytes += os.path.getsize(dst)
+                    # Most recently used
+                    os.utime(entry, None)
+        # Count takes the lock itself
+        if nbytes is None:
+            self.Count(misses=1)
+            return False
+        self.Count(hits=1, bytes_restored=nbytes)
+        return True
+
+    def Store(self, key, seed_dir, spec):
+        # Copy the outputs into a private directory and rename it into place
+        # so a half written entry is never seen
+        entry = self.EntryDir(key)
+        if os.path.isdir(entry):
+            return
+        outputs = []
+        for pat in spec['outputs']:
+            outputs += sorted(glob.glob(os.path.join(seed_dir, pat)))
+        outputs = [fn for fn in outputs if os.path.isfile(fn)]
+        if not outputs:
+            return
+        tmp = os.path.join(self.cache_dir, 'tmp.{0}.{1}'.format(os.getpid(), key))
+        nbytes = 0
+        for fn in outputs:
+            name = os.path.relpath(fn, seed_dir)
+            dst_dir = os.path.dirname(os.path.join(tmp, 'files', name))
+            if not os.path.isdir(dst_dir):
+                os.makedirs(dst_dir)
+            shutil.copy2(fn, os.path.join(tmp, 'files', name))
+            nbytes += os.path.getsize(fn)
+        with open(os.path.join(tmp, 'meta'), 'w') as f:
+            f.write("bytes\t{}\n".format(nbytes))
+            f.write("created\t{:.3f}\n".format(time.time()))
+            f.write("args\t{}\n".format(" ".join(spec['args'])))
+            for fn in outputs:
+                f.write("output\t{}\n".format(os.path.relpath(fn, seed_dir)))
+        if not os.path.isdir(os.path.dirname(entry)):
+            os.makedirs(os.path.dirname(entry), exist_ok=True)
+        try:
+            os.rename(tmp, entry)
+        except OSError:
+            # Another seed stored the same key first
+            shutil.rmtree(tmp, ignore_errors=True)
+            return
+        self.Count(stores=1)
+        if self.max_bytes:
+            self.Evict()
+
+    def Entries(self):
+        # (mtime, bytes, entry dir) of every entry
+        entries = []
+        for sub in os.listdir(self.cache_dir):
+            sub_dir = os.path.join(self.cache_dir, sub)
+            if len(sub) != 2 or not os.path.isdir(sub_dir):
+                continue
+            for key in os.listdir(sub_dir):
+                entry = os.path.join(sub_dir, key)
+                try:
+                    with open(os.path.join(entry, 'meta'), 'r') as f:
+                        nbytes = int(f.readline().split('\t')[1])
+                    entries.append((os.path.getmtime(entry), nbytes, entry))
+                except (OSError, IOError, IndexError, ValueError):
+                    continue
+        return entries
+
+    def Evict(self):
+        # Remove least recently used entries until the cache fits
+        with self.Locked():
+            entries = sorted(self.Entries())
+            total = sum([e[1] for e in entries])
+            nevicted = 0
+            for mtime, nbytes, entry in entries:
+                if total <= self.max_bytes:
+                    break
+                shutil.rmtree(entry, ignore_errors=True)
+                total -= nbytes
+                nevicted += 1
+        if nevicted:
+            self.Count(evictions=nevicted)
+
+    ### Statistics
+    def ReadStats(self):
+        stats = dict([(k, 0) for k in stats_keys])
+        path = os.path.join(self.cache_dir, STATS_NAME)
+        if os.path.isfile(path):
+            with open(path, 'r') as f:
+                for line in f:
+                    k, v = line.split()
+                    stats[k] = int(v)
+        return stats
+
+    def Count(self, **counts):
+        with self.Locked():
+            stats = self.ReadStats()
+            for k, v in counts.items():
+                stats[k] += v
+            path = os.path.join(self.cache_dir, STATS_NAME)
+            tmp = "{0}.{1}.tmp".format(path, os.getpid())
+            with open(tmp, 'w') as f:
+                for k in stats_keys:
+                    f.write("{0} {1}\n".format(k, stats[k]))
+            os.rename(tmp, path)
+
+    def Summary(self):
+        stats = self.ReadStats()
+        entries = self.Entries()
+        lookups = stats['hits'] + stats['misses']
+        print("cache {0}: {1} entries, {2} bytes{3}".format(
+            self.cache_dir, len(entries), sum([e[1] for e in entries]),
+            " (limit {})".format(self.max_bytes) if self.max_bytes else ""))
+        print("   hits: {0}  misses: {1}  hit rate: {2:.1f}%  stores: {3}  evictions: {4}  bytes restored: {5}".format(
+            stats['hits'], stats['misses'], 100. * stats['hits'] / lookups if lookups else 0.,
+            stats['stores'], stats['evictions'], stats['bytes_restored']))
+
+
+##########################################
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("must supply cache directory argument")
+        sys.exit(1)
+    ChiCache(sys.argv[1]).Summary()
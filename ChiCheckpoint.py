@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+import sys
+import os
+import pickle
+import numpy as np
+
+'''
+Name: ChiCheckpoint.py
+Description: Generation checkpoints of the optimizers. The setup (opts, yaml
+    tree, chiparams) is pickled once, every generation adds a small npz file
+    with the population arrays, and a one line index names the latest
+    generation, so resuming reads two files however long the run is.
+    Directories that only have the old per generation pickles of the whole
+    object are still read.
+Input: ChiCheckpoint.py GENERATIONS_DIR NAME prints the latest checkpoint
+'''
+
+CHECKPOINT_VERSION = 1
+
+class ChiCheckpoint(object):
+    """ Checkpoints of one optimizer (name is 'swarm' or 'genetics') in the
+        generations directory:
+            sim_data_<name>_static.pickle   setup without the arrays
+            sim_data_<name>_<gen>.npz       arrays of generation gen
+            sim_data_<name>_latest.txt      latest generation
+        Every file is written to a temporary name and renamed into place.
+    """
+    def __init__(self, gen_dir, name):
+        self.gen_dir = gen_dir
+        self.name = name
+
+    def StaticPath(self):
+        return os.path.join(self.gen_dir, "sim_data_{}_static.pickle".format(self.name))
+
+    def StatePath(self, generation):
+        return os.path.join(self.gen_dir, "sim_data_{0}_{1}.npz".format(self.name, generation))
+
+    def IndexPath(self):
+        return os.path.join(self.gen_dir, "sim_data_{}_latest.txt".format(self.name))
+
+    def LegacyPath(self, generation):
+        return os.path.join(self.gen_dir, "sim_data_{0}_{1}.pickle".format(self.name, generation))
+
+    def Latest(self):
+        """ Latest generation from the index. Without one (runs made before
+            the checkpoints) the highest generation directory.
+        """
+        if os.path.isfile(self.IndexPath()):
+            with open(self.IndexPath(), 'r') as f:
+                return int(f.read().split()[0])
+        generations = [dirname for dirname in os.listdir(self.gen_dir) if dirname.startswith('gen')]
+        return max([int(''.join(filter(str.isdigit, str1))) for str1 in generations])
+
+    def Save(self, generation, static, state, write_static=False):
+        """ static is the pickled setup, written when write_static is set or
+            when there is none yet. state maps names to the arrays of this
+            generation.
+        """
+        if write_static or not os.path.isfile(self.StaticPath()):
+            self.Replace(self.StaticPath(), lambda f: pickle.dump(static, f))
+        arrays = dict([(k, np.asarray(v)) for k, v in state.items()])
+        arrays['version'] = np.array(CHECKPOINT_VERSION)
+        arrays['generation'] = np.array(generation)
+        self.Replace(self.StatePath(generation), lambda f: np.savez(f, **arrays))
+        self.Replace(self.IndexPath(), lambda f: f.write("{}\n".format(generation).encode('utf-8')))
+
+    def Load(self, generation=None):
+        """ (static, state) of the generation, the latest by default. state
+            is None for a legacy pickle, whose static dict has everything.
+        """
+        if generation is None:
+            generation = self.Latest()
+        if not os.path.isfile(self.StatePath(generation)):
+            with open(self.LegacyPath(generation), 'rb') as f:
+                return (pickle.load(f), None)
+        with open(self.StaticPath(), 'rb') as f:
+            static = pickle.load(f)
+        with np.load(self.StatePath(generation)) as npz:
+            version = int(npz['version'])
+            if version > CHECKPOINT_VERSION:
+                raise ValueError("{0} is checkpoint version {1}, this code reads up to {2}".format(
+                    self.StatePath(generation), version, CHECKPOINT_VERSION))
+            state = dict([(k, npz[k]) for k in npz.files if k not in ('version', 'generation')])
+        return (static, state)
+
+    def Replace(self, path, write):
+        tmp = "{0}.{1}.tmp".format(path, os.getpid())
+        with open(tmp, 'wb') as f:
+            write(f)
+        os.rename(tmp, path)
+
+
+##########################################
+if __name__ == "__main__":
+    if len(sys.argv) < 3:
+        print("must supply generations directory and optimizer name (swarm or genetics)")
+        sys.exit(1)
+    cp = ChiCheckpoint(sys.argv[1], sys.argv[2])
+    gen = cp.Latest()
+    static, state = cp.Load(gen)
+    print("latest generation: {}".format(gen))
+    if state is None:
+        print("   legacy pickle {}".format(cp.LegacyPath(gen)))
+    else:
+        for k in sorted(state):
+            print("   {0:<10s} {1} {2}".format(k, state[k].dtype, state[k].shape))
@@ -11,6 +11,7 @@ import re
 from ChiParams import ChiParam, ChiSim
 from collections import OrderedDict
 from ChiLib import *
+from ChiState import ChiStateStore
 
 '''
 Name: ChiCreate.py
@@ -57,14 +58,19 @@ class ChiCreate(object):
         # Make all parameter values for ChiParam objects
         if self.opts.create:
             self.Sim.UpdateParamValues()
+        elif self.opts.adaptiverefinecreate: # Coarse grid of the slices
+            self.Sim.UpdateParamValues()
         elif self.opts.shotgun:
             self.Sim.UpdateShotgunParamValues()
         elif self.opts.particleswarmcreate: # Duplicates the behavior of the shotgun approach
             self.Sim.UpdateShotgunParamValues()
         elif self.opts.geneticalgorithmcreate: # Duplicates the behavior again
             self.Sim.UpdateShotgunParamValues()
+        elif self.opts.bayesoptcreate: # Random first batch, like the shotgun
+            self.Sim.UpdateShotgunParamValues()
 
         self.Sim.MakeSeeds()
+        self.Sim.CompileTemplates()
 
     def MakeDirectoryStruct(self):
         sim_dir_name = "simulations"
@@ -73,17 +79,36 @@ class ChiCreate(object):
         sim_dir = os.path.join(self.opts.workdir, sim_dir_name)
 
         # Make run directory
-        if self.opts.replace and os.path.exists(sim_dir_name):
-            shutil.rmtree(sim_dir)
-        #os.mkdir(sim_dir)
-        os.makedirs(sim_dir)
+        if self.opts.shard:
+            # Other shards of the sweep share the run directory so it is
+            # never removed and may already exist
+            if not os.path.exists(sim_dir):
+                try:
+                    os.makedirs(sim_dir)
+                except OSError:
+                    if not os.path.isdir(sim_dir):
+                        raise
+        else:
+            if self.opts.replace and os.path.exists(sim_dir_name):
+                shutil.rmtree(sim_dir)
+            #os.mkdir(sim_dir)
+            os.makedirs(sim_dir)
+            # Anything the manifest still lists in here is gone
+            prune_manifest(self.opts.workdir, sim_dir)
 
         # Get all the permutations of values when running a slice
         if self.opts.create:
             # Get number of variations in each parameter set
             lst = [ x.GetNValues() for x in self.ChiParams ] 
-            # Make a list of all the combinations of parameter indices
-            l = ind_recurse(lst)
+            # Lazily step through the combinations of parameter indices,
+            # only the ones in this shard if the sweep is split
+            start, stop = 0, None
+            if self.opts.shard:
+                start, stop = shard_range(ind_count(lst), *self.opts.shard)
+                print(" -- Shard {0}/{1}: sims {2} to {3} of {4} -- ".format(
+                    self.opts.shard[0], self.opts.shard[1], start, stop - 1,
+                    ind_count(lst)))
+            l = ind_product(lst, start, stop)
 
         # For shotgun runs no permutation is required
         elif self.opts.shotgun or self.opts.particleswarmcreate:
@@ -94,8 +119,25 @@ class ChiCreate(object):
         # Loop through indices and make the new sim directories 
         # and place seed directories in them
         print(" -- Making simulations -- ")
-        for il in l:
-            self.Sim.MakeSimDirectory(sim_dir_name, il)
+        linker = CreateLinker(self.opts)
+        recorders = self.MakeRecorders()
+        if self.opts.jobs > 1:
+            self.Sim.MakeSimDirectoriesParallel(sim_dir_name, l, self.opts.jobs, linker,
+                                                recorders)
+        else:
+            for il in l:
+                self.Sim.MakeSimDirectory(sim_dir_name, il, linker, recorders)
+        for r in recorders:
+            r.Close()
+        linker.Report()
+
+    def MakeRecorders(self):
+        # Objects told about every sim that gets created: the workdir
+        # manifest, and the state journal which arms the states of new seeds
+        recorders = [ManifestWriter(self.opts.workdir)]
+        if getattr(self.opts, 'state_store', False):
+            recorders += [ChiStateStore(self.opts.workdir, self.opts.states)]
+        return recorders
 
     def TestPickleDump(self, sim_dir):
         # Test the dump functionality
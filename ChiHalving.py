@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+import sys
+import os
+import numpy as np
+from ChiLib import *
+from ChiState import ChiStateStore, arm_seeds, clear_errors
+
+'''
+Name: ChiHalving.py
+Description: Successive halving of the particle swarm and genetic algorithm
+    generations. A fidelity key of the yaml files (n_steps by default) is
+    scaled down by eta per rung below the last, so every new candidate first
+    runs with a small budget. Procreating a generation that is not at its
+    last rung evaluates the candidates still in the running and only the
+    best 1/eta of them are rerun with eta times the budget, in place. Once
+    the last rung is evaluated the generation procreates as usual.
+Input: used through Chi.py -PSC/-GAC --rungs R [--eta ETA] [--fidelity KEY]
+'''
+
+def rung_budgets(full, rungs, eta):
+    # Value of the fidelity key at each rung, the last one is the full value
+    budgets = [full * float(eta) ** (r - rungs + 1) for r in range(rungs)]
+    if isinstance(full, int):
+        budgets = [max(1, int(round(b))) for b in budgets]
+    return budgets
+
+def rung_sizes(n, rungs, eta):
+    # Candidates evaluated at each rung out of n
+    sizes = [n]
+    for r in range(1, rungs):
+        sizes += [max(1, int(np.ceil(sizes[-1] / float(eta))))]
+    return sizes
+
+def setup_fidelity(opt):
+    """ Rung budgets of the fidelity key when --rungs asks for successive
+        halving. The key is set to the first rung budget in the yaml tree,
+        so the templates compiled afterwards write every new candidate with
+        it. Has to be called before the ChiParams are made.
+    """
+    opts = opt.opts
+    opt.budgets = None
+    rungs = getattr(opts, 'rungs', 1) or 1
+    if rungs <= 1:
+        return
+    for f, d in opt.yml_files_dict.items():
+        if opts.fidelity_file and f != opts.fidelity_file:
+            continue
+        ref = find_key(d, opts.fidelity)
+        if ref is not None:
+            break
+    else:
+        raise Exception("Fidelity key {0} is not in {1}".format(
+            opts.fidelity, opts.fidelity_file or list(opt.yml_files_dict.keys())))
+    full = ref.GetValue()
+    if type(full) not in (int, float):
+        raise Exception("Fidelity key {0} in {1} is {2}, not a number".format(
+            opts.fidelity, f, full))
+    opt.fidelity = opts.fidelity
+    opt.fidelity_file = f
+    opt.eta = opts.eta
+    opt.budgets = rung_budgets(full, rungs, opts.eta)
+    ref.Set(opt.budgets[0])
+
+    sizes = rung_sizes(opts.n, rungs, opts.eta)
+    cost = sum([s * b for s, b in zip(sizes, opt.budgets)]) / float(opts.n * full)
+    print(" -- Successive halving of {0} in {1}: budgets {2} for {3} candidates, "
+          "{4:.0%} of the full budget per generation -- ".format(
+              opt.fidelity, f, opt.budgets, sizes, cost))
+
+def halving(opt):
+    return bool(getattr(opt, 'budgets', None))
+
+def start_rungs(opt):
+    # Every candidate of a new generation is in the running at the first rung
+    if not halving(opt):
+        return
+    sim = opt.Sim
+    sim.rung = 0
+    sim.alive = np.ones(sim.nparticles, dtype=bool)
+    sim.erung = np.zeros(sim.nparticles, dtype=int)
+
+def last_rung(opt):
+    return not halving(opt) or opt.Sim.rung >= len(opt.budgets) - 1
+
+def rung_indices(opt):
+    # Candidates whose fitness is still to be evaluated, None for all of them
+    if not halving(opt):
+        return None
+    return [int(idx) for idx in np.flatnonzero(opt.Sim.alive)]
+
+def set_yaml_key(path, key, value):
+    # Rewrites the yaml file with key set to value. The new file is renamed
+    # over the old one, which may be a link into the store or another seed.
+    with open(path, 'r') as f:
+        d = OrderedYamlLoad(f)
+    find_key(d, key).Set(value)
+    tmp = "{0}.{1}.tmp".format(path, os.getpid())
+    with open(tmp, 'w') as f:
+        f.write(OrderedYamlDump(d, default_flow_style=False))
+    os.rename(tmp, path)
+
+def promote(opt, dotest=False, jobs=None):
+    """ Evaluates the candidates of the current rung and moves the best 1/eta
+        of them to the next one: their fidelity key is set to its budget in
+        every seed, their error flags are cleared and the create states are
+        armed again. Returns their seed directories.
+    """
+    sim = opt.Sim
+    opt.GenerateFitnessInformation(dotest, jobs)
+    alive = np.flatnonzero(sim.alive)
+    fitness = np.array(sim.fitness, dtype=float)[alive]
+    nkeep = max(1, int(np.ceil(len(alive) / float(opt.eta))))
+    order = alive[np.argsort(-np.nan_to_num(fitness, nan=-np.inf), kind='stable')]
+    keep = np.sort(order[:nkeep])
+    sim.alive[:] = False
+    sim.alive[keep] = True
+    sim.rung += 1
+    sim.erung[keep] = sim.rung
+    budget = opt.budgets[sim.rung]
+
+    print(" -- Rung {0}: {1} of {2} candidates go on with {3} = {4} -- ".format(
+        sim.rung - 1, nkeep, len(alive), opt.fidelity, budget))
+    for idx in order:
+        print("   particle {0} fitness {1:.3f}{2}".format(
+            idx, sim.fitness[idx], " promoted" if sim.alive[idx] else ""))
+
+    gen_dir = os.path.join(opt.opts.workdir, "generations", "gen{}".format(opt.generation))
+    sim_paths = sim.SimPaths(gen_dir, keep)
+    seeds = []
+    for idx in keep:
+        for sn in sim.seeds.sd_names:
+            sd_dir = os.path.join(sim_paths[idx], sn)
+            set_yaml_key(os.path.join(sd_dir, opt.fidelity_file), opt.fidelity, budget)
+            seeds += [sd_dir]
+    workdir = opt.opts.workdir
+    store = ChiStateStore(workdir).Load() if ChiStateStore.Exists(workdir) else None
+    # A seed whose lower rung failed has to run again too
+    clear_errors(seeds, store)
+    if opt.opts.states:
+        arm_seeds(seeds, opt.opts.states, store)
+    with open(os.path.join(gen_dir, "rung{}_seeds.txt".format(sim.rung)), 'w') as f:
+        for sd_dir in seeds:
+            f.write("{}\n".format(sd_dir))
+    print(" -- Rerun the {0} seeds in {1}, then procreate again -- ".format(
+        len(seeds), os.path.join(gen_dir, "rung{}_seeds.txt".format(sim.rung))))
+
+    # Same generation, now at the next rung
+    opt.savestate("generations")
+    return seeds
+
+def finish_rungs(opt):
+    """ After the last rung, candidates dropped at a rung rank below every
+        candidate that went on, as their fitness at a lower budget can not be
+        compared with the others.
+    """
+    if not halving(opt):
+        return
+    sim = opt.Sim
+    fitness = np.array(sim.fitness, dtype=float)
+    for r in range(len(opt.budgets) - 2, -1, -1):
+        above = fitness[sim.erung > r]
+        above = above[~np.isnan(above)]
+        if len(above):
+            out = sim.erung == r
+            # Strictly below, a tie could still be picked as a best
+            fitness[out] = np.minimum(fitness[out], np.nextafter(above.min(), -np.inf))
+    sim.fitness = fitness.tolist()
@@ -5,15 +5,52 @@ import yaml
 import argparse
 import re
 import fnmatch
+import time
+import multiprocessing
 
-from subprocess import Popen
+from subprocess import Popen, PIPE, call
+from ChiLib import read_manifest, read_metrics, WorkQueue, available_cpus
+from ChiState import ChiStateStore
 
 # Creates multithreaded processor jobs.
 
 
+def seed_command(seedlaunchpath, sd_path, args_file, states, run_flags=[]):
+    # ChiRun command line of one seed and where its output goes
+    sd_path = os.path.abspath(sd_path)
+    command = "{0} -d {1} -a {2} -s {3}".format(
+        seedlaunchpath, sd_path, args_file, " ".join(states))
+    if run_flags:
+        command += " " + " ".join(run_flags)
+    return (command, os.path.join(sd_path, 'sim.log'),
+            os.path.join(sd_path, 'sim.err'))
+
+
+def lane_string(runs, end):
+    # Runs of one lane go in the background together, one after the other
+    if len(runs) == 1:
+        return runs[0] + end
+    return "( " + "; ".join(runs) + " )" + end
+
+
+def submit_job(command, job_string=None):
+    # Runs the submission command with the job script on its stdin and
+    # returns what it printed
+    p = Popen(command, stdin=PIPE, stdout=PIPE, universal_newlines=True)
+    output, _ = p.communicate(job_string)
+    if p.returncode:
+        print("{0} exited with status {1}".format(" ".join(command), p.returncode))
+    return output
+
+
 def create_multiprocessor_job(seedpaths, statelist, job_name="ChiRun", walltime="1:00",
                               nnodes="1", ntasks="1", nprocs="24", queue="shas", args_file="args.yaml",
-                              qos="condo", allocation="ucb-summit-smr", qmgr='slurm'):
+                              qos="condo", allocation="ucb-summit-smr", qmgr='slurm',
+                              run_flags=[], lanes=None):
+    # lanes are lists of indices into seedpaths. The seeds of a lane run one
+    # after the other in one task, by default every seed is its own lane.
+    if lanes is None:
+        lanes = [[i] for i in range(len(seedpaths))]
     print("creating jobs for:")
     for i, sd_path in enumerate(seedpaths):
         print(
@@ -33,8 +70,7 @@ def create_multiprocessor_job(seedpaths, statelist, job_name="ChiRun", walltime=
 
     # Slurm submission code
     if qmgr == 'slurm':
-        # Open a pipe to the sbatch command.
-        output, input = Popen('sbatch')
+        submit = ['sbatch']
         if walltime.count(':') == 3:
             walltime = walltime.replace(':', '-', 1)
         job_string = """#!/bin/bash
@@ -53,23 +89,21 @@ cd $SLURM_SUBMIT_DIR
 
 
 """.format(job_name, walltime, nnodes, ntasks, nprocs, log, errlog, allocation, qos, queue)
-        for i, sd_path in enumerate(seedpaths):
-            sd_path = os.path.abspath(sd_path)
-            command = "{0} -d {1} -a {2} -s {3}".format(
-                seedlaunchpath, sd_path, args_file, " ".join(statelist[i]))
-            log = os.path.join(sd_path, 'sim.log')
-            errlog = os.path.join(sd_path, 'sim.err')
-            job_string = job_string + \
-                "srun -n1 --exclusive {0} 1> {1} 2> {2} &\n".format(
-                    command, log, errlog)
+        for lane in lanes:
+            runs = []
+            for i in lane:
+                command, log, errlog = seed_command(
+                    seedlaunchpath, seedpaths[i], args_file, statelist[i], run_flags)
+                runs.append("srun -n1 --exclusive {0} 1> {1} 2> {2}".format(
+                    command, log, errlog))
+            job_string = job_string + lane_string(runs, " &\n")
         job_string = job_string + "wait\n"
 
 # FIXME: Needs to be tested on pando before run
     elif qmgr == 'torque':
         log = 'sim.log'
         errlog = 'sim.err'
-        # Open a pipe to the qsub command.
-        output, input = Popen('qsub')
+        submit = ['qsub']
         job_string = """#!/bin/bash
 #PBS -N {0}
 #PBS -l walltime={1}
@@ -81,15 +115,13 @@ cd $SLURM_SUBMIT_DIR
 cd $PBS_O_WORKDIR
 
 """.format(job_name, walltime, nnodes, nprocs, log, errlog, queue)
-        for i, sd_path in enumerate(seedpaths):
-            sd_path = os.path.abspath(sd_path)
-            command = "{0} -d {1} -a {2} -s {3}".format(
-                seedlaunchpath, sd_path, args_file, " ".join(statelist[i]))
-            log = os.path.join(sd_path, 'sim.log')
-            errlog = os.path.join(sd_path, 'sim.err')
-
-            job_string = job_string + command + \
-                " 1> {0} 2> {1}&\n".format(log, errlog)
+        for lane in lanes:
+            runs = []
+            for i in lane:
+                command, log, errlog = seed_command(
+                    seedlaunchpath, seedpaths[i], args_file, statelist[i], run_flags)
+                runs.append(command + " 1> {0} 2> {1}".format(log, errlog))
+            job_string = job_string + lane_string(runs, "&\n")
 
         job_string = job_string + "wait\n"
 
@@ -98,12 +130,155 @@ cd $PBS_O_WORKDIR
         return
 
     # Send job_string to qsub
-    input.write(job_string)
-    input.close()
+    output = submit_job(submit, job_string)
 
     # Print your job and the response to the screen
     print(job_string)
-    print(output.read())
+    print(output)
+
+def create_array_job(seedpaths, statelist, workdir, walltime="1:00", nnodes="1",
+                     ntasks="1", nprocs="24", queue="shas", args_file="args.yaml",
+                     qos="condo", allocation="ucb-summit-smr", run_flags=[]):
+    """ Submits all seeds as one slurm job array. The seeds and their states
+        go into a seed list file, one seed per line, and array task i runs
+        lines i*ntasks+1 to (i+1)*ntasks of it. Both files are kept in
+        WORKDIR/chi_array. Returns the sbatch output, None when there are no
+        seeds to submit.
+    """
+    if not seedpaths:
+        print("No seeds to launch, no job array submitted")
+        return None
+    array_dir = os.path.join(workdir, 'chi_array')
+    if not os.path.isdir(array_dir):
+        os.makedirs(array_dir)
+    name = time.strftime('launch_%Y%m%d_%H%M%S')
+    seed_list = os.path.join(array_dir, name + '.seeds')
+    script = os.path.join(array_dir, name + '.sh')
+    ntasks = int(ntasks)
+    narray = (len(seedpaths) + ntasks - 1) // ntasks
+
+    with open(seed_list, 'w') as f:
+        for sd_path, states in zip(seedpaths, statelist):
+            f.write("{0}\t{1}\n".format(os.path.abspath(sd_path), " ".join(states)))
+
+    seedlaunchpath = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ChiRun.py')
+    flags = "".join([" " + f for f in run_flags])
+    if walltime.count(':') == 3:
+        walltime = walltime.replace(':', '-', 1)
+    job_string = """#!/bin/bash
+#SBATCH --job-name=ChiRunArray
+#SBATCH --array=0-{0}
+#SBATCH -t {1}
+#SBATCH -N {2}
+#SBATCH --ntasks-per-node {3}
+#SBATCH --cpus-per-task {4}
+#SBATCH -o /dev/null
+#SBATCH -e /dev/null
+#SBATCH -A {5}
+#SBATCH --qos={6}
+#SBATCH --partition={7}
+
+cd $SLURM_SUBMIT_DIR
+
+first=$((SLURM_ARRAY_TASK_ID * {3} + 1))
+last=$((first + {3} - 1))
+sed -n "${{first}},${{last}}p" {8} | {{
+while IFS=$'\\t' read -r sd states; do
+    srun -n1 --exclusive {9} -d "$sd" -a {10} -s $states{11} 1> "$sd/sim.log" 2> "$sd/sim.err" &
+done
+wait
+}}
+""".format(narray - 1, walltime, nnodes, ntasks, nprocs, allocation, qos, queue,
+           seed_list, seedlaunchpath, args_file, flags)
+    with open(script, 'w') as f:
+        f.write(job_string)
+
+    print("Submitting {0} seeds as {1} array tasks of {2} seeds".format(
+        len(seedpaths), narray, ntasks))
+    print("   seed list: {}".format(seed_list))
+    print("   script: {}".format(script))
+    output = submit_job(['sbatch', script])
+    print(output)
+    return output
+
+def create_pilot_jobs(seedpaths, statelist, workdir, njobs=1, walltime="1:00",
+                      nnodes="1", ntasks="1", nprocs="24", queue="shas",
+                      args_file="args.yaml", qos="condo", allocation="ucb-summit-smr",
+                      qmgr='slurm', run_flags=[]):
+    """ Puts the seeds into a work queue file in WORKDIR/chi_array and
+        submits njobs jobs of ntasks ChiRun --worker pilots. Each pilot
+        keeps claiming seeds from the queue until it is empty or the
+        walltime is close, so no core waits for the slowest seed of a block.
+    """
+    if not seedpaths:
+        print("No seeds to launch, no pilot jobs submitted")
+        return
+    array_dir = os.path.join(workdir, 'chi_array')
+    if not os.path.isdir(array_dir):
+        os.makedirs(array_dir)
+    name = time.strftime('pilot_%Y%m%d_%H%M%S')
+    work_queue = WorkQueue(os.path.join(array_dir, name + '.queue'))
+    work_queue.Append(seedpaths, statelist)
+
+    # Leave the pilots a minute to wrap up before the job is killed
+    secs = parse_walltime(walltime)
+    secs = max(secs - 60, secs // 2)
+    seedlaunchpath = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ChiRun.py')
+    command = "{0} --worker {1} -a {2} --walltime {3}".format(
+        seedlaunchpath, work_queue.path, args_file, secs)
+    if run_flags:
+        command += " " + " ".join(run_flags)
+    pilot_log = os.path.join(array_dir, name + '.log')
+
+    if qmgr == 'slurm':
+        if walltime.count(':') == 3:
+            walltime = walltime.replace(':', '-', 1)
+        job_string = """#!/bin/bash
+#SBATCH --job-name=ChiRunPilot
+#SBATCH -t {0}
+#SBATCH -N {1}
+#SBATCH --ntasks-per-node {2}
+#SBATCH --cpus-per-task {3}
+#SBATCH -o /dev/null
+#SBATCH -e /dev/null
+#SBATCH -A {4}
+#SBATCH --qos={5}
+#SBATCH --partition={6}
+
+cd $SLURM_SUBMIT_DIR
+
+""".format(walltime, nnodes, ntasks, nprocs, allocation, qos, queue)
+        run = "srun -n1 --exclusive {0} 1>> {1} 2>&1 &\n"
+        submit = ['sbatch']
+    elif qmgr == 'torque':
+        job_string = """#!/bin/bash
+#PBS -N ChiRunPilot
+#PBS -l walltime={0}
+#PBS -l nodes={1}:ppn={2}
+#PBS -o /dev/null
+#PBS -e /dev/null
+#PBS -q {3}
+#PBS -V
+cd $PBS_O_WORKDIR
+
+""".format(walltime, nnodes, nprocs, queue)
+        run = "{0} 1>> {1} 2>&1 &\n"
+        submit = ['qsub']
+    else:
+        print("Invalid qmgr: {0}".format(qmgr))
+        return
+    for i in range(int(ntasks)):
+        job_string = job_string + run.format(command, pilot_log)
+    job_string = job_string + "wait\n"
+
+    print("Queued {0} seeds in {1} for {2} jobs of {3} pilots".format(
+        len(seedpaths), work_queue.path, njobs, ntasks))
+    print(job_string)
+    for i in range(njobs):
+        print(submit_job(submit, job_string))
+        if qmgr == "torque":
+            time.sleep(10)
+    return work_queue
 
 # Create parallel job submissions to be run on the same node(Depricated)
 # def create_parallel_job(seedpaths, statelist, job_name="ChiRun", walltime="1:00",
@@ -193,6 +368,75 @@ cd $PBS_O_WORKDIR
 #     print output.read()
 
 
+# Local backend: runs ChiRun on this machine in a pool of worker processes,
+# for workstations or for use inside one large allocation
+local_worker = {}
+
+
+def init_local_worker(worker_ids, nprocs, args_file, run_flags):
+    # Each worker is pinned to its own nprocs cpus, which the ChiRun
+    # processes it starts inherit
+    wid = worker_ids.get()
+    cpus = available_cpus()
+    mine = [cpus[(wid * nprocs + k) % len(cpus)] for k in range(nprocs)]
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, mine)
+    local_worker['cpus'] = mine
+    local_worker['args_file'] = args_file
+    local_worker['run_flags'] = run_flags
+
+
+def run_local_seed(job):
+    sd_path, states = job
+    sd_path = os.path.abspath(sd_path)
+    command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ChiRun.py'),
+               '-d', sd_path, '-a', local_worker['args_file'], '-s'] + list(states)
+    command += local_worker['run_flags']
+    start = time.time()
+    with open(os.path.join(sd_path, 'sim.log'), 'w') as log, \
+            open(os.path.join(sd_path, 'sim.err'), 'w') as errlog:
+        status = call(command, stdout=log, stderr=errlog)
+    # ChiRun exits cleanly when a state fails, the metrics file tells
+    if not status:
+        status = len([r for r in read_metrics(sd_path)
+                      if float(r['start']) >= start - 1. and r['status'] != '0'])
+    return (sd_path, status, time.time() - start)
+
+
+def run_local_jobs(seedpaths, statelist, nworkers, nprocs=1, args_file="args.yaml",
+                   run_flags=[]):
+    """ Runs ChiRun on every seed in a pool of nworkers processes and prints
+        each seed as it finishes. Returns the number of seeds with a failed
+        state.
+    """
+    nworkers = max(1, min(nworkers, len(seedpaths)))
+    worker_ids = multiprocessing.Queue()
+    for wid in range(nworkers):
+        worker_ids.put(wid)
+    print("Running {0} seeds with {1} local workers".format(len(seedpaths), nworkers))
+    sys.stdout.flush()
+    nfailed = 0
+    start = time.time()
+    pool = multiprocessing.Pool(nworkers, init_local_worker,
+                                (worker_ids, nprocs, args_file, run_flags))
+    try:
+        jobs = zip(seedpaths, statelist)
+        for k, (sd_path, status, wall) in enumerate(pool.imap_unordered(run_local_seed, jobs)):
+            if status:
+                nfailed += 1
+            print("[{0}/{1}] {2} {3} in {4:.1f}s".format(
+                k + 1, len(seedpaths), sd_path, "failed" if status else "done", wall))
+            sys.stdout.flush()
+    except BaseException:
+        pool.terminate()
+        raise
+    pool.close()
+    pool.join()
+    print("Finished {0} seeds in {1:.1f}s, {2} failed".format(
+        len(seedpaths), time.time() - start, nfailed))
+    return nfailed
+
+
 def get_state(path):
     state = []
     # Find all sim.* (excluding sim.err and sim.log)
@@ -214,6 +458,107 @@ def is_error(path):
     return os.path.isfile(os.path.join(path, '.error'))
 
 
+def parse_walltime(walltime):
+    # Seconds in a [[[dd:]hh:]mm:]ss walltime
+    secs = 0
+    for f, x in zip([1, 60, 3600, 86400], reversed(walltime.split(':'))):
+        secs += f * int(x)
+    return secs
+
+
+def median(values):
+    values = sorted(values)
+    n = len(values)
+    if n % 2:
+        return values[n // 2]
+    return 0.5 * (values[n // 2 - 1] + values[n // 2])
+
+
+def estimate_runtimes(seeds, states, history_dirs):
+    """ Estimated wall time in seconds of running states[i] of seeds[i],
+        from the metrics files ChiRun wrote in history_dirs. A state is
+        estimated with the seed's own last successful run, else with the
+        median of its sim (the same parameter set), else with the median of
+        all seeds. None when no seed has a successful run of one of the
+        states.
+    """
+    seed_wall = {}
+    sim_walls = {}
+    state_walls = {}
+    for sd in history_dirs:
+        sim = os.path.dirname(os.path.abspath(sd))
+        for row in read_metrics(sd):
+            if row['status'] != '0':
+                continue
+            wall = float(row['wall'])
+            seed_wall[(os.path.abspath(sd), row['state'])] = wall
+            sim_walls.setdefault((sim, row['state']), []).append(wall)
+            state_walls.setdefault(row['state'], []).append(wall)
+
+    est = []
+    for sd, sd_states in zip(seeds, states):
+        sd = os.path.abspath(sd)
+        sim = os.path.dirname(sd)
+        total = 0.
+        for s in sd_states:
+            if (sd, s) in seed_wall:
+                total += seed_wall[(sd, s)]
+            elif (sim, s) in sim_walls:
+                total += median(sim_walls[(sim, s)])
+            elif s in state_walls:
+                total += median(state_walls[s])
+            else:
+                total = None
+                break
+        est.append(total)
+    return est
+
+
+def pack_seeds(est, ntasks, capacity):
+    """ Packs seeds into jobs of at most ntasks lanes, a lane being seeds run
+        one after the other by one task. Seeds are placed longest first into
+        the fullest lane they still fit in under capacity (best fit
+        decreasing), so there are few, full lanes. Lanes of similar length
+        are then put in the same job, since a job lasts as long as its
+        longest lane. Seeds without an estimate get a lane of their own.
+        Returns the jobs as lists of lanes of seed indices, and the lane
+        lengths.
+    """
+    lanes = []
+    loads = []
+    unknown = [i for i, e in enumerate(est) if e is None]
+    known = sorted([i for i, e in enumerate(est) if e is not None],
+                   key=lambda i: -est[i])
+    for i in known:
+        best = None
+        for j, load in enumerate(loads):
+            if load + est[i] <= capacity and (best is None or load > loads[best]):
+                best = j
+        if best is None:
+            if est[i] > capacity:
+                print("Warning: seed is estimated to need {0:.0f}s, longer than the walltime".format(est[i]))
+            lanes.append([i])
+            loads.append(est[i])
+        else:
+            lanes[best].append(i)
+            loads[best] += est[i]
+    for i in unknown:
+        lanes.append([i])
+        loads.append(float(capacity))
+
+    order = sorted(range(len(lanes)), key=lambda j: -loads[j])
+    jobs = [[lanes[j] for j in order[k:k + ntasks]]
+            for k in range(0, len(order), ntasks)]
+    job_loads = [[loads[j] for j in order[k:k + ntasks]]
+                 for k in range(0, len(order), ntasks)]
+    return jobs, job_loads
+
+
+def task_hours(job_loads):
+    # Tasks requested times how long the job runs, summed over jobs
+    return sum([len(l) * max(l) for l in job_loads]) / 3600.
+
+
 def query_yes_no(question, default="yes"):
     """Ask a yes/no question via raw_input() and return their answer.
 
@@ -256,6 +601,13 @@ def ChiLaunch(simdirs, opts=''):
     else:
         args_file = "args.yaml"
 
+    # Seeds of each sim from the workdir manifest, so sim directories do not
+    # have to be listed. Sims the manifest does not know are listed as before.
+    workdir = opts.workdir if opts else os.getcwd()
+    manifest_seeds = {}
+    for sd in (read_manifest(workdir) or []):
+        manifest_seeds.setdefault(os.path.dirname(sd), []).append(sd)
+
     for simd in simdirs:
         print("Searching for path {0}".format(simd))
 
@@ -264,9 +616,12 @@ def ChiLaunch(simdirs, opts=''):
             continue
         if os.path.exists(simd):
             print("path exists, checking for seeds...")
-            seeddirs = seeddirs + [os.path.join(simd, f) for f in os.listdir(simd)
-                                   if os.path.isdir(os.path.join(simd, f))
-                                   and not f.startswith('.')]
+            if os.path.abspath(simd) in manifest_seeds:
+                seeddirs = seeddirs + manifest_seeds[os.path.abspath(simd)]
+            else:
+                seeddirs = seeddirs + [os.path.join(simd, f) for f in os.listdir(simd)
+                                       if os.path.isdir(os.path.join(simd, f))
+                                       and not f.startswith('.')]
             if not seeddirs:
                 print("no seeds found in sim directory")
                 return 1
@@ -285,15 +640,34 @@ def ChiLaunch(simdirs, opts=''):
 
     # Go through all seed directories and see if they are capable of running
     # ei. No .error file and no .running file
+    # With a state journal in the workdir the states of all seeds come from
+    # one read of the journal instead of the marker files of every seed
+    # Options passed on to every ChiRun
+    run_flags = []
+    store = None
+    if ChiStateStore.Exists(workdir):
+        store = ChiStateStore(workdir).Load()
+        run_flags += ['--state_store', store.workdir]
+    if opts and getattr(opts, 'cache', None):
+        run_flags += ['--cache', os.path.abspath(opts.cache)]
+        if getattr(opts, 'cache_size', None):
+            run_flags += ['--cache_size', opts.cache_size]
     for sdd in seeddirs:
-        if not is_running(sdd) and not is_error(sdd):
+        if store:
+            st = store.Get(sdd)
+            if st.running or st.error:
+                continue
+            state = sorted(st.pending)
+        elif not is_running(sdd) and not is_error(sdd):
             state = get_state(sdd)
-            # print state
-            if runstates != 'all':
-                state = list(set(state).intersection(set(runstates)))
-            if state:
-                seeds.append(sdd)
-                states.append(state)
+        else:
+            continue
+        # print state
+        if runstates != 'all':
+            state = list(set(state).intersection(set(runstates)))
+        if state:
+            seeds.append(sdd)
+            states.append(state)
     print("Jobs found: {0}".format(len(seeds)))
 
     n_jobs = input(
@@ -311,6 +685,18 @@ def ChiLaunch(simdirs, opts=''):
     # much to fix up
     elif scheduler == 'torque':
         queue, nprocs = ("short2gb", "16")
+    elif scheduler == 'local':
+        ncpus = len(available_cpus())
+        nprocs = input('Input number of processors per task (default 1): ').strip()
+        nprocs = int(nprocs) if nprocs else 1
+        nworkers = input('Input number of workers (default {}): '.format(
+            max(1, ncpus // nprocs))).strip()
+        nworkers = int(nworkers) if nworkers else max(1, ncpus // nprocs)
+        if not query_yes_no("Running states ({0}) of {1} seeds locally with {2} workers of {3} processors.".format(
+                " ".join(runstates), min(n_jobs, len(seeds)), nworkers, nprocs)):
+            return 1
+        return run_local_jobs(seeds[:n_jobs], states[:n_jobs], nworkers, nprocs,
+                              args_file, run_flags)
     else:
         print("Chi-pet is not programmed for scheduler '{}'.".format(scheduler))
         sys.exit(1)
@@ -355,6 +741,28 @@ def ChiLaunch(simdirs, opts=''):
 
     # processors = "nodes={0}:ppn={1}".format(nodes,ppn)
 
+    if opts and getattr(opts, 'pilot', None):
+        create_pilot_jobs(seeds[:n_jobs], states[:n_jobs], workdir, opts.pilot,
+                          walltime=walltime, nnodes=nodes, ntasks=ntasks, nprocs=nprocs,
+                          queue=queue, args_file=args_file, qos=qos,
+                          allocation=allocation, qmgr=scheduler, run_flags=run_flags)
+        return
+
+    if opts and getattr(opts, 'array', False):
+        if scheduler != 'slurm':
+            print("Job arrays are only written for slurm.")
+            return 1
+        create_array_job(seeds[:n_jobs], states[:n_jobs], workdir, walltime=walltime,
+                         nnodes=nodes, ntasks=ntasks, nprocs=nprocs, queue=queue,
+                         args_file=args_file, qos=qos, allocation=allocation,
+                         run_flags=run_flags)
+        return
+
+    if opts and getattr(opts, 'pack', False):
+        return launch_packed(seeds[:n_jobs], states[:n_jobs], seeddirs, walltime,
+                             nodes, int(ntasks), nprocs, queue, qos, allocation,
+                             scheduler, run_flags)
+
     for i_block in range(0, int(n_jobs / int(ntasks)) + 1):
         # Find the index range of the seeds that you are running
         starti = i_block * int(ntasks)
@@ -364,18 +772,53 @@ def ChiLaunch(simdirs, opts=''):
         if endi > len(seeds):
             endi = len(seeds)
         if endi > starti:
+            # The last block only asks for the tasks it has seeds for
             create_multiprocessor_job(seeds[starti:endi], states[starti:endi], walltime=walltime,
-                                      nnodes=nodes, ntasks=ntasks, nprocs=nprocs, queue=queue, qos=qos,
-                                      allocation=allocation, qmgr=scheduler)
+                                      nnodes=nodes, ntasks=str(endi - starti), nprocs=nprocs, queue=queue, qos=qos,
+                                      allocation=allocation, qmgr=scheduler,
+                                      run_flags=run_flags)
         # Torque scheduler has a 10 second update time
         # make sure you wait before adding another
-        import time
         if scheduler == "torque":
             time.sleep(10)
         else:
             time.sleep(.1)
 
 
+
+def launch_packed(seeds, states, history_dirs, walltime, nodes, ntasks, nprocs,
+                  queue, qos, allocation, scheduler, run_flags=[]):
+    """ Submits the seeds packed into jobs by their estimated runtimes (see
+        pack_seeds) instead of in blocks of ntasks in discovery order.
+    """
+    est = estimate_runtimes(seeds, states, history_dirs)
+    jobs, job_loads = pack_seeds(est, ntasks, parse_walltime(walltime))
+    n_unknown = len([e for e in est if e is None])
+    if n_unknown:
+        print("{0} of {1} seeds have no runtime estimate and get a task of their own".format(
+            n_unknown, len(seeds)))
+    # Same seeds in blocks of ntasks in discovery order, for comparison
+    block_loads = []
+    for k in range(0, len(seeds), ntasks):
+        block_loads.append([parse_walltime(walltime) if e is None else e
+                            for e in est[k:k + ntasks]])
+    print("Estimated task-hours: {0:.2f} packed in {1} jobs, {2:.2f} in {3} blocks".format(
+        task_hours(job_loads), len(jobs), task_hours(block_loads), len(block_loads)))
+
+    for lanes in jobs:
+        idx = [i for lane in lanes for i in lane]
+        pos = dict([(i, k) for k, i in enumerate(idx)])
+        create_multiprocessor_job([seeds[i] for i in idx], [states[i] for i in idx],
+                                  walltime=walltime, nnodes=nodes, ntasks=str(len(lanes)),
+                                  nprocs=nprocs, queue=queue, qos=qos,
+                                  allocation=allocation, qmgr=scheduler,
+                                  run_flags=run_flags,
+                                  lanes=[[pos[i] for i in lane] for lane in lanes])
+        if scheduler == "torque":
+            time.sleep(10)
+        else:
+            time.sleep(.1)
+
 if __name__ == '__main__':
     if len(sys.argv) > 1:
         # Arguments are the simulation directories to be run
@@ -5,9 +5,13 @@ import pdb
 import re
 import numpy as np 
 import shutil
+import errno
+import fcntl
+import hashlib
 import yaml
 from collections import OrderedDict
 from math import *
+from ChiYaml import OrderedYamlLoad, OrderedYamlDump, YamlScalarString
 
 '''
 Name: ChiLib.py
@@ -25,44 +29,91 @@ def CreateDictFromYamlFile(path):
         ydict = OrderedYamlLoad(f)
         return ydict
 
-# Taken from http://stackoverflow.com/questions/5121931/in-python-how-can-you-load-yaml-mappings-as-ordereddicts/21048064#21048064
-# Usage: yaml_dict = OrderedYamlLoad(istream)
-def OrderedYamlLoad(stream, Loader=yaml.Loader, object_pairs_hook=OrderedDict):
-    class OrderedLoader(Loader):
-        pass
-    def construct_mapping(loader, node):
-        loader.flatten_mapping(node)
-        return object_pairs_hook(loader.construct_pairs(node))
-    OrderedLoader.add_constructor(
-        yaml.resolver.BaseResolver.DEFAULT_MAPPING_TAG,
-        construct_mapping)
-    return yaml.load(stream, OrderedLoader)
-
-# Usage: OrderedYamlDump(yaml_dictionary, ostream)
-def OrderedYamlDump(data, stream=None, Dumper=yaml.Dumper, **kwds):
-    class OrderedDumper(Dumper):
-        pass
-    def _dict_representer(dumper, data):
-        return dumper.represent_mapping(
-            yaml.resolver.BaseResolver.DEFAULT_MAPPING_TAG,
-            list(data.items()))
-    OrderedDumper.add_representer(OrderedDict, _dict_representer)
-    return yaml.dump(data, stream, OrderedDumper, **kwds)
-
-# Function that creates a list of list of all possible parameter indices
-def ind_recurse(pi_list, p_index=0):
-    l = [] # return list
-    # Cycle through possible value indices for parameter with param index, p_index
-    for i in range(pi_list[p_index]):
-        if p_index == len(pi_list)-1:
-            # If at the last index (end of recursion) start constructing index list
-            l += [[i]]
-        else:
-            # Prepend i value to front of sublists using recursion
-            lst = ind_recurse(pi_list, p_index+1)
-            for x in lst:
-                l += [[i]+ x]
-    return l
+# Placeholder put in the yaml tree where a ChiParam or ChiSeed value goes
+# while a template is being compiled
+TEMPLATE_SLOT = '__chi_slot_{}__'
+template_slot_pat = re.compile(r'__chi_slot_(\d+)__')
+
+# Values of these types are written as plain scalars that do not depend on
+# their position in the document, so they can be pasted into a template.
+# Anything else (lists, strings, numpy scalars) falls back to a full dump.
+template_scalar_types = (bool, int, float)
+
+class YamlTemplate(object):
+    """ Yaml file dumped once with placeholders at the ChiParam/ChiSeed
+        locations. Render substitutes the slot values into the dumped text,
+        which gives the same bytes as an OrderedYamlDump of the filled tree.
+    """
+    def __init__(self, data, text, obj_refs):
+        self.data = data
+        self.obj_refs = obj_refs
+        pieces = template_slot_pat.split(text)
+        self.pieces = pieces[0::2]
+        self.slots = [int(x) for x in pieces[1::2]]
+
+    def Render(self, values):
+        out = [self.pieces[0]]
+        for k, piece in zip(self.slots, self.pieces[1:]):
+            if type(values[k]) not in template_scalar_types:
+                return self.RenderFull(values)
+            out += [YamlScalarString(values[k]), piece]
+        return ''.join(out)
+
+    def RenderFull(self, values):
+        for k in self.slots:
+            self.obj_refs[k].Set(values[k])
+        return OrderedYamlDump(self.data, default_flow_style=False)
+
+def CompileYamlTemplates(yml_file_dict, obj_refs):
+    # Dump every file once with slot i at the location of obj_refs[i]
+    saved = [r.GetValue() for r in obj_refs]
+    for i, r in enumerate(obj_refs):
+        r.Set(TEMPLATE_SLOT.format(i))
+    templates = OrderedDict()
+    for f, d in yml_file_dict.items():
+        text = OrderedYamlDump(d, default_flow_style=False)
+        templates[f] = YamlTemplate(d, text, obj_refs)
+    # Put the tree back the way it was
+    for r, v in zip(obj_refs, saved):
+        r.Set(v)
+    return templates
+
+# Generator of all combinations of parameter indices in the order of a nested
+# loop (last index changes fastest). Only one index list is held at a time and
+# iteration can start at any linear index, which is what lets a sweep be split
+# into shards.
+def ind_product(pi_list, start=0, stop=None):
+    total = ind_count(pi_list)
+    if stop is None or stop > total:
+        stop = total
+    if start >= stop:
+        return
+    # Mixed radix digits of the starting linear index
+    ind = []
+    rem = start
+    for n in reversed(pi_list):
+        ind.insert(0, rem % n)
+        rem //= n
+    for _ in range(stop - start):
+        yield list(ind)
+        # Step to the next combination like an odometer
+        for k in range(len(ind)-1, -1, -1):
+            ind[k] += 1
+            if ind[k] < pi_list[k]:
+                break
+            ind[k] = 0
+
+# Number of combinations ind_product will produce
+def ind_count(pi_list):
+    total = 1
+    for n in pi_list:
+        total *= n
+    return total
+
+# Linear index range [start, stop) of shard i out of n for a sweep of total
+# combinations. Shards are disjoint and cover the whole sweep.
+def shard_range(total, i, n):
+    return (total * i) // n, (total * (i + 1)) // n
 
 # Recursive function to find ChiParams in program and 
 # returns a list of references to those objects
@@ -85,6 +136,18 @@ def find_str_values(obj, pattern='^ChiParam\(.*\)'):
     else:
         return
 
+# Reference to the first value stored under key anywhere in obj, None if
+# there is none
+def find_key(obj, key):
+    if isinstance(obj, dict) and key in obj:
+        return ObjRef(obj, key)
+    if isinstance(obj, (dict, list)):
+        for v in (obj.values() if isinstance(obj, dict) else obj):
+            ref = find_key(v, key)
+            if ref is not None:
+                return ref
+    return None
+
 
 class ObjRef(object):
     def __init__(self, obj, key):
@@ -100,17 +163,325 @@ class ObjRef(object):
     def __repr__(self):
         return self.obj[self.key]
 
+# Ways to put a non-yaml input file into a seed directory
+link_modes = ['copy', 'hardlink', 'reflink', 'symlink']
+
+# Linux ioctl that clones a file's extents (_IOW(0x94, 9, int))
+FICLONE = 0x40049409
+
+# Errors meaning the file system can not do the requested kind of link
+link_unsupported_errnos = set([errno.EXDEV, errno.EPERM, errno.EMLINK,
+                               errno.EINVAL, errno.ENOTTY, errno.ENOSYS,
+                               errno.EOPNOTSUPP, getattr(errno, 'ENOTSUP', errno.EOPNOTSUPP)])
+
+def reflink(src, dst):
+    with open(src, 'rb') as fsrc:
+        with open(dst, 'wb') as fdst:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+    shutil.copymode(src, dst)
+
+class FileLinker(object):
+    """ Puts input files into seed directories using one of link_modes.
+        When the file system refuses the requested mode it is dropped for
+        the rest of the run and files are copied instead. Keeps count of
+        the bytes written to disk and the bytes that linking avoided.
+
+        With a store_dir, file bodies shared between seeds are written once
+        into a content-addressed store and linked into the seeds from there.
+    """
+    def __init__(self, mode='copy', store_dir=None):
+        self.requested_mode = mode
+        self.mode = mode
+        # Store files are always linked, by hardlink unless asked otherwise
+        self.store_dir = store_dir
+        self.store_mode = mode if mode != 'copy' else 'hardlink'
+        self.store_known = set()
+        self.bytes_written = 0
+        self.bytes_avoided = 0
+        self.sizes = {}
+
+    def Link(self, src, dst, mode):
+        # Returns the mode that was actually used
+        if mode != 'copy':
+            try:
+                if mode == 'hardlink':
+                    os.link(src, dst)
+                elif mode == 'symlink':
+                    os.symlink(os.path.abspath(src), dst)
+                elif mode == 'reflink':
+                    reflink(src, dst)
+                return mode
+            except (OSError, IOError) as e:
+                if e.errno not in link_unsupported_errnos:
+                    raise
+                print(" -- Can not {0} {1} ({2}), copying files instead -- ".format(
+                    mode, src, e.strerror))
+                if os.path.lexists(dst):
+                    os.remove(dst)
+        shutil.copy(src, dst)
+        return 'copy'
+
+    def Count(self, src, mode):
+        if src not in self.sizes:
+            self.sizes[src] = os.path.getsize(src)
+        if mode == 'copy':
+            self.bytes_written += self.sizes[src]
+        else:
+            self.bytes_avoided += self.sizes[src]
+
+    def Place(self, src, dst_dir, name=None):
+        dst = os.path.join(dst_dir, name or os.path.basename(src))
+        self.mode = self.Link(src, dst, self.mode)
+        self.Count(src, self.mode)
+
+    def WriteText(self, text, dst_dir, name):
+        with open(os.path.join(dst_dir, name), 'w') as of:
+            of.write(text)
+        self.bytes_written += len(text)
+
+    def PlaceText(self, text, dst_dir, name):
+        # Text that other seeds share goes through the store if there is one
+        if self.store_dir is None:
+            self.WriteText(text, dst_dir, name)
+            return
+        src = self.StorePut(text)
+        self.store_mode = self.Link(src, os.path.join(dst_dir, name), self.store_mode)
+        self.Count(src, self.store_mode)
+
+    def StorePut(self, text):
+        # Store path is <store_dir>/<sha1[:2]>/<sha1> of the body
+        digest = hashlib.sha1(text.encode('utf-8')).hexdigest()
+        path = os.path.join(self.store_dir, digest[:2], digest)
+        if digest in self.store_known:
+            return path
+        if not os.path.exists(path):
+            sub_dir = os.path.dirname(path)
+            try:
+                os.makedirs(sub_dir)
+            except OSError:
+                if not os.path.isdir(sub_dir):
+                    raise
+            # Write under a private name and rename so that other creating
+            # processes never link a partly written file. Store files are
+            # read only since every seed linking them shares the inode.
+            tmp = "{0}.{1}.tmp".format(path, os.getpid())
+            with open(tmp, 'w') as of:
+                of.write(text)
+            os.chmod(tmp, 0o444)
+            os.rename(tmp, path)
+            self.bytes_written += len(text)
+        self.store_known.add(digest)
+        return path
+
+    def Add(self, bytes_written, bytes_avoided):
+        # Fold in the counts of a linker that ran in another process
+        self.bytes_written += bytes_written
+        self.bytes_avoided += bytes_avoided
+
+    def Report(self):
+        print(" -- Input files: {0} bytes written, {1} bytes avoided (--link-mode {2}{3}) -- ".format(
+            self.bytes_written, self.bytes_avoided, self.requested_mode,
+            ", store {}".format(self.store_dir) if self.store_dir else ""))
+
+def CreateLinker(opts):
+    # FileLinker for the creation options (opts of older pickled runs may
+    # not have them)
+    store_dir = None
+    if getattr(opts, 'store', False):
+        store_dir = os.path.join(opts.workdir, 'chi_store')
+    return FileLinker(getattr(opts, 'link_mode', 'copy'), store_dir)
+
+# Seed directory names end in s<number>
+is_seed_dir = re.compile(r's\d+$')
+
+# File in the workdir that lists the seed directories ChiCreate made, one
+# path relative to the workdir per line
+MANIFEST_NAME = 'chi_manifest.txt'
+
+class ManifestWriter(object):
+    """ Appends seed directories to the workdir manifest. Each sim is one
+        O_APPEND write of whole lines, so shards creating into the same
+        workdir at the same time do not mix up each other's lines.
+    """
+    def __init__(self, workdir):
+        self.workdir = os.path.abspath(workdir)
+        self.fd = os.open(os.path.join(self.workdir, MANIFEST_NAME),
+                          os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+
+    def AddSim(self, sim_dir, sd_names):
+        sim_rel = os.path.relpath(os.path.abspath(sim_dir), self.workdir)
+        lines = ''.join([os.path.join(sim_rel, sn) + '\n' for sn in sd_names])
+        os.write(self.fd, lines.encode('utf-8'))
+
+    def Close(self):
+        os.close(self.fd)
+
+def read_manifest(workdir):
+    """ Absolute seed paths listed in the workdir manifest, or None when
+        the workdir has no manifest. Entries whose directory is gone (a sim
+        removed by hand) are left out, like a walk would not find them.
+    """
+    path = os.path.join(workdir, MANIFEST_NAME)
+    if not os.path.isfile(path):
+        return None
+    workdir = os.path.abspath(workdir)
+    seed_dirs = []
+    seen = set()
+    with open(path, 'r') as f:
+        for line in f:
+            sd = line.rstrip('\n')
+            if sd and sd not in seen:
+                seen.add(sd)
+                if os.path.isdir(os.path.join(workdir, sd)):
+                    seed_dirs.append(os.path.join(workdir, sd))
+    return seed_dirs
+
+def prune_manifest(workdir, run_dir):
+    # Drop the manifest entries under run_dir, used when it is recreated
+    path = os.path.join(workdir, MANIFEST_NAME)
+    if not os.path.isfile(path):
+        return
+    prefix = os.path.relpath(os.path.abspath(run_dir), os.path.abspath(workdir)) + os.sep
+    with open(path, 'r') as f:
+        lines = [l for l in f if not l.startswith(prefix)]
+    with open(path, 'w') as f:
+        f.writelines(lines)
+
+def walk_seed_dirs(path):
+    """ Walk that stops at seed directories instead of descending into the
+        output trees below them.
+    """
+    stack = [path]
+    while stack:
+        current = stack.pop()
+        if is_seed_dir.search(current):
+            yield os.path.abspath(current)
+            continue
+        try:
+            entries = sorted([e.path for e in os.scandir(current)
+                              if e.is_dir(follow_symlinks=False)], reverse=True)
+        except OSError:
+            continue
+        stack += entries
+
 def find_seed_dirs(path):
-    is_seed = re.compile('s\d+$')
-    for current, dirnames, filenames in os.walk(path):
-        if is_seed.search(current):
-            yield  os.path.abspath(current)
+    # Use the manifest ChiCreate wrote if there is one
+    seed_dirs = read_manifest(path)
+    if seed_dirs is None:
+        seed_dirs = walk_seed_dirs(path)
+    for sd in seed_dirs:
+        yield sd
+
+# File in each seed directory that ChiRun appends a line to for every state
+# it runs. The first line is a tab separated header naming the columns.
+# Times are in seconds, maxrss in kilobytes and inblock/oublock are the
+# number of block input/output operations, all as reported by wait4.
+METRICS_NAME = 'chi_metrics.txt'
+METRICS_COLUMNS = ['state', 'status', 'start', 'wall',
+                   'utime', 'stime', 'maxrss', 'inblock', 'oublock']
+
+def write_metrics(seed_dir, values, columns=METRICS_COLUMNS):
+    path = os.path.join(seed_dir, METRICS_NAME)
+    lines = ''
+    if not os.path.isfile(path):
+        lines += '\t'.join(columns) + '\n'
+    else:
+        with open(path, 'r') as f:
+            header = f.readline().rstrip('\n').split('\t')
+        if header != columns:
+            # Written with other columns, rewrite the old rows in the new ones
+            rows = read_metrics(seed_dir)
+            lines += '\t'.join(columns) + '\n'
+            lines += ''.join(['\t'.join([r.get(c, '') for c in columns]) + '\n'
+                              for r in rows])
+            os.remove(path)
+    lines += '\t'.join([str(values.get(c, '')) for c in columns]) + '\n'
+    with open(path, 'a') as f:
+        f.write(lines)
+
+def read_metrics(seed_dir):
+    """ Rows of the seed's metrics file as dictionaries keyed by column
+        name, oldest first. Empty when the seed has not run yet.
+    """
+    path = os.path.join(seed_dir, METRICS_NAME)
+    if not os.path.isfile(path):
+        return []
+    with open(path, 'r') as f:
+        lines = f.read().splitlines()
+    if not lines:
+        return []
+    columns = lines[0].split('\t')
+    return [dict(zip(columns, l.split('\t'))) for l in lines[1:] if l]
+
+class WorkQueue(object):
+    """ File of seeds to run shared by ChiRun --worker pilots. Each line is
+        a seed path and its space separated states, separated by a tab.
+        A cursor file holds the byte offset of the next unclaimed line.
+        Claims and appends hold an flock on the lock file, so every line is
+        handed to exactly one worker.
+    """
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        self.lock = self.path + '.lock'
+        self.cursor = self.path + '.cursor'
+
+    def Locked(self):
+        lf = open(self.lock, 'a')
+        fcntl.flock(lf, fcntl.LOCK_EX)
+        return lf
+
+    def Append(self, seedpaths, statelist):
+        lines = ''.join(["{0}\t{1}\n".format(os.path.abspath(sd), " ".join(states))
+                         for sd, states in zip(seedpaths, statelist)])
+        with self.Locked():
+            with open(self.path, 'a') as f:
+                f.write(lines)
+
+    def ReadCursor(self):
+        if not os.path.isfile(self.cursor):
+            return 0
+        with open(self.cursor, 'r') as f:
+            text = f.read().strip()
+        return int(text) if text else 0
+
+    def Claim(self):
+        """ Next seed as (seed_dir, states), or None when the queue is empty """
+        with self.Locked():
+            offset = self.ReadCursor()
+            if not os.path.isfile(self.path):
+                return None
+            with open(self.path, 'rb') as f:
+                f.seek(offset)
+                line = f.readline()
+            if not line.endswith(b'\n'):
+                return None
+            tmp = "{0}.{1}.tmp".format(self.cursor, os.getpid())
+            with open(tmp, 'w') as f:
+                f.write(str(offset + len(line)))
+            os.rename(tmp, self.cursor)
+        sd, states = line[:-1].decode('utf-8').split('\t')
+        return (sd, states.split())
+
+    def Remaining(self):
+        with self.Locked():
+            offset = self.ReadCursor()
+            if not os.path.isfile(self.path):
+                return 0
+            with open(self.path, 'rb') as f:
+                f.seek(offset)
+                return len(f.readlines())
 
 def touch(fname, times=None):
     """ Replicates the UNIX touch command """
     with open(fname, 'a'):
         os.utime(fname, times)
 
+def available_cpus():
+    # Sorted ids of the cpus this process may run on
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
 def find_dirs(path):
     """ Find all the child directories one level deep and return a list 
         of the absolute paths.
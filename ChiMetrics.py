@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+import sys
+import os
+import pandas as pd
+from ChiLib import *
+
+'''
+Name: ChiMetrics.py
+Description: Collects the per state resource records ChiRun writes to
+    chi_metrics.txt in every seed directory into one table, and sums them up
+    per state for sizing allocations.
+Input: ChiMetrics.py [WORKDIR] prints the per state summary of WORKDIR
+'''
+
+# Columns that are summed up, besides the counts
+numeric_columns = ['wall', 'utime', 'stime', 'maxrss', 'inblock', 'oublock']
+
+def collect_metrics(seed_dirs, workdir=None):
+    """ One row per state run of every seed, with the sim and seed
+        directories (relative to workdir when given) in front.
+    """
+    rows = []
+    for sd in seed_dirs:
+        sd_abs = os.path.abspath(sd)
+        sim = os.path.dirname(sd_abs)
+        if workdir:
+            sim = os.path.relpath(sim, os.path.abspath(workdir))
+        for r in read_metrics(sd_abs):
+            r['sim'] = sim
+            r['seed'] = os.path.basename(sd_abs)
+            rows.append(r)
+    df = pd.DataFrame(rows, columns=['sim', 'seed'] + METRICS_COLUMNS)
+    for c in ['status', 'start'] + numeric_columns:
+        df[c] = pd.to_numeric(df[c], errors='coerce')
+    return df
+
+def summarize_metrics(df):
+    """ Per state: number of runs and failures, wall time statistics, the
+        cpu hours used and the largest resident set and block I/O.
+    """
+    df = df.assign(cpu=df['utime'] + df['stime'],
+                   failed=(df['status'] != 0).astype(int))
+    g = df.groupby('state', sort=False)
+    table = pd.DataFrame({
+        'runs': g.size(),
+        'failed': g['failed'].sum(),
+        'wall_mean': g['wall'].mean(),
+        'wall_median': g['wall'].median(),
+        'wall_max': g['wall'].max(),
+        'wall_hours': g['wall'].sum() / 3600.,
+        'cpu_hours': g['cpu'].sum() / 3600.,
+        'maxrss_mb': g['maxrss'].max() / 1024.,
+        'inblock': g['inblock'].sum(),
+        'oublock': g['oublock'].sum(),
+        })
+    return table
+
+def MetricsReport(workdir, out_file=None):
+    df = collect_metrics(find_seed_dirs(workdir), workdir)
+    if df.empty:
+        print("No {0} files found under {1}".format(METRICS_NAME, workdir))
+        return df
+    with pd.option_context('display.width', 200, 'display.max_columns', None,
+                           'display.float_format', '{:.3f}'.format):
+        print(summarize_metrics(df))
+    if out_file:
+        df.to_csv(out_file, index=False)
+        print("Wrote {0} records to {1}".format(len(df), out_file))
+    return df
+
+
+##########################################
+if __name__ == "__main__":
+    MetricsReport(sys.argv[1] if len(sys.argv) > 1 else os.getcwd())
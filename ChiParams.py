@@ -5,6 +5,7 @@ import os
 import pdb
 import re
 import numpy as np
+from copy import copy
 import random
 import hashlib
 from shutil import copy as cp
@@ -15,9 +16,10 @@ from itertools import repeat
 from collections import OrderedDict
 from ChiLib import *
 from copy import copy
-from copy import deepcopy
 import bisect
 import pandas as pd
+from multiprocessing import Pool
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 '''
 Name:ChiParams.py
@@ -55,6 +57,59 @@ def Replicate(item_str, bounds=[], n_vars=None):
 def UniformRandom(bounds):
     return random.uniform(bounds[0], bounds[-1])
 
+
+# Space filling designs. In shotgun mode all the ChiParams that use the same
+# design and seed are drawn jointly, one column of a single n x d design each,
+# instead of one value at a time through AddValue. Without a seed, one is drawn
+# from random so runs stay reproducible under random.seed.
+def unit_design(name, n, d, seed=None):
+    # n points of the design name in the d dimensional unit cube
+    from scipy.stats import qmc
+    if seed is None:
+        seed = random.getrandbits(32)
+    if name == 'LatinHypercube':
+        return qmc.LatinHypercube(d, seed=seed).random(n)
+    if name == 'Halton':
+        return qmc.Halton(d, scramble=True, seed=seed).random(n)
+    if n & (n - 1):
+        print("## Sobol design of {} points is not a power of 2, its balance properties are lost".format(n))
+    import warnings
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        return qmc.Sobol(d, scramble=True, seed=seed).random(n)
+
+
+def design_spec(exec_str):
+    # (design name, bounds, seed) of an exec_str using a space filling design,
+    # None for any other exec_str
+    m = re.match(r'\s*(LatinHypercube|Halton|Sobol)\(', exec_str)
+    if m is None:
+        return None
+    name = m.group(1)
+
+    def spec(bounds, n_vars=None, seed=None):
+        return (name, bounds, seed)
+    return eval(exec_str, globals(), {name: spec})
+
+
+def scale_design(u, bounds):
+    return bounds[0] + u * (bounds[-1] - bounds[0])
+
+
+def LatinHypercube(bounds, n_vars=10, seed=None):
+    # Latin hypercube sample of n_vars values between bounds[0] and bounds[-1]
+    return scale_design(unit_design('LatinHypercube', n_vars, 1, seed)[:, 0], bounds)
+
+
+def Halton(bounds, n_vars=10, seed=None):
+    # Scrambled Halton sequence of n_vars values between bounds[0] and bounds[-1]
+    return scale_design(unit_design('Halton', n_vars, 1, seed)[:, 0], bounds)
+
+
+def Sobol(bounds, n_vars=10, seed=None):
+    # Scrambled Sobol sequence of n_vars values between bounds[0] and bounds[-1]
+    return scale_design(unit_design('Sobol', n_vars, 1, seed)[:, 0], bounds)
+
 # Class that holds all the values for a single parameter in a run
 
 
@@ -139,6 +194,20 @@ class ChiParam(object):
         return self.format_str
 
 
+# Arrays of the optimizers that change every generation, checkpointed per
+# generation next to the positions (see ChiCheckpoint). pgen is the
+# generation of each particle's current candidate in steady state mode. With
+# successive halving (see ChiHalving) rung is the rung of the generation,
+# alive the candidates still in the running and erung the last rung each
+# candidate was evaluated at.
+halving_state = ['rung', 'alive', 'erung']
+swarm_state = ['fitness', 'velocity', 'pbest', 'pbestid', 'pbestpos',
+               'gbest', 'gbestid', 'gbestpos', 'pgen'] + halving_state
+genetics_state = ['fitness', 'pelite', 'peliteid', 'elitepos', 'lastpos',
+                  'lastfit', 'parents', 'pgen'] + halving_state
+bayes_state = ['fitness', 'evalpos', 'evalfit']
+
+
 class ChiSim(object):
     def __init__(self, chiparams, yml_file_dict, opts):
         self.chiparams = chiparams
@@ -150,6 +219,7 @@ class ChiSim(object):
             cparam.UpdateValues()
 
     def UpdateShotgunParamValues(self):
+        designs = OrderedDict()
         for cparam in self.chiparams:
             if cparam.values:
                 # TODO If two param value lists are different,
@@ -161,10 +231,19 @@ class ChiSim(object):
                         self.opts.n))
                     self.opts.n = cparam.GetNValues()
                 continue
+            elif design_spec(cparam.exec_str):
+                name, bounds, seed = design_spec(cparam.exec_str)
+                designs.setdefault((name, seed), []).append((cparam, bounds))
             else:
                 for i in range(self.opts.n):
                     cparam.AddValue()
 
+        # Each design is drawn once for all of its ChiParams
+        for (name, seed), members in designs.items():
+            u = unit_design(name, self.opts.n, len(members), seed)
+            for j, (cparam, bounds) in enumerate(members):
+                cparam.values += [cparam.paramtype(v) for v in scale_design(u[:, j], bounds)]
+
     def MakeSeeds(self):
         sd_obj = next(find_str_values(self.yml_file_dict,
                                       pattern='^ChiSeed\(.*\)'))
@@ -172,26 +251,72 @@ class ChiSim(object):
         self.seeds.SetObjRef(sd_obj)
         self.seeds.CreateSeedList()
 
-    def MakeSimDirectory(self, run_dir, ind_lst=[]):
+    def CompileTemplates(self):
+        # Template slots are the ChiParams in order followed by the ChiSeed
+        obj_refs = [p.obj_r for p in self.chiparams] + [self.seeds.obj_r]
+        self.yml_templates = CompileYamlTemplates(self.yml_file_dict, obj_refs)
+
+    def SimAssignment(self, ind_lst):
+        # Sim directory name and ChiParam values for one index vector
+        values = [p[i] for i, p in zip(ind_lst, self.chiparams)]
+        sim_name = "_".join([p.format(v) for p, v in zip(self.chiparams, values)])
+        return sim_name, values
+
+    def MakeSimDirectoriesParallel(self, run_dir, ind_lsts, jobs, linker,
+                                   recorders=[]):
+        # The parent only works out the sim names and values. Rendering and
+        # writing the sim/seed trees is done by a pool of processes that each
+        # have their own copy of the templates, so nothing shared is mutated.
+        def assignments():
+            for il in ind_lsts:
+                sim_name, values = self.SimAssignment(il)
+                yield os.path.join(run_dir, sim_name), values
+
+        pool = Pool(jobs, InitSimWorker,
+                    (self.seeds, self.yml_templates, self.opts))
+        try:
+            for sim_dir, written, avoided in pool.imap(MakeSimTree, assignments(),
+                                                       chunksize=8):
+                print("   {}".format(sim_dir))
+                linker.Add(written, avoided)
+                for r in recorders:
+                    r.AddSim(sim_dir, self.seeds.sd_names)
+        except BaseException:
+            pool.terminate()
+            raise
+        pool.close()
+        pool.join()
+
+    def MakeSimDirectory(self, run_dir, ind_lst=[], linker=None, recorders=[]):
         sim_name = ""
+        values = []
         for i, p in zip(ind_lst, self.chiparams):
             # dir_name += "{}_".format(p.format(p[i]))
             p.UpdateParamValue(i)
             # print p[i]
+            values += [p[i]]
             sim_name += p.format(p[i]) + "_"
 
         sim_dir = os.path.join(run_dir, sim_name[:-1])
         os.mkdir(sim_dir)
         print("   {}".format(sim_dir))
-        self.seeds.MakeSeedDirectories(sim_dir, self.yml_file_dict, self.opts)
-
-    def MakeSimDirectoryDatabase(self, run_dir, gen, ind_lst=[]):
+        self.seeds.MakeSeedDirectories(sim_dir, self.yml_file_dict, self.opts,
+                                       getattr(self, 'yml_templates', None), values,
+                                       linker)
+        # Let the manifest and state journal know about the new seeds
+        for r in recorders:
+            r.AddSim(sim_dir, self.seeds.sd_names)
+
+    def MakeSimDirectoryDatabase(self, run_dir, gen, ind_lst=[], linker=None,
+                                 recorders=[]):
         # Update the parameter values the same as the last type of sim
         # directory sturcture
         sim_values = ""
         sim_name = ""
+        values = []
         for i, p in zip(ind_lst, self.chiparams):
             p.UpdateParamValue(i)
+            values += [p[i]]
             sim_values += str(p[i]) + " "
             sim_name += p.format(p[i]) + "_"
 
@@ -213,7 +338,12 @@ class ChiSim(object):
         sim_dir = os.path.join(run_dir, hash_object.hexdigest())
         os.mkdir(sim_dir)
         print("   {} (from {})".format(sim_dir, sim_name))
-        self.seeds.MakeSeedDirectories(sim_dir, self.yml_file_dict, self.opts)
+        self.seeds.MakeSeedDirectories(sim_dir, self.yml_file_dict, self.opts,
+                                       getattr(self, 'yml_templates', None), values,
+                                       linker)
+        # Let the manifest and state journal know about the new seeds
+        for r in recorders:
+            r.AddSim(sim_dir, self.seeds.sd_names)
 
     def DumpPickle(self, sim_dir):
         pkl_filename = os.path.join(sim_dir, 'sim_data.pickle')
@@ -228,43 +358,154 @@ class ChiSim(object):
         return np.exp(-np.power(x - mu, 2.) / (2 * np.power(sigma, 2.)))
 
     # ParticleSwarm specific information
+    # The swarm is kept as (particle, chiparam) arrays: velocity, the
+    # personal best positions pbestpos and the global best position gbestpos.
+    # The current positions live in the chiparam values, which the sim
+    # directories are made from.
     def CreateParticleSwarm(self):
         self.nparticles = self.opts.n
-        self.pbest = [np.float(-100.0) for i in range(self.nparticles)]
-        self.pbestid = [np.int(i) for i in range(self.nparticles)]
-        self.pbestx = [deepcopy(self.chiparams)
-                       for i in range(self.nparticles)]
+        self.pbest = np.full(self.nparticles, -100.0)
+        self.pbestid = np.arange(self.nparticles)
+        self.pbestpos = self.SwarmPositions()
         self.pbest_better = [' ' for i in range(self.nparticles)]
-        self.gbest = np.float(-100.0)
-        self.gbestid = np.int(0)
-        self.gbestx = None
+        self.gbest = -100.0
+        self.gbestid = 0
+        self.gbestpos = None
         self.gbest_better = ' '
-        self.fitness = [np.float(-100.0) for i in range(self.nparticles)]
-        self.velocity = np.zeros((self.nparticles, len(self.chiparams)))
+        self.pgen = None
+        self.fitness = [-100.0 for i in range(self.nparticles)]
         # For each chiparam, create a velocity based on the vmax for each
-        # particle and each chiparam
-        for ichi in range(len(self.chiparams)):
-            vmax = self.chiparams[ichi].bounds[1] - \
-                self.chiparams[ichi].bounds[0]
-            #print "chiparam{} vmax {}".format(ichi, vmax)
-            for idx in range(self.nparticles):
-                self.velocity[idx][ichi] = random.uniform(-vmax, vmax)
-        #print "velocity: {}".format(self.velocity)
+        # particle and each chiparam (drawn in chiparam major order)
+        lower, upper = self.SwarmBounds()
+        self.velocity = np.array([[random.uniform(-vmax, vmax)
+                                   for idx in range(self.nparticles)]
+                                  for vmax in upper - lower]).T.reshape(
+                                      self.nparticles, len(self.chiparams))
+
+    def SwarmPositions(self):
+        # Current positions as a (particle, chiparam) array
+        return np.array([cparam.values[:self.nparticles]
+                         for cparam in self.chiparams], dtype=float).T.reshape(
+                             self.nparticles, len(self.chiparams))
+
+    def SetSwarmPositions(self, positions, rows=None):
+        # Positions of all particles, or of the particles in rows
+        for ichi, cparam in enumerate(self.chiparams):
+            if rows is None:
+                cparam.values[:self.nparticles] = [
+                    cparam.paramtype(v) for v in positions[:, ichi]]
+                continue
+            for idx, v in zip(rows, positions[:, ichi]):
+                cparam.values[idx] = cparam.paramtype(v)
+
+    def Rows(self, indices=None):
+        # Particles an update works on, all of them by default
+        if indices is None:
+            return np.arange(self.nparticles)
+        return np.asarray(indices, dtype=int)
+
+    def SwarmBounds(self):
+        bounds = np.array([cparam.bounds[:2] for cparam in self.chiparams],
+                          dtype=float).reshape(len(self.chiparams), 2)
+        return bounds[:, 0], bounds[:, 1]
+
+    def GetState(self, names):
+        # Positions and the named arrays, None (no global best yet) is left out
+        state = {'positions': self.SwarmPositions()}
+        for name in names:
+            if getattr(self, name, None) is not None:
+                state[name] = getattr(self, name)
+        return state
+
+    def SetState(self, names, state):
+        self.SetSwarmPositions(state['positions'])
+        for name in names:
+            value = state.get(name)
+            if value is not None and value.ndim == 0:
+                value = value.item()
+            elif name == 'fitness':
+                value = value.tolist()
+            setattr(self, name, value)
+
+    def Static(self, names):
+        # Shallow copy without the named arrays, for the setup checkpoint
+        sim = copy(self)
+        for name in names:
+            sim.__dict__.pop(name, None)
+        return sim
+
+    def UpgradeSwarm(self):
+        # Swarms pickled before the arrays kept a copy of every chiparam for
+        # the personal and global bests, take the best positions out of them
+        if hasattr(self, 'pbestpos'):
+            return
+        self.pbest = np.array(self.pbest, dtype=float)
+        self.pbestid = np.array(self.pbestid, dtype=int)
+        self.pbestpos = np.array(
+            [[self.pbestx[idx][ichi].values[self.pbestid[idx]]
+              for ichi in range(len(self.chiparams))]
+             for idx in range(self.nparticles)], dtype=float).reshape(
+                 self.nparticles, len(self.chiparams))
+        self.gbestpos = None
+        if self.gbestx is not None:
+            self.gbestpos = np.array(
+                [self.gbestx[ichi].values[self.gbestid]
+                 for ichi in range(len(self.chiparams))], dtype=float)
+        del self.pbestx
+        del self.gbestx
 
     # Create the genetic algorithm for everything
+    # The population is the (particle, chiparam) position array, the elites
+    # are rows of elitepos and lastpos holds the generation that was bred from
     def CreateGeneticAlgorithm(self):
         self.nparticles = self.opts.n
         # Maintain the top 5 elite genetic sequences
         self.nelite = 5
-        self.pelite = [np.float(-100) for i in range(self.nelite)]
-        self.peliteid = [np.int(i) for i in range(self.nelite)]
-        self.pelitex = [deepcopy(self.chiparams) for i in range(self.nelite)]
-        self.plastx = [deepcopy(self.chiparams)
-                       for i in range(self.nparticles)]
+        self.pelite = np.full(self.nelite, -100.0)
+        self.peliteid = np.arange(self.nelite)
+        self.elitepos = self.SwarmPositions()[self.peliteid % self.nparticles]
+        self.lastpos = self.SwarmPositions()
+        self.lastfit = np.full(self.nparticles, -np.inf)
         self.pelite_better = [' ' for i in range(self.nelite)]
+        self.pgen = None
         # Maintain the current fitness of the different phenotypes
-        self.fitness = [np.float(-100) for i in range(self.nparticles)]
-        self.parents = [[-1, -1] for i in range(self.nparticles)]
+        self.fitness = [-100.0 for i in range(self.nparticles)]
+        self.parents = np.full((self.nparticles, 2), -1)
+
+    def UpgradeGenetics(self):
+        # Populations pickled before the arrays kept a copy of every chiparam
+        # for each elite and each particle
+        if hasattr(self, 'elitepos'):
+            return
+        self.pelite = np.array(self.pelite, dtype=float)
+        self.peliteid = np.array(self.peliteid, dtype=int)
+        self.elitepos = np.array(
+            [[self.pelitex[k][ichi].values[self.peliteid[k]]
+              for ichi in range(len(self.chiparams))]
+             for k in range(self.nelite)], dtype=float).reshape(
+                 self.nelite, len(self.chiparams))
+        self.lastpos = self.SwarmPositions()
+        self.parents = np.array(self.parents, dtype=int).reshape(
+            self.nparticles, 2)
+        del self.pelitex
+        del self.plastx
+
+    # Bayesian optimization keeps every evaluated position and its fitness,
+    # the surrogate is fit to them (see ChiBayesOpt)
+    def CreateBayesOpt(self):
+        self.nparticles = self.opts.n
+        self.fitness = [-100.0 for i in range(self.nparticles)]
+        self.evalpos = np.zeros((0, len(self.chiparams)))
+        self.evalfit = np.zeros(0)
+
+    def UpdateEvaluated(self):
+        # Add the particles with a fitness to the evaluated points. Failed
+        # analyses (fitness -100) would only mislead the surrogate.
+        fitness = np.array(self.fitness, dtype=float)
+        ok = np.isfinite(fitness) & (fitness > -100.0)
+        self.evalpos = np.concatenate([self.evalpos, self.SwarmPositions()[ok]])
+        self.evalfit = np.concatenate([self.evalfit, fitness[ok]])
+        return int(ok.sum())
 
     def CreateParticleSwarmDatabase(self, sim_dir, gen):
         # Create a database of the parameters, write them out to start with
@@ -279,11 +520,13 @@ class ChiSim(object):
             stream.write("{}\n".format(param_str))
 
     # Update the fitness of myself for all the subsims
-    def UpdateFitness(self, sim_dir, dotest=False):
+    def UpdateFitness(self, sim_dir, dotest=False, jobs=None, indices=None):
         print(" -- Simulations Checking and Updating Fitness -- ")
+        if indices is None:
+            indices = list(range(self.nparticles))
         if dotest:
             print(" WARNING ERROR Using fake fitness function!!!!!")
-            for idx in range(self.nparticles):
+            for idx in indices:
                 x = self.chiparams[0].values[idx]
                 sx = self.chiparams[1].values[idx]
                 y = self.chiparams[2].values[idx]
@@ -304,20 +547,27 @@ class ChiSim(object):
                                                                                                                                                                                      0.1) + self.FakeGaussianSignal(sz,
                                                                                                                                                                                                                     0.0,
                                                                                                                                                                                                                     0.1)
-            return
+            return []
+        return self.EvaluateFitness(self.SimPaths(sim_dir, indices), jobs)
 
-        # Look for the fitness file in the data directory for each particle
-        for idx in range(self.nparticles):
+    def SimHash(self, idx):
+        # Hashed sim directory name of particle idx (see MakeSimDirectoryDatabase)
+        sim_name = ''
+        for ichi in range(len(self.chiparams)):
+            p = self.chiparams[ichi]
+            sim_name += p.format(p[idx]) + "_"
+
+        sim_name = sim_name[:-1]
+        return hashlib.md5(sim_name.encode()).hexdigest()
+
+    def SimPaths(self, sim_dir, indices):
+        # Look for the sim directory of each particle in sim_dir
+        sim_paths = {}
+        db_data = None
+        for idx in indices:
             print("Sim {} looking for fitness.yaml".format(idx))
             # Rebuild the name of the sim
-            sim_name = ''
-            for ichi in range(len(self.chiparams)):
-                p = self.chiparams[ichi]
-                sim_name += p.format(p[idx]) + "_"
-
-            sim_name = sim_name[:-1]
-            hash_object = hashlib.md5(sim_name.encode())
-            sim_full_path = os.path.join(sim_dir, hash_object.hexdigest())
+            sim_full_path = os.path.join(sim_dir, self.SimHash(idx))
 
             # Check to see if this path exists
             if not os.path.exists(sim_full_path):
@@ -325,325 +575,264 @@ class ChiSim(object):
                     "Checking the database file for the correct hash, as something went wrong during the regeneration")
                 # See if we can reconstruct the name of the simulation from the gen database file
                 # Exploit pandas for this purpose
-                db_data = pd.read_csv(
-                    os.path.join(
-                        sim_dir,
-                        "{}_database.txt".format(
-                            os.path.basename(sim_dir))),
-                    header=None,
-                    delim_whitespace=True)
+                if db_data is None:
+                    db_data = pd.read_csv(
+                        os.path.join(
+                            sim_dir,
+                            "{}_database.txt".format(
+                                os.path.basename(sim_dir))),
+                        header=None,
+                        delim_whitespace=True)
 
                 # Get the last column and position of idx in the dataframe...
                 hexdigest = db_data.iloc[idx, -1]
 
                 sim_full_path = os.path.join(sim_dir, hexdigest)
-
-            # Generate the sim fitness data!
-            status = call(['SpindleAnalysis', '--sim',
-                           '-R', '-F', '-d', sim_full_path])
-
-            # Check that the data directory and fitness file exist...
-            data_file_path = os.path.join(
-                sim_full_path, 'data', 'fitness_final.yaml')
-            with open(data_file_path, 'r') as stream:
-                fitness_yaml = yaml.load(stream)
-                # Compile fitness information
-                #em_fitness = 0.0
-                #length_correlation_avg = 0.0
-                #fbiorientation = 0.0
-                #kinetochore_fitness = 0.0
-
-                # Get the EM and length correlation fitness information
-                #em_fitness = (fitness_yaml['short'] + fitness_yaml['med'] + fitness_yaml['long'])/3.
-                #length_correlation_avg = fitness_yaml['length_correlation_avg']
-
-                # Get the chromosome fitness information, base it off chromosome seconds fraction key
-                # if 'chromosome_seconds_fraction' in fitness_yaml:
-                #    fbiorientation = fitness_yaml['fbiorientation']
-                #    kinetochore_fitness = np.mean([fitness_yaml['chromosome_kc_spb_distance'], fitness_yaml['chromosome_kc_spindle1d']])
-
-                # Combine total fitness in our special way
-                #total_fitness = em_fitness + 2.0*length_correlation_avg + 2.0*fbiorientation + kinetochore_fitness
-                #self.fitness[idx] = total_fitness
-
-                # Get what SpindleAnalysis thinks is the total fitness
-                total_fitness = fitness_yaml['FINAL_FITNESS']
-                self.fitness[idx] = total_fitness
+            sim_paths[idx] = sim_full_path
+        return sim_paths
+
+    def EvaluateFitness(self, sim_paths, jobs=None):
+        """ Runs the fitness analysis of the sims in sim_paths (particle
+            index to sim directory) and sets the particles' fitness. Returns
+            the (index, reason) of the analyses that failed.
+        """
+        indices = sorted(sim_paths)
+        # Generate the sim fitness data! Each analysis is its own process, so
+        # a bounded thread pool that waits on them is all the parallelism
+        # needed. A failed analysis only costs its own particle.
+        if not jobs:
+            jobs = os.cpu_count() or 1
+        jobs = max(1, min(jobs, len(indices)))
+        failed = []
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            futures = dict([(executor.submit(run_fitness_analysis, sim_paths[idx]), idx)
+                            for idx in indices])
+            for future in as_completed(futures):
+                idx = futures[future]
+                total_fitness, error = future.result()
+                if error:
+                    self.fitness[idx] = -100.0
+                    failed.append((idx, error))
+                else:
+                    self.fitness[idx] = total_fitness
+                print("Sim {0} fitness {1}".format(idx, self.fitness[idx]))
+        if failed:
+            print(" -- {} analyses failed, their particles get fitness -100.0 -- ".format(len(failed)))
+            for idx, error in sorted(failed):
+                print("   Sim {0} ({1}): {2}".format(idx, sim_paths[idx], error))
+        return failed
 
     # Update the best position of the swarm variables
-    def UpdateBest(self):
-        pcurr = [np.float(-100.0) for i in range(self.nparticles)]
+    # (of all particles, or only of those in indices in steady state mode)
+    def UpdateBest(self, indices=None):
+        self.UpgradeSwarm()
+        rows = self.Rows(indices)
+        pcurr = np.array(self.fitness, dtype=float)[rows]
+        positions = self.SwarmPositions()[rows]
+        # NaN (not yet evaluated) never compares better
+        better = pcurr > self.pbest[rows]
+        self.pbest[rows[better]] = pcurr[better]
+        self.pbestpos[rows[better]] = positions[better]
+        self.pbestid[rows[better]] = rows[better]
         self.pbest_better = [' ' for i in range(self.nparticles)]
+        for idx in rows[better]:
+            self.pbest_better[idx] = '*'
         self.gbest_better = ' '
-        for i in range(self.nparticles):
-            pcurr[i] = self.fitness[i]
-            if pcurr[i] > self.pbest[i]:
-                self.pbest[i] = pcurr[i]
-                self.pbestx[i] = deepcopy(self.chiparams)
-                self.pbestid[i] = np.int(i)
-                self.pbest_better[i] = '*'
+        if better.any():
+            # First particle with the highest fitness, like a scan would find
+            i = int(np.argmax(np.where(better, pcurr, -np.inf)))
             if pcurr[i] > self.gbest:
-                self.gbest = pcurr[i]
-                self.gbestx = deepcopy(self.chiparams)
-                self.gbestid = np.int(i)
+                self.gbest = float(pcurr[i])
+                self.gbestpos = positions[i].copy()
+                self.gbestid = int(rows[i])
                 self.gbest_better = '*'
 
     # Update the current elites for the genetic algorithm
-    def UpdateBestGenetics(self):
-        self.pelite_better = [' ' for i in range(self.nelite)]
-        for i in range(self.nparticles):
-            # Test each fitness of the 'best' particles, and figure out which
-            # one is best
-            lowest_fitness = np.argmin(self.pelite)
-            self.plastx[i] = deepcopy(self.chiparams)
-            if self.pelite[lowest_fitness] < self.fitness[i]:
-                self.pelite[lowest_fitness] = self.fitness[i]
-                self.pelitex[lowest_fitness] = deepcopy(self.chiparams)
-                self.peliteid[lowest_fitness] = np.int(i)
-                self.pelite_better[lowest_fitness] = '*'
+    # (of all particles, or only of those in indices in steady state mode)
+    def UpdateBestGenetics(self, indices=None):
+        self.UpgradeGenetics()
+        rows = self.Rows(indices)
+        fitness = np.array(self.fitness, dtype=float)[rows]
+        fitness[np.isnan(fitness)] = -np.inf
+        # The population breeding draws from: the last evaluated position and
+        # fitness of every particle
+        if getattr(self, 'lastfit', None) is None:
+            self.lastfit = np.full(self.nparticles, -np.inf)
+        self.lastpos[rows] = self.SwarmPositions()[rows]
+        self.lastfit[rows] = fitness
+        # The best nelite of the elites and the particles, the current elites
+        # win ties. Elites that stay keep their slot, new ones fill the slots
+        # that were freed
+        allfit = np.concatenate([self.pelite, fitness])
+        best = np.argsort(-allfit, kind='stable')[:self.nelite]
+        newcomers = rows[best[best >= self.nelite] - self.nelite]
+        freed = np.setdiff1d(np.arange(self.nelite), best)
+        self.pelite[freed] = self.lastfit[newcomers]
+        self.elitepos[freed] = self.lastpos[newcomers]
+        self.peliteid[freed] = newcomers
+        self.pelite_better = ['*' if k in freed else ' '
+                              for k in range(self.nelite)]
 
     # Update the positions and velocities of the particles in the sytem
-    def UpdatePositions(self):
-        for idx in range(self.nparticles):
-            c1 = 2 * random.random()
-            c2 = 2 * random.random()
-            for ichi in range(len(self.chiparams)):
-                oldval = self.chiparams[ichi].values[idx]
-                upperb = self.chiparams[ichi].bounds[1]
-                lowerb = self.chiparams[ichi].bounds[0]
-                vmax = (upperb - lowerb) / 2.0
-                pbestval = self.pbestx[idx][ichi].values[self.pbestid[idx]]
-                gbestval = self.gbestx[ichi].values[self.gbestid]
-                #print "oldval: {}".format(oldval)
-                #print "vmax:   {}".format(vmax)
-                #print "pbestval: {}".format(pbestval)
-                #print "gbestval: {}".format(gbestval)
-                # Update velocity
-                newvel = self.velocity[idx][ichi] * 0.6 + \
-                    c1 * (pbestval - oldval) + \
-                    c2 * (gbestval - oldval)
-                #print "newvel: {}".format(newvel)
-                if newvel > vmax:
-                    newvel = vmax
-                elif newvel < -vmax:
-                    newvel = -vmax
-
-                newpos = oldval + newvel
-                if newpos > upperb:
-                    newpos = 2 * upperb - newpos
-                    newvel = -newvel
-                if newpos < lowerb:
-                    newpos = 2 * lowerb - newpos
-                    newvel = -newvel
-
-                # Set the new variables
-                self.velocity[idx][ichi] = newvel
-                self.chiparams[ichi].values[idx] = self.chiparams[ichi].paramtype(
-                    newpos)
+    def UpdatePositions(self, indices=None):
+        self.UpgradeSwarm()
+        rows = self.Rows(indices)
+        # Random weights of each particle, drawn in the same order as the
+        # particles so a seeded run reproduces
+        c = np.array([2 * random.random() for i in range(2 * len(rows))])
+        c1 = c[0::2, np.newaxis]
+        c2 = c[1::2, np.newaxis]
+        oldpos = self.SwarmPositions()[rows]
+        lowerb, upperb = self.SwarmBounds()
+        vmax = (upperb - lowerb) / 2.0
+        # Without a global best yet (every fitness failed) only the personal
+        # bests pull
+        gbestpos = self.gbestpos if self.gbestpos is not None else self.pbestpos[rows]
+        # Update velocity
+        newvel = self.velocity[rows] * 0.6 + \
+            c1 * (self.pbestpos[rows] - oldpos) + \
+            c2 * (gbestpos - oldpos)
+        # Same order as the scalar test, bounds given high to low make vmax
+        # negative and np.clip would disagree
+        newvel = np.where(newvel > vmax, vmax,
+                          np.where(newvel < -vmax, -vmax, newvel))
+
+        # Reflect off the bounds
+        newpos = oldpos + newvel
+        over = newpos > upperb
+        newpos = np.where(over, 2 * upperb - newpos, newpos)
+        newvel = np.where(over, -newvel, newvel)
+        under = newpos < lowerb
+        newpos = np.where(under, 2 * lowerb - newpos, newpos)
+        newvel = np.where(under, -newvel, newvel)
+
+        # Set the new variables
+        self.velocity[rows] = newvel
+        self.SetSwarmPositions(newpos, rows)
+        for idx in rows:
             self.fitness[idx] = float('nan')
 
     # Update genetics based on tournament selection
-    def UpdateGeneticsTournament(self):
+    def UpdateGeneticsTournament(self, indices=None):
         self.crossover_rate = 0.5
         self.mutation_rate = 0.1
-        self.ntournament = 5
-
-        for ichild in range(self.nparticles / 2):
-            cidx1 = 2 * ichild
-            cidx2 = 2 * ichild + 1
-
-            tournament = np.random.choice(
-                self.nparticles, self.ntournament, replace=False)
-
-            # Take the 2 best from tournament
-            pbest1 = -1000000.0
-            pbest2 = -1000000.0
-            parent1_idx = -1
-            parent2_idx = -1
-            for idx in tournament:
-                if self.fitness[idx] > pbest1:
-                    pbest1 = self.fitness[idx]
-                    parent1_idx = idx
-
-            for idx in tournament:
-                if idx == parent1_idx:
-                    continue
-                if self.fitness[idx] > pbest2:
-                    pbest2 = self.fitness[idx]
-                    parent2_idx = idx
-
-            # Now that we have the two genetics in hand, let us use the crossover points and determine the new genome for the resulting children
-            # Iterate along the genome of the chromosomes and pick when we
-            # either do a crossover, or a mutation
-            for ichi in range(len(self.chiparams)):
-                # Crossover using random chance of inheriting from parent 1 or
-                # 2
-                self.parents[cidx1] = [parent1_idx, parent2_idx]
-                self.parents[cidx2] = [parent1_idx, parent2_idx]
-                rand = random.uniform(0.0, 1.0)
-                if (rand <= self.crossover_rate):
-                    self.chiparams[ichi].values[cidx1] = self.plastx[parent1_idx][ichi].paramtype(
-                        self.plastx[parent1_idx][ichi].values[parent1_idx])
-                    self.chiparams[ichi].values[cidx2] = self.plastx[parent2_idx][ichi].paramtype(
-                        self.plastx[parent2_idx][ichi].values[parent2_idx])
-                else:
-                    self.chiparams[ichi].values[cidx2] = self.plastx[parent1_idx][ichi].paramtype(
-                        self.plastx[parent1_idx][ichi].values[parent1_idx])
-                    self.chiparams[ichi].values[cidx1] = self.plastx[parent2_idx][ichi].paramtype(
-                        self.plastx[parent2_idx][ichi].values[parent2_idx])
-
-                # Now check the mutation rate
-                rand_mut1 = random.uniform(0.0, 1.0)
-                if rand_mut1 <= self.mutation_rate:
-                    newval = random.uniform(
-                        self.chiparams[ichi].bounds[0],
-                        self.chiparams[ichi].bounds[1])
-                    self.chiparams[ichi].values[cidx1] = self.chiparams[ichi].paramtype(
-                        newval)
-                rand_mut2 = random.uniform(0.0, 1.0)
-                if rand_mut2 <= self.mutation_rate:
-                    newval = random.uniform(
-                        self.chiparams[ichi].bounds[0],
-                        self.chiparams[ichi].bounds[1])
-                    self.chiparams[ichi].values[cidx2] = self.chiparams[ichi].paramtype(
-                        newval)
-
-        for i in range(self.nparticles):
-            self.fitness[i] = float('nan')
+        self.ntournament = min(5, self.nparticles)
+        rows = self.ChildRows(indices)
+        npairs = (len(rows) + 1) // 2
+
+        # One tournament of distinct particles per pair of children, redraw
+        # the rare ones that picked a particle twice
+        tournament = np.random.randint(self.nparticles,
+                                       size=(npairs, self.ntournament))
+        while True:
+            srt = np.sort(tournament, axis=1)
+            dup = (srt[:, 1:] == srt[:, :-1]).any(axis=1)
+            if not dup.any():
+                break
+            tournament[dup] = np.random.randint(
+                self.nparticles, size=(dup.sum(), self.ntournament))
+
+        # Take the 2 best from each tournament
+        tfit = self.lastfit[tournament]
+        pairs = np.arange(npairs)
+        first = np.argmax(tfit, axis=1)
+        parent1_idx = tournament[pairs, first]
+        tfit[pairs, first] = -np.inf
+        parent2_idx = tournament[pairs, np.argmax(tfit, axis=1)]
+
+        self.Breed(parent1_idx, parent2_idx, rows)
+        if indices is None:
+            # The carried over particle is evaluated again with the others
+            self.fitness = [float('nan') for i in range(self.nparticles)]
 
     # Update the genetics information for the swarm!
-
-    def UpdateGeneticsRoulette(self):
+    def UpdateGeneticsRoulette(self, indices=None):
         self.min_genetics = 0.0
 
         self.crossover_rate = 0.5
         self.mutation_rate = 0.1
-        # Load the current fitness/genetics into a roulette wheel selection@
-        # Generate the two parents together, making sure that they are not the
-        # same parent (inbreeding is bad)
-        for ichild in range(self.nparticles / 2):
-            cidx1 = 2 * ichild
-            cidx2 = 2 * ichild + 1
-
-            # go through and move all the fitness to be above 0 (subtract off
-            # min)
-            self.weight_sum1 = 0.0
-            for i in range(self.nparticles):
-                self.weight_sum1 += self.fitness[i] - self.min_genetics
-
-            # Roulette wheel selection of the available parameters
-            value1 = random.uniform(0.0, 1.0) * self.weight_sum1
-            parent1_idx = -1
-            #cur_value1 = self.min_fitness
-            for i in range(self.nparticles):
-                value1 -= (self.fitness[i] - self.min_genetics)
-                if value1 <= 0.0:
-                    parent1_idx = i
-                    break
-
-            # print "Choose parent1 idx {} ({})".format(parent1_idx, self.fitness[parent1_idx] - self.min_genetics)
-            i
-
-            # Roulette wheel of the resulting set for the next parent!
-            self.weight_sum2 = 0.0
-            for i in range(self.nparticles):
-                if i == parent1_idx:
-                    continue
-                self.weight_sum2 += self.fitness[i] - self.min_genetics
-
-            # Roulette wheel selection of the available parameters
-            value2 = random.uniform(0.0, 1.0) * self.weight_sum2
-            parent2_idx = -1
-            for i in range(self.nparticles):
-                if i == parent1_idx:
-                    continue
-                value2 -= (self.fitness[i] - self.min_genetics)
-                if value2 <= 0.0:
-                    parent2_idx = i
-                    break
-
-            #print "Choose parent2 idx {} ({})".format(parent2_idx, self.fitness[parent2_idx] - self.min_genetics)
-
-            # Two point crossover
-            # Two point crossover
-            #self.parents[cidx1] = [parent1_idx, parent2_idx]
-            #self.parents[cidx2] = [parent1_idx, parent2_idx]
-            #cp1 = int(random.uniform(0, len(self.chiparams)))
-            #cp2 = int(random.uniform(0, len(self.chiparams)))
-            # if cp2 < cp1:
-            #    temp = cp1
-            #    cp1 = cp2
-            #    cp2 = temp
-            # if cp1 == cp2:
-            #    cp2 = cp1 + 1
-
-            # for ichi in xrange(len(self.chiparams)):
-            #    # Parent 1 for 1
-            #    if ichi <= cp1:
-            #        self.chiparams[ichi].values[cidx1] = self.plastx[parent1_idx][ichi].paramtype(self.plastx[parent1_idx][ichi].values[parent1_idx])
-            #        self.chiparams[ichi].values[cidx2] = self.plastx[parent2_idx][ichi].paramtype(self.plastx[parent2_idx][ichi].values[parent2_idx])
-            #    elif ichi <= cp2 and ichi > cp1:
-            #        self.chiparams[ichi].values[cidx2] = self.plastx[parent1_idx][ichi].paramtype(self.plastx[parent1_idx][ichi].values[parent1_idx])
-            #        self.chiparams[ichi].values[cidx1] = self.plastx[parent2_idx][ichi].paramtype(self.plastx[parent2_idx][ichi].values[parent2_idx])
-            #    else:
-            #        self.chiparams[ichi].values[cidx1] = self.plastx[parent1_idx][ichi].paramtype(self.plastx[parent1_idx][ichi].values[parent1_idx])
-            #        self.chiparams[ichi].values[cidx2] = self.plastx[parent2_idx][ichi].paramtype(self.plastx[parent2_idx][ichi].values[parent2_idx])
-            #    #Now check the mutation rate
-            #    rand_mut1 = random.uniform(0.0, 1.0)
-            #    if rand_mut1 <= self.mutation_rate:
-            #        newval = random.uniform(self.chiparams[ichi].bounds[0], self.chiparams[ichi].bounds[1])
-            #        self.chiparams[ichi].values[cidx1] = self.chiparams[ichi].paramtype(newval)
-            #    rand_mut2 = random.uniform(0.0, 1.0)
-            #    if rand_mut2 <= self.mutation_rate:
-            #        newval = random.uniform(self.chiparams[ichi].bounds[0], self.chiparams[ichi].bounds[1])
-            #        self.chiparams[ichi].values[cidx2] = self.chiparams[ichi].paramtype(newval)
-
-            # Now that we have the two genetics in hand, let us use the crossover points and determine the new genome for the resulting children
-            # Iterate along the genome of the chromosomes and pick when we
-            # either do a crossover, or a mutation
-            for ichi in range(len(self.chiparams)):
-                # Crossover using random chance of inheriting from parent 1 or 2
-                # This crossover computation is a random choice of each
-                # parent...
-                self.parents[cidx1] = [parent1_idx, parent2_idx]
-                self.parents[cidx2] = [parent1_idx, parent2_idx]
-                rand = random.uniform(0.0, 1.0)
-                if (rand <= self.crossover_rate):
-                    self.chiparams[ichi].values[cidx1] = self.plastx[parent1_idx][ichi].paramtype(
-                        self.plastx[parent1_idx][ichi].values[parent1_idx])
-                    self.chiparams[ichi].values[cidx2] = self.plastx[parent2_idx][ichi].paramtype(
-                        self.plastx[parent2_idx][ichi].values[parent2_idx])
-                else:
-                    self.chiparams[ichi].values[cidx2] = self.plastx[parent1_idx][ichi].paramtype(
-                        self.plastx[parent1_idx][ichi].values[parent1_idx])
-                    self.chiparams[ichi].values[cidx1] = self.plastx[parent2_idx][ichi].paramtype(
-                        self.plastx[parent2_idx][ichi].values[parent2_idx])
-
-                # Now check the mutation rate
-                rand_mut1 = random.uniform(0.0, 1.0)
-                if rand_mut1 <= self.mutation_rate:
-                    newval = random.uniform(
-                        self.chiparams[ichi].bounds[0],
-                        self.chiparams[ichi].bounds[1])
-                    self.chiparams[ichi].values[cidx1] = self.chiparams[ichi].paramtype(
-                        newval)
-                rand_mut2 = random.uniform(0.0, 1.0)
-                if rand_mut2 <= self.mutation_rate:
-                    newval = random.uniform(
-                        self.chiparams[ichi].bounds[0],
-                        self.chiparams[ichi].bounds[1])
-                    self.chiparams[ichi].values[cidx2] = self.chiparams[ichi].paramtype(
-                        newval)
-
-        for i in range(self.nparticles):
-            self.fitness[i] = float('nan')
+        rows = self.ChildRows(indices)
+        npairs = (len(rows) + 1) // 2
+        # Load the current fitness/genetics into a roulette wheel selection,
+        # moving all the fitness to be above 0 (subtract off min). Particles
+        # not evaluated yet get no slice, and neither do failed analyses
+        # (-100.0) below min_genetics, which would put the wheel out of order.
+        weight = np.maximum(np.where(np.isfinite(self.lastfit), self.lastfit,
+                                     self.min_genetics) - self.min_genetics, 0.0)
+        wheel = np.cumsum(weight)
+        last = self.nparticles - 1
+
+        # Roulette wheel selection of the first parent
+        value1 = np.random.uniform(0.0, 1.0, npairs) * wheel[-1]
+        parent1_idx = np.minimum(np.searchsorted(wheel, value1), last)
+
+        # Generate the second parent on the wheel without the first one
+        # (inbreeding is bad): below the first parent's slice the wheel is
+        # unchanged, above it every edge moves up by the first parent's weight
+        value2 = np.random.uniform(0.0, 1.0, npairs) * \
+            (wheel[-1] - weight[parent1_idx])
+        before = wheel[parent1_idx] - weight[parent1_idx]
+        value2 = np.where(value2 <= before, value2,
+                          value2 + weight[parent1_idx])
+        parent2_idx = np.minimum(np.searchsorted(wheel, value2), last)
+        # Only reachable through rounding at the end of the wheel
+        same = parent2_idx == parent1_idx
+        parent2_idx[same] = np.where(parent1_idx[same] == last,
+                                     last - 1, parent1_idx[same] + 1)
+
+        self.Breed(parent1_idx, parent2_idx, rows)
+        if indices is None:
+            # The carried over particle is evaluated again with the others
+            self.fitness = [float('nan') for i in range(self.nparticles)]
+
+    def ChildRows(self, indices=None):
+        # Particles replaced by children. Generational: pairs from the start,
+        # with an odd population the last particle carries over.
+        if indices is None:
+            return np.arange(2 * (self.nparticles // 2))
+        return np.asarray(indices, dtype=int)
+
+    def Breed(self, parent1_idx, parent2_idx, rows):
+        """ Children rows[2i] and rows[2i+1] of parents parent1_idx[i] and
+            parent2_idx[i] (rows of lastpos) inherit each gene from either
+            parent, then every gene of a child mutates to a uniform draw
+            within the bounds with the mutation rate.
+        """
+        npairs = len(parent1_idx)
+        nchi = len(self.chiparams)
+        lowerb, upperb = self.SwarmBounds()
+        pos1 = self.lastpos[parent1_idx]
+        pos2 = self.lastpos[parent2_idx]
+
+        # Crossover using random chance of inheriting from parent 1 or 2
+        cross = np.random.uniform(0.0, 1.0, (npairs, nchi)) <= self.crossover_rate
+        child1 = np.where(cross, pos1, pos2)
+        child2 = np.where(cross, pos2, pos1)
+
+        # Now check the mutation rate
+        for child in (child1, child2):
+            mutate = np.random.uniform(0.0, 1.0, (npairs, nchi)) <= self.mutation_rate
+            newval = lowerb + (upperb - lowerb) * \
+                np.random.uniform(0.0, 1.0, (npairs, nchi))
+            child[mutate] = newval[mutate]
+
+        # An odd number of rows leaves the last second child unused
+        rows1 = rows[0::2]
+        rows2 = rows[1::2]
+        parents = np.column_stack([parent1_idx, parent2_idx])
+        self.parents[rows1] = parents
+        self.parents[rows2] = parents[:len(rows2)]
+        self.SetSwarmPositions(child1, rows1)
+        self.SetSwarmPositions(child2[:len(rows2)], rows2)
+        for idx in rows:
+            self.fitness[idx] = float('nan')
 
     # Bias the swarm variables at random
     def BiasSwarm(self, bias):
         # Do via the dataframe that we received
         for idx, row in bias.iterrows():
             # Get the particle id
-            pid = np.int(row[0])
+            pid = int(row[0])
             # Loop over the chiparams and set them, note, this has to index by 1 further because of
             # the particle taking up a spot in the dataframe
             for ichi in range(len(self.chiparams)):
@@ -653,7 +842,7 @@ class ChiSim(object):
     def PrintSwarmCurrent(self):
         str0 = "id  fitness "
         for ichi in range(len(self.chiparams)):
-            str0 += "{:>12s}{:>12s}".format(self.chiparams[ichi], "vel")
+            str0 += "{:>12s}{:>12s}".format(str(self.chiparams[ichi]), "vel")
         print(str0)
         for idx in range(self.nparticles):
             str1 = "{0:<3d}  {1:>6.3f} ".format(idx, self.fitness[idx])
@@ -663,32 +852,32 @@ class ChiSim(object):
             print(str1)
 
     def PrintSwarmBest(self):
+        self.UpgradeSwarm()
         str0 = "id  bestfit  "
         for ichi in range(len(self.chiparams)):
-            str0 += "{:>10s}    ".format(self.chiparams[ichi])
+            str0 += "{:>10s}    ".format(str(self.chiparams[ichi]))
         print(str0)
         for idx in range(self.nparticles):
             str1 = "{0:<3d}  {1:>6.3f} ".format(idx, self.pbest[idx])
             for ichi in range(len(self.chiparams)):
-                str1 += " {0:10.3f}   ".format(
-                    self.pbestx[idx][ichi].values[self.pbestid[idx]])
+                str1 += " {0:10.3f}   ".format(self.pbestpos[idx][ichi])
             str1 += " {} ".format(self.pbest_better[idx])
             print(str1)
 
         str2 = "{0:<3s}  {1:>6.3f} ".format("g", self.gbest)
         for ichi in range(len(self.chiparams)):
-            str2 += " {0:10.3f}   ".format(
-                self.gbestx[ichi].values[self.gbestid])
+            str2 += " {0:10.3f}   ".format(self.gbestpos[ichi])
         str2 += " {} ".format(self.gbest_better)
         print(str2)
 
         #str3 = "{} {} ".format("gfull", self.gbest)
         # for ichi in xrange(len(self.chiparams)):
-        #    str3 += " {} ".format(self.gbestx[ichi].values[self.gbestid])
+        #    str3 += " {} ".format(self.gbestpos[ichi])
         #print str3
 
     # Genetic algorithm print information
     def PrintCurrentGenetics(self):
+        self.UpgradeGenetics()
         str0 = "id  fitness "
         for idx in range(self.nparticles):
             str1 = "{0:<3d}  {1:>6.3f} ".format(idx, self.fitness[idx])
@@ -699,18 +888,64 @@ class ChiSim(object):
             print(str1)
 
     def PrintGeneticsBest(self):
+        self.UpgradeGenetics()
         str0 = "id  bestfit  "
         for ichi in range(len(self.chiparams)):
-            str0 += "{:>10s}    ".format(self.chiparams[ichi])
+            str0 += "{:>10s}    ".format(str(self.chiparams[ichi]))
         print(str0)
         for idx in range(self.nelite):
             str1 = "{0:<3d}  {1:>6.3f} ".format(idx, self.pelite[idx])
             for ichi in range(len(self.chiparams)):
-                str1 += " {0:10.3f}   ".format(
-                    self.pelitex[idx][ichi].values[self.peliteid[idx]])
+                str1 += " {0:10.3f}   ".format(self.elitepos[idx][ichi])
             str1 += " {} ".format(self.pelite_better[idx])
             print(str1)
 
+# Per process state of the sim creation pool (see MakeSimDirectoriesParallel)
+sim_worker = {}
+
+
+def InitSimWorker(seeds, yml_templates, opts):
+    sim_worker['seeds'] = seeds
+    sim_worker['yml_templates'] = yml_templates
+    sim_worker['opts'] = opts
+    sim_worker['linker'] = CreateLinker(opts)
+
+
+def MakeSimTree(assignment):
+    sim_dir, values = assignment
+    linker = sim_worker['linker']
+    written, avoided = linker.bytes_written, linker.bytes_avoided
+    os.mkdir(sim_dir)
+    sim_worker['seeds'].MakeSeedDirectories(sim_dir, None, sim_worker['opts'],
+                                            sim_worker['yml_templates'], values,
+                                            linker)
+    # Byte counts for this sim only, the parent adds them up
+    return (sim_dir, linker.bytes_written - written,
+            linker.bytes_avoided - avoided)
+
+def run_fitness_analysis(sim_full_path):
+    """ Runs SpindleAnalysis on one particle's sim and reads its fitness.
+        Returns (fitness, None), or (None, reason) when the analysis failed.
+    """
+    try:
+        status = call(['SpindleAnalysis', '--sim',
+                       '-R', '-F', '-d', sim_full_path])
+    except OSError as e:
+        return (None, "could not run SpindleAnalysis: {}".format(e))
+
+    # Check that the data directory and fitness file exist...
+    data_file_path = os.path.join(
+        sim_full_path, 'data', 'fitness_final.yaml')
+    if not os.path.isfile(data_file_path):
+        return (None, "SpindleAnalysis exited with {0}, no {1}".format(status, data_file_path))
+    try:
+        with open(data_file_path, 'r') as stream:
+            fitness_yaml = OrderedYamlLoad(stream)
+            # Get what SpindleAnalysis thinks is the total fitness
+            return (fitness_yaml['FINAL_FITNESS'], None)
+    except Exception as e:
+        return (None, "bad {0}: {1}".format(data_file_path, e))
+
 # Class to fill Sim directories with seed directories
 
 
@@ -722,17 +957,35 @@ class ChiSeed(ChiParam):
     def CreateSeedList(self):
         self.sd_names = ['s{}'.format(i) for i in self.values]
 
-    def MakeSeedDirectories(self, sim_dir, yml_file_dict, opts):
+    def MakeSeedDirectories(self, sim_dir, yml_file_dict, opts,
+                            yml_templates=None, values=[], linker=None):
+        if linker is None:
+            linker = CreateLinker(opts)
+        # Seed value goes in the last template slot. Files without it are the
+        # same for every seed of the sim and are only rendered once.
+        seed_slot = len(values)
+        shared = {}
+        if yml_templates:
+            for f, t in yml_templates.items():
+                if seed_slot not in t.slots:
+                    shared[f] = t.Render(values + [None])
         for sn, s in zip(self.sd_names, self.values):
             sd_dir = os.path.join(sim_dir, sn)
             os.mkdir(sd_dir)
-            self.obj_r.Set(s)
-            CreateYamlFilesFromDict(sd_dir, yml_file_dict)
+            if yml_templates:
+                for f, t in yml_templates.items():
+                    if f in shared:
+                        linker.PlaceText(shared[f], sd_dir, f)
+                    else:
+                        linker.WriteText(t.Render(values + [s]), sd_dir, f)
+            else:
+                self.obj_r.Set(s)
+                CreateYamlFilesFromDict(sd_dir, yml_file_dict)
             if opts.fluid_config:  # TODO depricate this for one below
-                cp(opts.fluid_config, sd_dir)
+                linker.Place(opts.fluid_config, sd_dir)
             for f in opts.non_yaml:
-                cp(f, sd_dir)
-            if opts.states:
+                linker.Place(f, sd_dir)
+            if opts.states and not getattr(opts, 'state_store', False):
                 for s in opts.states:
                     open(os.path.join(sd_dir, 'sim.{}'.format(s)), 'a')
 
@@ -7,10 +7,12 @@ import shutil
 import yaml
 import argparse
 import re
-import pickle
 ## Analysis
 from ChiCreate import ChiCreate
-from ChiParams import ChiParam, ChiSim
+from ChiParams import ChiParam, ChiSim, swarm_state
+from ChiCheckpoint import ChiCheckpoint
+from ChiSteady import steady_state
+from ChiHalving import setup_fidelity, start_rungs, last_rung, rung_indices, promote, finish_rungs
 from collections import OrderedDict
 from ChiLib import *
 import pandas as pd
@@ -27,27 +29,31 @@ class ChiParticleSwarm(ChiCreate):
         self.generation = generation
         ChiCreate.__init__(self, opts=opts, cwd=cwd)
 
-    ### Fun save/load hacks
+    ### Checkpoints (see ChiCheckpoint), the setup is written with generation 0
     def savestate(self, sim_dir):
-        filename = os.path.join(sim_dir, "sim_data_swarm_{}.pickle".format(self.generation))
-        self.save(filename)
-
-    def save(self, filename):
-        f = open(filename, 'wb')
-        pickle.dump(self.__dict__,f)
-        f.close()
-
-    def load(self, filename):
-        f = open(filename, 'rb')
-        tmp_dict = pickle.load(f)
-        f.close()
-
-        self.__dict__.update(tmp_dict)
+        static = dict(self.__dict__)
+        static['Sim'] = self.Sim.Static(swarm_state)
+        ChiCheckpoint(sim_dir, 'swarm').Save(self.generation, static,
+                                              self.Sim.GetState(swarm_state),
+                                              write_static=(self.generation == 0))
+
+    def loadstate(self, sim_dir):
+        # Load the latest generation, returns its number
+        cp = ChiCheckpoint(sim_dir, 'swarm')
+        generation = cp.Latest()
+        static, state = cp.Load(generation)
+        self.__dict__.update(static)
+        if state is not None:
+            self.Sim.SetState(swarm_state, state)
+        self.generation = generation
+        return generation
 
     # Create has to have an additional step from ChiCreate
     def Create(self, file_list):
         # Make master yaml dictionary
         self.MakeYmlDict(file_list)
+        # Fidelity key at the first rung budget for successive halving
+        setup_fidelity(self)
 
         # Get a list of all the ChiParam dictionsarys with key 
         # and value (ChiParam string) and put into a list
@@ -66,10 +72,12 @@ class ChiParticleSwarm(ChiCreate):
         # Make run directory
         if self.opts.replace and os.path.exists(sim_dir_name):
             shutil.rmtree(sim_dir)
+            prune_manifest(self.opts.workdir, sim_dir)
         if not os.path.exists(sim_dir_name):
             os.makedirs(sim_dir)
 
         # Always a shotgun type creation of directory struct
+        start_rungs(self)
         l = []
         for i in range(self.opts.n):
             l += [ [i]*len(self.ChiParams) ]
@@ -78,8 +86,14 @@ class ChiParticleSwarm(ChiCreate):
         # index/database to lookup later!
         # Loop through the sim stuff, it should handle writing out the hash to the database file
         print(" -- Making Particle Swarm Generation {} -- ".format(self.generation))
+        linker = CreateLinker(self.opts)
+        recorders = self.MakeRecorders()
         for il in l:
-            self.Sim.MakeSimDirectoryDatabase(sim_dir_name, self.generation, il)
+            self.Sim.MakeSimDirectoryDatabase(sim_dir_name, self.generation, il, linker,
+                                              recorders)
+        for r in recorders:
+            r.Close()
+        linker.Report()
 
         # Save myself off to the directory
         self.savestate("generations")
@@ -96,38 +110,33 @@ class ChiParticleSwarm(ChiCreate):
         sim_dir = os.path.join(self.opts.workdir, sim_dir_name)
         self.Sim.CreateParticleSwarmDatabase(sim_dir, self.generation)
 
-    def GenerateFitnessInformation(self, dotest=False):
+    def GenerateFitnessInformation(self, dotest=False, jobs=None):
         # We have to look up the fitness information based on the driectory names and correlate this
         # with the proper sim, otherwise, is useless
         sim_dir_name = "generations/gen{0}".format(self.generation)
         sim_dir = os.path.join(self.opts.workdir, sim_dir_name)
 
         # Always a shotgun type creation of directory struct
-        self.Sim.UpdateFitness(sim_dir, dotest)
+        self.Sim.UpdateFitness(sim_dir, dotest, jobs, rung_indices(self))
 
     # Procreate Functionality
-    def Procreate(self, dotest=False):
-        # Load self
-        generations = [dirname for dirname in os.listdir('generations') if dirname.startswith('gen')]
-        generationints = [int(list(filter(str.isdigit, str1))) for str1 in generations]
-        maxgen = max(generationints)
-
+    def Procreate(self, dotest=False, jobs=None):
         # Save off the information about the opts, path, etc
         cur_cwd = self.cwd
 
-        filename = os.path.join('generations', 'sim_data_swarm_{}.pickle'.format(maxgen))
-        self.load(filename)
-
-        # have to reset the generation and generationints
-        generations = [dirname for dirname in os.listdir('generations') if dirname.startswith('gen')]
-        generationints = [int(list(filter(str.isdigit, str1))) for str1 in generations]
-        self.maxgen = max(generationints)
+        # Load self from the latest checkpoint
+        self.maxgen = self.loadstate('generations')
         self.nextgen = self.maxgen + 1
         self.cwd = cur_cwd
 
         self.PrintSwarm()
         print(" -- Particle Swarm Procreating from max generation {}".format(self.maxgen))
-        self.GenerateFitnessInformation(dotest)
+        # With successive halving only the last rung makes a new generation
+        if not last_rung(self):
+            promote(self, dotest, jobs)
+            return
+        self.GenerateFitnessInformation(dotest, jobs)
+        finish_rungs(self)
         #self.Sim.UpdateFitness()
         print(" -- Input Parameters -- ")
         self.Sim.PrintSwarmCurrent()
@@ -143,19 +152,24 @@ class ChiParticleSwarm(ChiCreate):
         self.generation = self.nextgen
         self.MakeDirectoryStruct()
 
-    def Bias(self, opts):
-        # Load self like in procreate
-        generations = [dirname for dirname in os.listdir('generations') if dirname.startswith('gen')]
-        generationints = [int(list(filter(str.isdigit, str1))) for str1 in generations]
-        maxgen = max(generationints)
+    # Steady state functionality (see ChiSteady)
+    def SteadyState(self, opts):
+        cur_cwd = self.cwd
+        self.maxgen = self.loadstate('generations')
+        self.cwd = cur_cwd
 
-        filename = os.path.join('generations', 'sim_data_swarm_{}.pickle'.format(maxgen))
-        self.load(filename)
+        self.PrintSwarm()
+        print(" -- Particle Swarm steady state from generation {}".format(self.maxgen))
+        steady_state(self, self.UpdateSteady, opts, opts.test)
+
+    def UpdateSteady(self, indices):
+        # Update the bests with the finished particles and move only those
+        self.Sim.UpdateBest(indices)
+        self.Sim.UpdatePositions(indices)
 
-        # have to reset the generation and generationints
-        generations = [dirname for dirname in os.listdir('generations') if dirname.startswith('gen')]
-        generationints = [int(list(filter(str.isdigit, str1))) for str1 in generations]
-        self.maxgen = max(generationints)
+    def Bias(self, opts):
+        # Load self like in procreate
+        self.maxgen = self.loadstate('generations')
         self.nextgen = self.maxgen + 1
 
         # Print ourselves
@@ -188,7 +202,27 @@ def parse_args():
     parser.add_argument('-T', '--test', action='store_true',
             help='Test the particle swarm optimization')
 
+    parser.add_argument('-j', '--jobs', type=int,
+            help='Number of SpindleAnalysis fitness evaluations run at once when procreating (default: number of cpus)')
+
+    parser.add_argument('-S', '--steady', action='store_true',
+            help='Steady state mode: instead of a generation at a time, every particle whose sim has finished the -s states is given its fitness, updated and replaced by a new candidate right away. Runs until --max_evals fitness evaluations.')
+
+    parser.add_argument('-s', '--states', nargs='+', type=str,
+            help='States the candidates run, armed in every new candidate. (Used with --steady option only)')
+
+    parser.add_argument('--queue', type=str, metavar='FILE',
+            help='Work queue of ChiRun --worker pilots (see Chi.py --pilot) the new candidates are appended to. (Used with --steady option only)')
+
+    parser.add_argument('--poll', type=float, default=30.,
+            help='Seconds between looks for finished candidates (default: 30). (Used with --steady option only)')
+
+    parser.add_argument('--max_evals', type=int,
+            help='Stop after this many fitness evaluations (default: run until stopped). (Used with --steady option only)')
+
     opts = parser.parse_args()
+    if opts.steady and not opts.states:
+        parser.error('--steady needs the -s/--states the candidates run')
     return opts
 
 ### Main function to test stuff?
@@ -196,6 +230,8 @@ if __name__ == "__main__":
     opts = parse_args()
     c = ChiParticleSwarm(opts, os.getcwd(), 0)
     if opts.procreate:
-        c.Procreate(opts.test)
+        c.Procreate(opts.test, opts.jobs)
     elif opts.bias:
         c.Bias(opts)
+    elif opts.steady:
+        c.SteadyState(opts)
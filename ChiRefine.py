@@ -0,0 +1,321 @@
+#!/usr/bin/env python
+## Basic
+import sys
+import os
+import pdb
+import shutil
+import yaml
+import argparse
+import re
+## Analysis
+import numpy as np
+from ChiCreate import ChiCreate
+from ChiParams import ChiParam, ChiSim
+from ChiCheckpoint import ChiCheckpoint
+from collections import OrderedDict
+from ChiLib import *
+
+'''
+Name: ChiRefine.py
+Description: Adaptive refinement of a LinearSlice/LogSlice sweep. Starts from
+    the coarse grid of --create and after every round reads a scalar metric
+    of each sim. The grid intervals (two neighbouring points along one
+    parameter) over which the metric changes most are bisected, so new sims
+    only go where the response is not flat. Midpoints of LogSlice parameters
+    are geometric. All sims are made in simulations with the directory names
+    of a --create sweep.
+Input: Chi.py -ARC PARAM_FILES creates round 0, ChiRefine.py -R makes the next round
+'''
+
+# Arrays of the refinement that change every round, checkpointed per round
+# (see ChiCheckpoint). points are index vectors into the ChiParam values,
+# edges the (point, point, chiparam) intervals that can still be bisected.
+refine_state = ['points', 'edges', 'metric', 'pround']
+
+refinable_pat = re.compile(r'\s*(LinearSlice|LogSlice)\(')
+
+def midpoint(cparam, v1, v2):
+    # Middle of an interval of the ChiParam, geometric for a LogSlice
+    if refinable_pat.match(cparam.exec_str).group(1) == 'LogSlice':
+        return cparam.paramtype(np.sqrt(v1 * v2))
+    return cparam.paramtype(0.5 * (v1 + v2))
+
+def sim_metric(sim_dir, metric_file, key):
+    # Scalar metric of a sim, None when it is not there yet
+    path = os.path.join(sim_dir, metric_file)
+    if not os.path.isfile(path):
+        return None
+    try:
+        return float(CreateDictFromYamlFile(path)[key])
+    except Exception as e:
+        print("## Could not read {0} from {1}: {2}".format(key, path, e))
+        return None
+
+
+class ChiRefine(ChiCreate):
+    def __init__(self, opts, cwd, round):
+        self.round = round
+        ChiCreate.__init__(self, opts=opts, cwd=cwd)
+
+    ### Checkpoints (see ChiCheckpoint). Refinement adds ChiParam values so
+    ### the setup is written every round.
+    def savestate(self, sim_dir):
+        static = dict(self.__dict__)
+        for name in refine_state:
+            static.pop(name, None)
+        ChiCheckpoint(sim_dir, 'refine').Save(self.round, static,
+                                              dict([(name, getattr(self, name))
+                                                    for name in refine_state]),
+                                              write_static=True)
+
+    def loadstate(self, sim_dir):
+        # Load the latest round, returns its number
+        cp = ChiCheckpoint(sim_dir, 'refine')
+        round = cp.Latest()
+        static, state = cp.Load(round)
+        self.__dict__.update(static)
+        for name in refine_state:
+            setattr(self, name, state[name])
+        self.round = round
+        return round
+
+    # Create has to have an additional step from ChiCreate
+    def Create(self, file_list):
+        # Make master yaml dictionary
+        self.MakeYmlDict(file_list)
+
+        # Get a list of all the ChiParam dictionsarys with key
+        # and value (ChiParam string) and put into a list
+        a = list(find_str_values(self.yml_files_dict))
+
+        # Turn list of dictionaries in to ChiParam objects
+        self.MakeChiParams(a)
+        self.CreateRefinement()
+        self.MakeDirectoryStruct()
+
+    def CreateRefinement(self):
+        """ Coarse grid of all the ChiParam values. Every pair of neighbouring
+            grid points along a LinearSlice or LogSlice parameter is an
+            interval that can be bisected.
+        """
+        lst = [x.GetNValues() for x in self.ChiParams]
+        self.points = np.array(list(ind_product(lst)), dtype=int).reshape(-1, len(lst))
+        self.metric = np.full(len(self.points), np.nan)
+        self.pround = np.zeros(len(self.points), dtype=int)
+        rows = dict([(tuple(p), i) for i, p in enumerate(self.points)])
+        edges = []
+        for ichi, cparam in enumerate(self.ChiParams):
+            if not refinable_pat.match(cparam.exec_str):
+                continue
+            for i, p in enumerate(self.points):
+                if p[ichi] + 1 < lst[ichi]:
+                    q = p.copy()
+                    q[ichi] += 1
+                    edges += [[i, rows[tuple(q)], ichi]]
+        self.edges = np.array(edges, dtype=int).reshape(-1, 3)
+        print(" -- Refinement: {0} grid points, {1} intervals -- ".format(
+            len(self.points), len(self.edges)))
+
+    # Directory creation, makes the sims of the points of the current round
+    def MakeDirectoryStruct(self):
+        sim_dir_name = "simulations"
+        sim_dir = os.path.join(self.opts.workdir, sim_dir_name)
+
+        # Make run directory
+        if self.round == 0:
+            if self.opts.replace and os.path.exists(sim_dir_name):
+                shutil.rmtree(sim_dir)
+            os.makedirs(sim_dir)
+            # Anything the manifest still lists in here is gone
+            prune_manifest(self.opts.workdir, sim_dir)
+        if not os.path.exists("refinement"):
+            os.makedirs("refinement")
+
+        l = [list(p) for p in self.points[self.pround == self.round]]
+        print(" -- Making Refinement Round {} -- ".format(self.round))
+        linker = CreateLinker(self.opts)
+        recorders = self.MakeRecorders()
+        if self.opts.jobs > 1:
+            self.Sim.MakeSimDirectoriesParallel(sim_dir_name, l, self.opts.jobs, linker,
+                                                recorders)
+        else:
+            for il in l:
+                self.Sim.MakeSimDirectory(sim_dir_name, il, linker, recorders)
+        for r in recorders:
+            r.Close()
+        linker.Report()
+
+        # Sims of this round, to launch just those
+        with open(os.path.join("refinement", "round{}_sims.txt".format(self.round)), 'w') as f:
+            for il in l:
+                f.write("{}\n".format(os.path.join(sim_dir, self.Sim.SimAssignment(il)[0])))
+
+        # Save myself off to the directory
+        self.savestate("refinement")
+
+    ### Metrics
+    def TestMetric(self, point):
+        # Smooth step across the parameter space to test the refinement with
+        u = []
+        for i, cparam in zip(point, self.ChiParams):
+            lower, upper = getattr(cparam, 'bounds', [0.0, 1.0])
+            u += [(cparam[i] - lower) / (upper - lower) if upper != lower else 0.0]
+        return np.tanh(10.0 * (np.mean(u) - 0.4))
+
+    def ReadMetrics(self, metric_file, key, dotest=False):
+        """ Metric of every point that does not have one yet. Returns the
+            number of points still missing one.
+        """
+        if dotest:
+            print(" WARNING ERROR Using fake metric function!!!!!")
+        for i in np.flatnonzero(np.isnan(self.metric)):
+            if dotest:
+                self.metric[i] = self.TestMetric(self.points[i])
+                continue
+            sim_name = self.Sim.SimAssignment(self.points[i])[0]
+            value = sim_metric(os.path.join(self.opts.workdir, "simulations", sim_name),
+                               metric_file, key)
+            if value is not None:
+                self.metric[i] = value
+        return int(np.sum(np.isnan(self.metric)))
+
+    ### Refinement
+    def SelectEdges(self, n, tol):
+        """ Up to n intervals with the largest change of the metric, leaving
+            out the ones that change less than tol times the metric range.
+        """
+        f1 = self.metric[self.edges[:, 0]]
+        f2 = self.metric[self.edges[:, 1]]
+        change = np.abs(f2 - f1)
+        known = ~np.isnan(change)
+        if not np.any(known):
+            return np.array([], dtype=int), change
+        frange = np.nanmax(self.metric) - np.nanmin(self.metric)
+        candidates = np.flatnonzero(known & (change > tol * frange))
+        order = candidates[np.argsort(-change[candidates], kind='stable')]
+        return order[:n], change
+
+    def Bisect(self, iedges):
+        """ Adds the midpoint of each interval in iedges as a point of the
+            next round and splits the interval in two. Intervals that can
+            not be split further are dropped.
+        """
+        rows = dict([(tuple(p), i) for i, p in enumerate(self.points)])
+        names = set([self.Sim.SimAssignment(p)[0] for p in self.points])
+        new_points = []
+        keep = np.ones(len(self.edges), dtype=bool)
+        new_edges = []
+        for e in iedges:
+            i, j, ichi = self.edges[e]
+            keep[e] = False
+            cparam = self.ChiParams[ichi]
+            v1 = cparam[self.points[i][ichi]]
+            v2 = cparam[self.points[j][ichi]]
+            vm = midpoint(cparam, v1, v2)
+            if vm == v1 or vm == v2:
+                continue
+            if vm in cparam.values:
+                k = cparam.values.index(vm)
+            else:
+                cparam.values += [vm]
+                k = len(cparam.values) - 1
+            q = self.points[i].copy()
+            q[ichi] = k
+            m = rows.get(tuple(q))
+            if m is None:
+                sim_name = self.Sim.SimAssignment(q)[0]
+                if sim_name in names:
+                    print("## Midpoint {0} of {1} has the directory name of an existing sim, "
+                          "use more digits in its format_str to refine further.".format(
+                              vm, cparam.format_str))
+                    continue
+                m = len(self.points) + len(new_points)
+                rows[tuple(q)] = m
+                names.add(sim_name)
+                new_points += [q]
+            new_edges += [[i, m, ichi], [m, j, ichi]]
+        if new_points:
+            self.points = np.vstack([self.points, new_points])
+            self.metric = np.append(self.metric, np.full(len(new_points), np.nan))
+            self.pround = np.append(self.pround, np.full(len(new_points), self.round + 1))
+        self.edges = np.vstack([self.edges[keep],
+                                np.array(new_edges, dtype=int).reshape(-1, 3)])
+        return len(new_points)
+
+    def PrintRefine(self):
+        print("Refinement Round: {}".format(self.round))
+        print("   points: {0}  intervals: {1}".format(len(self.points), len(self.edges)))
+        for ichi, cparam in enumerate(self.ChiParams):
+            if refinable_pat.match(cparam.exec_str):
+                print("   {0:>12s}: {1} values".format(str(cparam), cparam.GetNValues()))
+
+    # Refine Functionality
+    def Refine(self, n=None, tol=0.05, metric_file='data/fitness_final.yaml',
+               key='FINAL_FITNESS', dotest=False):
+        # Save off the information about the opts, path, etc
+        cur_cwd = self.cwd
+
+        # Load self from the latest checkpoint
+        self.loadstate('refinement')
+        self.cwd = cur_cwd
+        if n is None:
+            n = self.opts.n
+
+        self.PrintRefine()
+        print(" -- Reading {0} of the sims from {1} -- ".format(key, metric_file))
+        nmissing = self.ReadMetrics(metric_file, key, dotest)
+        if nmissing:
+            print(" -- {} sims have no metric yet, their intervals are not refined -- ".format(nmissing))
+        iedges, change = self.SelectEdges(n, tol)
+        if not len(iedges):
+            print(" -- No interval changes by more than {} of the metric range, refinement is done -- ".format(tol))
+            self.savestate("refinement")
+            return
+        print("change    interval")
+        for e in iedges:
+            i, j, ichi = self.edges[e]
+            cparam = self.ChiParams[ichi]
+            print("{0:>8.3g}  {1} - {2}".format(change[e],
+                                               cparam.format(cparam[self.points[i][ichi]]),
+                                               cparam.format(cparam[self.points[j][ichi]])))
+        nadded = self.Bisect(iedges)
+        if not nadded:
+            print(" -- Selected intervals can not be split further, refinement is done -- ")
+            self.savestate("refinement")
+            return
+
+        # Write the new information
+        self.round += 1
+        self.MakeDirectoryStruct()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(prog='ChiRefine.py')
+
+    parser.add_argument('-R', '--refine', action='store_true',
+            help='Reads the metric of the latest round and makes the sims of the next one.')
+
+    parser.add_argument('-n', type=int,
+            help='Largest number of intervals bisected per round (default: -n of the create)')
+
+    parser.add_argument('--tol', type=float, default=0.05,
+            help='Intervals whose metric changes by less than this fraction of the metric range are not bisected (default: 0.05)')
+
+    parser.add_argument('-m', '--metric', type=str, default='FINAL_FITNESS',
+            help='Key of the metric in the metric file (default: FINAL_FITNESS)')
+
+    parser.add_argument('--metric_file', type=str, default='data/fitness_final.yaml',
+            help='Yaml file with the metric, relative to each sim directory (default: data/fitness_final.yaml)')
+
+    parser.add_argument('-T', '--test', action='store_true',
+            help='Test the refinement with a fake metric')
+
+    opts = parser.parse_args()
+    return opts
+
+### Main function to test stuff?
+if __name__ == "__main__":
+    opts = parse_args()
+    c = ChiRefine(opts, os.getcwd(), 0)
+    if opts.refine:
+        c.Refine(opts.n, opts.tol, opts.metric_file, opts.metric, opts.test)
@@ -1,12 +1,19 @@
 #!/usr/bin/env python
 import sys
 import os
-from subprocess import call
+import time
+from subprocess import Popen
 import shutil
 import yaml
 from ChiLib import *
+from ChiState import ChiStateStore
+from ChiCache import ChiCache, parse_size
 from collections import OrderedDict
 import argparse
+import copy
+import traceback
+import glob
+import hashlib
 
 '''
 Name: ChiMain.py
@@ -43,57 +50,168 @@ default_args = OrderedDict([ ('run', [ 'spindle_bd_mp',
 
 def run_parse_args():
     parser = argparse.ArgumentParser(prog='Chi.py')
-    parser.add_argument('-d', '--workdir', type=str, required=True,
+    parser.add_argument('-d', '--workdir', type=str,
             help='Name of the working directory where simulation will be run')
     parser.add_argument('-a', '--args_file', type=str,
             help='Name file that holds the program argument list.')
     # parser.add_argument('-p', '--program', type=str, required=True,
             # help='Name of program that will be run')
-    parser.add_argument('-s', '--states', nargs='+', type=str, required=True,
+    parser.add_argument('-s', '--states', nargs='+', type=str,
             help='Name of all the states the simulation will run eg. start, build, analyze, etc.')
+    parser.add_argument('--state_store', type=str, metavar='WORKDIR',
+            help='Workdir with a state journal (see ChiState.py). State changes are recorded there instead of in marker files.')
+    parser.add_argument('--cpus', type=int,
+            help='Cpus the states of a seed may use at once. States whose dependencies are done run concurrently while their cpus fit (see state_specs). Defaults to the cpus this process may run on.')
+    parser.add_argument('--cache', type=str, metavar='DIR',
+            help='Results cache shared between sweeps (see ChiCache.py). States with declared outputs are looked up by a hash of the seed yaml files, their inputs, arguments and program, and their outputs are copied from the cache instead of running on a hit.')
+    parser.add_argument('--cache_size', type=str,
+            help='Size the cache is kept under by removing the least recently used entries, e.g. 50G. (Used with --cache only)')
+    parser.add_argument('--worker', type=str, metavar='QUEUE',
+            help='Run as a pilot: keep claiming the next seed from the work queue file QUEUE and running its states until the queue is empty or the walltime is close. Replaces -d and -s.')
+    parser.add_argument('--walltime', type=float, default=0,
+            help='Seconds the pilot may run for. No new seed is claimed when the longest seed run so far would not fit anymore. (Used with --worker only)')
 
     opts = parser.parse_args()
+    if not opts.worker and not (opts.workdir and opts.states):
+        parser.error('-d/--workdir and -s/--states are required without --worker')
     return opts
 
-def run_start(workdir, args): #, prefix="spindle_bd_mp"):
-    print("starting sim in {0}".format(workdir))
-    sys.stdout.flush()
-    if os.path.exists(workdir):
-        os.chdir(workdir)
-        print(args)
-        open('.running', 'a').close()
-        # args = [program, prefix+".default", prefix+".equil"]
-        status = call(args)
-        os.remove('.running')
-        return status
-    else:
-        return 1
-
-def run_analyze(workdir, args):
-    print("starting sim in {0}".format(workdir))
-    sys.stdout.flush()
-    if os.path.exists(workdir):
-        os.chdir(workdir)
-        open('.running', 'a').close()
-        # args = ["spindle_analysis", prefix+".default", prefix+".equil", prefix+".initial_config", prefix+".posit"]
-        status = call(args)
-        os.remove('.running')
-        return status
-    else:
-        return 1
-
-def run_args(workdir, state, args):
-    action = state+'-ing'
-    print("Started {} sim in {}".format(action, args))
-    sys.stdout.flush()
-    if os.path.exists(workdir):
-        os.chdir(workdir)
-        open('.'+action, 'a').close()
-        status = call(args)
-        os.remove('.'+action)
-        return status
-    else:
-        return 1
+def state_specs(af):
+    """ Normalizes the args file to OrderedDict state -> spec. A state is
+        either a list of arguments, or a mapping with
+            args:  list of arguments
+            after: states that have to succeed first (default: the state above)
+            cpus:  cpus the state uses (default 1)
+            inputs, outputs: files (or glob patterns) in the seed directory
+                the state reads and writes. When outputs are given the
+                state is skipped while they are up to date (see state_current)
+            check: mtime (default) or hash, how inputs are compared
+        Without after a state only waits for the state above it, whether or
+        not that one succeeded, which is how the list form always ran.
+    """
+    specs = OrderedDict()
+    prev = None
+    for k, v in af.items():
+        inputs, outputs, check = [], [], 'mtime'
+        if isinstance(v, dict):
+            args = v['args']
+            after = v.get('after')
+            cpus = int(v.get('cpus', 1))
+            inputs = v.get('inputs', [])
+            outputs = v.get('outputs', [])
+            check = v.get('check', 'mtime')
+        else:
+            args, after, cpus = v, None, 1
+        strict = after is not None
+        if after is None:
+            after = [prev] if prev else []
+        elif not isinstance(after, list):
+            after = [after]
+        if not isinstance(inputs, list):
+            inputs = [inputs]
+        if not isinstance(outputs, list):
+            outputs = [outputs]
+        specs[k] = {'args': [str(a) for a in args], 'after': after,
+                    'cpus': cpus, 'strict': strict,
+                    'inputs': inputs, 'outputs': outputs, 'check': check}
+        prev = k
+    return specs
+
+# File in the seed directory with the hashes of the inputs of every state
+# the last time it succeeded, lines of state, path and sha1
+STAMPS_NAME = '.chi_stamps'
+
+def expand_files(seed_dir, patterns):
+    files = []
+    for pat in patterns:
+        found = sorted(glob.glob(os.path.join(seed_dir, pat)))
+        files += found if found else [os.path.join(seed_dir, pat)]
+    return files
+
+def state_inputs(seed_dir, spec):
+    # Declared inputs plus the program the state runs
+    files = expand_files(seed_dir, spec['inputs'])
+    prog = spec['args'][0] if spec['args'] else None
+    if prog:
+        if os.path.isfile(os.path.join(seed_dir, prog)):
+            files.append(os.path.join(seed_dir, prog))
+        elif shutil.which(prog):
+            files.append(shutil.which(prog))
+    return files
+
+def file_hash(path):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def stamp_key(seed_dir, fn):
+    # Files in the seed directory are stamped by relative path, so the
+    # stamps survive moving the workdir
+    rel = os.path.relpath(fn, seed_dir)
+    return fn if rel.startswith('..') else rel
+
+def read_stamps(seed_dir):
+    stamps = {}
+    path = os.path.join(seed_dir, STAMPS_NAME)
+    if os.path.isfile(path):
+        with open(path, 'r') as f:
+            for line in f:
+                state, fn, digest = line.rstrip('\n').split('\t')
+                stamps.setdefault(state, {})[fn] = digest
+    return stamps
+
+def write_stamps(seed_dir, state, spec):
+    # Remember the inputs the state just succeeded with
+    stamps = read_stamps(seed_dir)
+    stamps[state] = dict([(stamp_key(seed_dir, fn), file_hash(fn))
+                          for fn in state_inputs(seed_dir, spec) if os.path.isfile(fn)])
+    path = os.path.join(seed_dir, STAMPS_NAME)
+    tmp = "{0}.{1}.tmp".format(path, os.getpid())
+    with open(tmp, 'w') as f:
+        for st in stamps:
+            for fn, digest in sorted(stamps[st].items()):
+                f.write("{0}\t{1}\t{2}\n".format(st, fn, digest))
+    os.rename(tmp, path)
+
+def state_current(seed_dir, state, spec):
+    """ True when the state declares outputs, they all exist, and they are
+        newer than its inputs and program (check: mtime), or the inputs and
+        program hash the same as when the state last succeeded (check: hash).
+        States without declared outputs are never current.
+    """
+    if not spec['outputs']:
+        return False
+    outputs = expand_files(seed_dir, spec['outputs'])
+    if not all([os.path.exists(fn) for fn in outputs]):
+        return False
+    inputs = state_inputs(seed_dir, spec)
+    if not all([os.path.exists(fn) for fn in inputs]):
+        return False
+    if spec['check'] == 'hash':
+        stamped = read_stamps(seed_dir).get(state)
+        keys = [stamp_key(seed_dir, fn) for fn in inputs]
+        if stamped is None or set(stamped) != set(keys):
+            return False
+        return all([file_hash(fn) == stamped[k] for fn, k in zip(inputs, keys)])
+    if not inputs:
+        return True
+    oldest_out = min([os.path.getmtime(fn) for fn in outputs])
+    newest_in = max([os.path.getmtime(fn) for fn in inputs])
+    return oldest_out >= newest_in
+
+def stale_states(seed_dir, specs, states):
+    """ The states out of states that have to run again: those that are not
+        current and every state that runs after one of them.
+    """
+    stale = set([k for k in states if k in specs and
+                 not state_current(seed_dir, k, specs[k])])
+    # Dependents of stale states are stale too, specs are in run order
+    for k in specs:
+        if set(specs[k]['after']) & stale:
+            stale.add(k)
+    return [k for k in states if k in stale or k not in specs]
 
 class ChiRun(object):
     def __init__(self, opts):
@@ -103,6 +221,7 @@ class ChiRun(object):
         args_dict = {}
         if not os.path.exists(opts.workdir):
             print("Run failed. Directory {} does not exists".format(opts.workdir))
+            return
 
         else:
             if (opts.args_file and 
@@ -112,38 +231,190 @@ class ChiRun(object):
             else:
                 af = default_args
 
+        # Hold on to the absolute seed path, states run in the seed directory
+        seed_dir = os.path.abspath(opts.workdir)
+        os.chdir(seed_dir)
+        store = None
+        if getattr(opts, 'state_store', None):
+            store = ChiStateStore(opts.state_store)
+        cache = None
+        if getattr(opts, 'cache', None):
+            cache = ChiCache(opts.cache, parse_size(opts.cache_size or 0))
+
+        specs = state_specs(af)
         # print OrderedYamlDump(af, default_flow_style=False)
-        for k, l in af.items():
-            print("File= {}, Dictionary= {}".format(k, " ".join(l)))
+        for k, spec in specs.items():
+            print("File= {}, Dictionary= {}".format(k, " ".join(spec['args'])))
+
+        budget = getattr(opts, 'cpus', None) or len(available_cpus())
+        todo = [k for k in specs if k in opts.states]
+        # States whose declared outputs are stale or that follow a stale
+        # state. Computed once up front, a state that reruns makes the
+        # states after it stale anyway.
+        rerun = stale_states(seed_dir, specs, todo)
+        running = {}  # pid -> (state, process, start time, cache key)
+        status = {}   # state -> exit status, or 'skipped'
+        used = 0
+        while todo or running:
+            # Start every state whose dependencies are done, in args file
+            # order, while it fits in the cpu budget. A state bigger than
+            # the budget runs on its own.
+            running_states = [r[0] for r in running.values()]
+            for k in list(todo):
+                spec = specs[k]
+                if [d for d in spec['after'] if d in todo or d in running_states]:
+                    continue
+                if spec['strict'] and [d for d in spec['after'] if status.get(d, 0) != 0]:
+                    print("Skipping {}, a state it runs after did not succeed".format(k))
+                    todo.remove(k)
+                    status[k] = 'skipped'
+                    continue
+                if k not in rerun:
+                    print("{} is up to date, skipping".format(k))
+                    todo.remove(k)
+                    status[k] = 0
+                    self.SkipState(seed_dir, k, store)
+                    continue
+                need = min(spec['cpus'], budget)
+                if used and used + need > budget:
+                    continue
+                todo.remove(k)
+                # Only states with declared outputs can be cached
+                key = None
+                if cache and spec['outputs']:
+                    key = cache.Key(seed_dir, k, spec, opts.args_file)
+                    if cache.Restore(key, seed_dir):
+                        print("{} restored from the cache".format(k))
+                        status[k] = 0
+                        self.SkipState(seed_dir, k, store)
+                        write_stamps(seed_dir, k, spec)
+                        continue
+                p = self.StartState(seed_dir, k, spec['args'], store)
+                running[p.pid] = (k, p, time.time(), key)
+                running_states.append(k)
+                used += need
+            if not running:
+                if todo:
+                    print("States {} wait on each other and can not run".format(" ".join(todo)))
+                break
 
-            if k in opts.states:
-                if run_args(opts.workdir, k, l):
-                    print("run failed")
-                    open('.error', 'a').close()
-                elif os.path.exists('sim.{}'.format(k)):
-                    os.remove('sim.{}'.format(k))
+            pid, wstatus, rusage = os.wait4(-1, 0)
+            if pid not in running:
+                continue
+            k, p, start, key = running.pop(pid)
+            p.returncode = os.waitstatus_to_exitcode(wstatus)
+            used -= min(specs[k]['cpus'], budget)
+            status[k] = p.returncode
+            self.FinishState(seed_dir, k, p.returncode, start, store, rusage)
+            if p.returncode == 0 and specs[k]['outputs']:
+                write_stamps(seed_dir, k, specs[k])
+                if key:
+                    cache.Store(key, seed_dir, specs[k])
 
+    def StartState(self, seed_dir, state, args, store=None):
+        action = state+'-ing'
+        print("Started {} sim in {}".format(action, args))
+        sys.stdout.flush()
+        if store:
+            store.Start(seed_dir, state)
+        else:
+            open(os.path.join(seed_dir, '.'+action), 'a').close()
+        return Popen(args, cwd=seed_dir)
 
+    def SkipState(self, seed_dir, state, store=None):
+        # Up to date, the state counts as done without running
+        if store:
+            store.Finish(seed_dir, state, 0)
+        elif os.path.exists(os.path.join(seed_dir, 'sim.{}'.format(state))):
+            os.remove(os.path.join(seed_dir, 'sim.{}'.format(state)))
 
+    def FinishState(self, seed_dir, state, status, start, store=None, rusage=None):
+        # Record what the state used in the seed's metrics file, which
+        # ChiLaunch uses to pack seeds into jobs and Chi.py --metrics sums up
+        values = {'state': state, 'status': status,
+                  'start': "{:.3f}".format(start),
+                  'wall': "{:.3f}".format(time.time() - start)}
+        if rusage is not None:
+            values.update({'utime': "{:.3f}".format(rusage.ru_utime),
+                           'stime': "{:.3f}".format(rusage.ru_stime),
+                           'maxrss': rusage.ru_maxrss,
+                           'inblock': rusage.ru_inblock,
+                           'oublock': rusage.ru_oublock})
+        write_metrics(seed_dir, values)
+        if store:
+            store.Finish(seed_dir, state, status)
+            if status:
+                print("run failed")
+            return
+        os.remove(os.path.join(seed_dir, '.'+state+'-ing'))
+        if status:
+            print("run failed")
+            open(os.path.join(seed_dir, '.error'), 'a').close()
+        elif os.path.exists(os.path.join(seed_dir, 'sim.{}'.format(state))):
+            os.remove(os.path.join(seed_dir, 'sim.{}'.format(state)))
 
+    def RunRedirected(self, seed_dir, states):
+        # Run the seed in this process with stdout and stderr going to the
+        # seed's sim.log and sim.err, like the job scripts do
+        opts = copy.copy(self.opts)
+        opts.workdir = seed_dir
+        opts.states = states
+        sys.stdout.flush()
+        sys.stderr.flush()
+        saved = (os.dup(1), os.dup(2))
+        try:
+            with open(os.path.join(seed_dir, 'sim.log'), 'w') as log, \
+                    open(os.path.join(seed_dir, 'sim.err'), 'w') as errlog:
+                os.dup2(log.fileno(), 1)
+                os.dup2(errlog.fileno(), 2)
+                try:
+                    self.Run(opts)
+                except Exception:
+                    traceback.print_exc()
+                finally:
+                    sys.stdout.flush()
+                    sys.stderr.flush()
+        finally:
+            os.dup2(saved[0], 1)
+            os.dup2(saved[1], 2)
+            os.close(saved[0])
+            os.close(saved[1])
 
-        # if 'start' in opts.states:
-            # if run_start(opts.workdir, af['start']):
-                # print "run failed"
-                # open('.error', 'a').close()
-            # else:
-                # os.remove('sim.start')
-        # if 'analyze' in opts.states:
-            # if run_analyze(opts.workdir, af['analyze']):
-                # print "run failed"
-                # open('.error', 'a').close()
-            # else:
-                # os.remove('sim.analyze')
+    def Work(self, opts):
+        """ Pilot loop: claim seeds from the work queue and run them one
+            after the other until the queue is empty or the next seed would
+            likely not finish before the walltime.
+        """
+        queue = WorkQueue(opts.worker)
+        cwd = os.getcwd()
+        start = time.time()
+        longest = 0.
+        nseeds = 0
+        while True:
+            if opts.walltime and time.time() + longest > start + opts.walltime:
+                print("Stopping, the next seed might not finish before the walltime")
+                break
+            job = queue.Claim()
+            if job is None:
+                print("Work queue is empty")
+                break
+            seed_dir, states = job
+            print("Running {0} states {1}".format(seed_dir, " ".join(states)))
+            sys.stdout.flush()
+            t0 = time.time()
+            self.RunRedirected(seed_dir, states)
+            os.chdir(cwd)
+            longest = max(longest, time.time() - t0)
+            nseeds += 1
+        print("Pilot ran {0} seeds in {1:.1f}s".format(nseeds, time.time() - start))
 
 if __name__ == '__main__':
 
     opts = run_parse_args()
 
     c = ChiRun(opts)
-    c.Run(opts)
+    if opts.worker:
+        c.Work(opts)
+    else:
+        c.Run(opts)
 
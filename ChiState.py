@@ -0,0 +1,277 @@
+#!/usr/bin/env python
+import sys
+import os
+import re
+import time
+import fcntl
+from ChiLib import *
+
+'''
+Name: ChiState.py
+Description: Journaled run state store for a workdir. Replaces the sim.<state>,
+    .error and .running marker files with one append-only journal, so asking
+    for the state of every seed is a single read instead of several metadata
+    operations per seed.
+Input: ChiState.py WORKDIR prints a summary of the workdir's run states
+'''
+
+# Journal and lock file names in the workdir
+STATE_JOURNAL = 'chi_state.journal'
+STATE_LOCK = 'chi_state.lock'
+
+# Journal records are tab separated lines of
+#   time  op  seed  state  value
+# with seed relative to the workdir. The ops are
+#   arm    state needs to run (was sim.<state>)
+#   disarm state does not need to run anymore
+#   start  state started running (was .<state>-ing/.running)
+#   done   state finished with exit status value, non zero sets the error flag
+#   stop   state is not running anymore, without a result (job was killed)
+#   error  error flag set (was .error)
+#   clear  error flag cleared
+
+
+class SeedState(object):
+    def __init__(self):
+        self.pending = set()
+        self.running = set()
+        self.error = False
+
+    def Apply(self, op, state, value):
+        if op == 'arm':
+            self.pending.add(state)
+        elif op == 'disarm':
+            self.pending.discard(state)
+        elif op == 'start':
+            self.running.add(state)
+        elif op == 'done':
+            self.running.discard(state)
+            if value == '0':
+                self.pending.discard(state)
+            else:
+                self.error = True
+        elif op == 'stop':
+            self.running.discard(state)
+        elif op == 'error':
+            self.error = True
+        elif op == 'clear':
+            self.error = False
+
+
+class ChiStateStore(object):
+    """ State of every seed in a workdir, kept as an append-only journal.
+        Writers take an exclusive flock on the lock file and append whole
+        lines, so many ChiRun processes can record transitions at once.
+        Load replays the journal once, after which queries are dict lookups.
+    """
+    def __init__(self, workdir, arm_states=None):
+        self.workdir = os.path.abspath(workdir)
+        self.journal = os.path.join(self.workdir, STATE_JOURNAL)
+        self.lock = os.path.join(self.workdir, STATE_LOCK)
+        # States armed for new sims when used as a creation recorder
+        self.arm_states = arm_states or []
+        self.seeds = {}
+        self.offset = 0
+        self.inode = None
+
+    @staticmethod
+    def Exists(workdir):
+        return os.path.isfile(os.path.join(workdir, STATE_JOURNAL))
+
+    def Key(self, seed_dir):
+        return os.path.relpath(os.path.abspath(seed_dir), self.workdir)
+
+    ### Reading
+    def Load(self):
+        self.seeds = {}
+        self.offset = 0
+        self.inode = None
+        self.Refresh()
+        return self
+
+    def Refresh(self):
+        # Read the records appended since the last read. A compaction swaps
+        # in a new file, in which case everything is read again.
+        if not os.path.exists(self.journal):
+            return
+        inode = os.stat(self.journal).st_ino
+        if self.inode is not None and inode != self.inode:
+            self.seeds = {}
+            self.offset = 0
+        self.inode = inode
+        with open(self.journal, 'rb') as f:
+            f.seek(self.offset)
+            for line in f:
+                # A line without its newline is still being written
+                if not line.endswith(b'\n'):
+                    break
+                self.offset += len(line)
+                self.ApplyRecord(line[:-1].decode('utf-8').split('\t'))
+
+    def ApplyRecord(self, rec):
+        _, op, seed, state, value = rec
+        if seed not in self.seeds:
+            self.seeds[seed] = SeedState()
+        self.seeds[seed].Apply(op, state, value)
+
+    def Get(self, seed_dir):
+        return self.seeds.get(self.Key(seed_dir), SeedState())
+
+    def Pending(self, seed_dir):
+        return sorted(self.Get(seed_dir).pending)
+
+    def IsRunning(self, seed_dir):
+        return bool(self.Get(seed_dir).running)
+
+    def IsError(self, seed_dir):
+        return self.Get(seed_dir).error
+
+    ### Writing
+    def Write(self, records):
+        # records are (op, seed_dir, state, value), written in one locked append
+        now = "{:.3f}".format(time.time())
+        lines = []
+        for op, seed_dir, state, value in records:
+            rec = [now, op, self.Key(seed_dir), state, str(value)]
+            lines.append('\t'.join(rec) + '\n')
+            self.ApplyRecord(rec)
+        with open(self.lock, 'a') as lf:
+            fcntl.flock(lf, fcntl.LOCK_EX)
+            try:
+                with open(self.journal, 'a') as f:
+                    f.write(''.join(lines))
+            finally:
+                fcntl.flock(lf, fcntl.LOCK_UN)
+
+    def Arm(self, seed_dirs, states):
+        self.Write([('arm', sd, s, '') for sd in seed_dirs for s in states])
+
+    def Disarm(self, seed_dirs, states):
+        self.Write([('disarm', sd, s, '') for sd in seed_dirs for s in states])
+
+    def Start(self, seed_dir, state):
+        self.Write([('start', seed_dir, state, '')])
+
+    def Finish(self, seed_dir, state, status):
+        self.Write([('done', seed_dir, state, status)])
+
+    def SetError(self, seed_dirs, error=True):
+        self.Write([('error' if error else 'clear', sd, '', '') for sd in seed_dirs])
+
+    def ClearRunning(self, seed_dirs):
+        # Forget states that were left running, e.g. by a job that was killed
+        self.Write([('stop', sd, s, '') for sd in seed_dirs
+                    for s in sorted(self.Get(sd).running)])
+
+    def AddSim(self, sim_dir, sd_names):
+        # Creation recorder interface (see ChiSim.MakeSimDirectory)
+        self.Arm([os.path.join(sim_dir, sn) for sn in sd_names], self.arm_states)
+
+    def Close(self):
+        pass
+
+    def Compact(self):
+        # Rewrite the journal as the smallest set of records giving the
+        # current state. Done under the lock so no append is lost.
+        with open(self.lock, 'a') as lf:
+            fcntl.flock(lf, fcntl.LOCK_EX)
+            try:
+                self.Load()
+                now = "{:.3f}".format(time.time())
+                lines = []
+                for seed in sorted(self.seeds):
+                    st = self.seeds[seed]
+                    lines += ['\t'.join([now, 'arm', seed, s, '']) + '\n' for s in sorted(st.pending)]
+                    lines += ['\t'.join([now, 'start', seed, s, '']) + '\n' for s in sorted(st.running)]
+                    if st.error:
+                        lines.append('\t'.join([now, 'error', seed, '', '']) + '\n')
+                tmp = "{0}.{1}.tmp".format(self.journal, os.getpid())
+                with open(tmp, 'w') as f:
+                    f.write(''.join(lines))
+                os.rename(tmp, self.journal)
+            finally:
+                fcntl.flock(lf, fcntl.LOCK_UN)
+        self.Load()
+
+    ### Marker files
+    def ImportMarkers(self, seed_dirs):
+        """ One-shot import of the marker files of an existing workdir. The
+            marker files are left in place but are not read anymore.
+        """
+        # Same state file pattern as ChiLaunch.get_state
+        state_pat = re.compile(r'sim\.(?!err)(?!log).+')
+        running_pat = re.compile(r'\.(.+)-ing$')
+        records = []
+        for sd in seed_dirs:
+            for f in os.listdir(sd):
+                m = state_pat.match(f)
+                if m:
+                    records.append(('arm', sd, f.split('.')[-1], ''))
+                    continue
+                m = running_pat.match(f)
+                if m:
+                    records.append(('start', sd, m.group(1), ''))
+                elif f == '.running':
+                    records.append(('start', sd, 'unknown', ''))
+                elif f == '.error':
+                    records.append(('error', sd, '', ''))
+        # Make sure the journal exists even for a workdir with no markers
+        self.Write(records)
+        self.Compact()
+        return len(records)
+
+    def Summary(self):
+        npending = sum([1 for st in self.seeds.values() if st.pending])
+        nrunning = sum([1 for st in self.seeds.values() if st.running])
+        nerror = sum([1 for st in self.seeds.values() if st.error])
+        print("seeds: {0}  pending: {1}  running: {2}  error: {3}".format(
+            len(self.seeds), npending, nrunning, nerror))
+        counts = {}
+        for st in self.seeds.values():
+            for s in st.pending:
+                counts[s] = counts.get(s, 0) + 1
+        for s in sorted(counts):
+            print("   state {0}: {1} seeds to run".format(s, counts[s]))
+
+def seed_finished(seed_dir, states, store=None):
+    """ True when none of states is armed or running in the seed, or the seed
+        failed. Reads the journal when given a store, else the marker files.
+    """
+    if store:
+        st = store.Get(seed_dir)
+        return st.error or not (set(states) & (st.pending | st.running))
+    if os.path.exists(os.path.join(seed_dir, '.error')):
+        return True
+    for s in states:
+        if os.path.exists(os.path.join(seed_dir, 'sim.{}'.format(s))) or \
+                os.path.exists(os.path.join(seed_dir, '.{}-ing'.format(s))):
+            return False
+    return True
+
+def arm_seeds(seed_dirs, states, store=None):
+    # Arm states of new seeds in the journal, or with sim.<state> markers
+    if store:
+        store.Arm(seed_dirs, states)
+        return
+    for sd in seed_dirs:
+        for s in states:
+            touch(os.path.join(sd, 'sim.{}'.format(s)))
+
+def clear_errors(seed_dirs, store=None):
+    # Clear the error flag of seeds that are run again, in the journal or
+    # by removing their .error markers
+    if store:
+        store.SetError(seed_dirs, False)
+        return
+    for sd in seed_dirs:
+        if os.path.exists(os.path.join(sd, '.error')):
+            os.remove(os.path.join(sd, '.error'))
+
+
+##########################################
+if __name__ == "__main__":
+    wd = sys.argv[1] if len(sys.argv) > 1 else os.getcwd()
+    if not ChiStateStore.Exists(wd):
+        print("No state journal in {}".format(wd))
+        sys.exit(1)
+    ChiStateStore(wd).Load().Summary()
@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+import sys
+import os
+import time
+import numpy as np
+from ChiLib import *
+from ChiState import ChiStateStore, seed_finished, arm_seeds
+from ChiHalving import halving
+from ChiRun import read_stamps
+
+'''
+Name: ChiSteady.py
+Description: Steady state mode of the particle swarm and genetic algorithm.
+    Instead of waiting for a whole generation, every particle whose sim has
+    finished gets its fitness, the bests are updated with it and the particle
+    is replaced by a new candidate right away, so the slowest sim does not
+    hold up the others. The k-th candidate of a particle is created in
+    generations/gen<k>, so the generation directories fill up as particles
+    progress at their own pace.
+Input: used through ChiParticleSwarm.py --steady and ChiGeneticAlgorithm.py --steady
+'''
+
+def candidate_dir(opt, idx):
+    # Generation directory of the current candidate of particle idx
+    return os.path.join('generations', 'gen{}'.format(int(opt.Sim.pgen[idx])))
+
+def candidate_path(opt, idx):
+    # Sim directory of the current candidate of particle idx, from its name
+    # alone as this is asked for every particle at every poll
+    return os.path.join(candidate_dir(opt, idx), opt.Sim.SimHash(idx))
+
+def candidate_finished(opt, idx, states, store=None):
+    sim_path = candidate_path(opt, idx)
+    return all([seed_finished(os.path.join(sim_path, sn), states, store)
+                for sn in opt.Sim.seeds.sd_names])
+
+def seed_ran(seed_dir, states):
+    # ChiRun ran one of states in the seed (metrics record) or found it up to
+    # date (stamps)
+    if any([r.get('state') in states for r in read_metrics(seed_dir)]):
+        return True
+    return bool(set(states) & set(read_stamps(seed_dir)))
+
+def arm_unprepped(opt, states, store=None):
+    """ Arms states in the seeds of the current candidates that have none of
+        them armed or running and never ran them, e.g. a generation that was
+        not prepped. Without this they would count as finished and get the
+        failed fitness. Returns those seeds.
+    """
+    seeds = []
+    for idx in range(opt.Sim.nparticles):
+        sim_path = candidate_path(opt, idx)
+        for sn in opt.Sim.seeds.sd_names:
+            sd = os.path.join(sim_path, sn)
+            if os.path.isdir(sd) and seed_finished(sd, states, store) and \
+                    not seed_ran(sd, states):
+                seeds.append(sd)
+    if seeds:
+        print(" -- Arming {0} in {1} candidate seeds that never ran -- ".format(
+            " ".join(states), len(seeds)))
+        arm_seeds(seeds, states, store)
+    return seeds
+
+def make_candidates(opt, indices):
+    """ New sim directory for each particle in indices from its current
+        values, in the generation directory of the particle's candidate
+        count. Returns the new seed directories.
+    """
+    linker = CreateLinker(opt.opts)
+    recorders = opt.MakeRecorders()
+    seeds = []
+    for idx in indices:
+        gen = int(opt.Sim.pgen[idx])
+        sim_dir_name = os.path.join('generations', 'gen{}'.format(gen))
+        if not os.path.exists(sim_dir_name):
+            os.makedirs(sim_dir_name)
+        opt.Sim.MakeSimDirectoryDatabase(sim_dir_name, gen,
+                                         [idx] * len(opt.ChiParams), linker,
+                                         recorders)
+        sim_path = candidate_path(opt, idx)
+        seeds += [os.path.join(sim_path, sn) for sn in opt.Sim.seeds.sd_names]
+    for r in recorders:
+        r.Close()
+    linker.Report()
+    return seeds
+
+def steady_state(opt, update, opts, dotest=False):
+    """ Loop of the steady state mode for a loaded optimizer opt. update(indices)
+        updates the bests with the fitness of the particles in indices and
+        moves them. Candidates get opts.states armed and are appended to the
+        opts.queue work queue of ChiRun --worker pilots when given. Stops after
+        opts.max_evals fitness evaluations, candidates already made are left
+        to run.
+    """
+    sim = opt.Sim
+    if halving(opt):
+        print("## Steady state mode does not do successive halving, the candidates "
+              "would only ever run the first rung budget. Create without --rungs.")
+        return
+    if sim.pgen is None:
+        sim.pgen = np.full(sim.nparticles, opt.generation)
+    workdir = os.getcwd()
+    store = ChiStateStore(workdir).Load() if ChiStateStore.Exists(workdir) else None
+    queue = WorkQueue(opts.queue) if opts.queue else None
+    seeds = arm_unprepped(opt, opts.states, store)
+    if queue and seeds:
+        queue.Append(seeds, [opts.states] * len(seeds))
+    nevals = 0
+    while opts.max_evals is None or nevals < opts.max_evals:
+        if store:
+            store.Refresh()
+        done = [idx for idx in range(sim.nparticles)
+                if candidate_finished(opt, idx, opts.states, store)]
+        if opts.max_evals is not None:
+            done = done[:opts.max_evals - nevals]
+        if not done:
+            time.sleep(opts.poll)
+            continue
+
+        # Fitness of the finished particles, update and replace them
+        print(" -- Steady state: particles {} finished -- ".format(done))
+        if dotest:
+            sim.UpdateFitness(None, True, opts.jobs, done)
+        else:
+            # Only here is the sim looked up, with the database as fallback
+            sim.EvaluateFitness(dict([(idx, sim.SimPaths(candidate_dir(opt, idx), [idx])[idx])
+                                      for idx in done]), opts.jobs)
+        for idx in done:
+            print("   particle {0} generation {1} fitness {2:.3f}".format(
+                idx, int(sim.pgen[idx]), sim.fitness[idx]))
+        update(done)
+        nevals += len(done)
+        sim.pgen[done] += 1
+        seeds = make_candidates(opt, done)
+        arm_seeds(seeds, opts.states, store)
+        if queue:
+            queue.Append(seeds, [opts.states] * len(seeds))
+
+        # Checkpoint under the newest generation so a restart picks it up
+        opt.generation = int(sim.pgen.max())
+        opt.savestate('generations')
+    print(" -- Steady state: stopping after {} fitness evaluations -- ".format(nevals))
@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+import sys
+import os
+import glob
+import timeit
+import yaml
+from collections import OrderedDict
+
+'''
+Name: ChiYaml.py
+Description: Ordered yaml I/O for Chi-Launcher. The ordered Loader/Dumper
+    classes are built once and reused, and are backed by libyaml
+    (CSafeLoader/CDumper) when PyYaml was built with it.
+Input: Run ChiYaml.py [YAML_FILES] to benchmark against the old per-call path
+    (defaults to the test/spindle_chrom configs).
+'''
+
+# Use the libyaml backed classes when they exist, pure python otherwise
+try:
+    from yaml import CSafeLoader as YamlLoader
+    from yaml import CDumper as YamlDumper
+    yaml_backend = 'libyaml'
+except ImportError:
+    from yaml import SafeLoader as YamlLoader
+    from yaml import Dumper as YamlDumper
+    yaml_backend = 'python'
+
+# Ordered Loader/Dumper subclasses, keyed by (base class, mapping type)
+loader_cache = {}
+dumper_cache = {}
+
+def GetOrderedLoader(Loader=None, object_pairs_hook=OrderedDict):
+    if Loader is None:
+        Loader = YamlLoader
+    key = (Loader, object_pairs_hook)
+    if key not in loader_cache:
+        class OrderedLoader(Loader):
+            pass
+        def construct_mapping(loader, node):
+            loader.flatten_mapping(node)
+            return object_pairs_hook(loader.construct_pairs(node))
+        OrderedLoader.add_constructor(
+            yaml.resolver.BaseResolver.DEFAULT_MAPPING_TAG,
+            construct_mapping)
+        loader_cache[key] = OrderedLoader
+    return loader_cache[key]
+
+def GetOrderedDumper(Dumper=None):
+    if Dumper is None:
+        Dumper = YamlDumper
+    if Dumper not in dumper_cache:
+        class OrderedDumper(Dumper):
+            pass
+        def _dict_representer(dumper, data):
+            return dumper.represent_mapping(
+                yaml.resolver.BaseResolver.DEFAULT_MAPPING_TAG,
+                list(data.items()))
+        OrderedDumper.add_representer(OrderedDict, _dict_representer)
+        dumper_cache[Dumper] = OrderedDumper
+    return dumper_cache[Dumper]
+
+# Usage: yaml_dict = OrderedYamlLoad(istream)
+def OrderedYamlLoad(stream, Loader=None, object_pairs_hook=OrderedDict):
+    return yaml.load(stream, GetOrderedLoader(Loader, object_pairs_hook))
+
+# Usage: OrderedYamlDump(yaml_dictionary, ostream)
+def OrderedYamlDump(data, stream=None, Dumper=None, **kwds):
+    return yaml.dump(data, stream, GetOrderedDumper(Dumper), **kwds)
+
+def YamlScalarString(value):
+    # Text that the emitter writes for a scalar. The python emitter ends a
+    # bare scalar document with '...', libyaml does not.
+    text = OrderedYamlDump(value)
+    if text.endswith('\n...\n'):
+        return text[:-len('\n...\n')]
+    return text[:-1]
+
+
+# Old per-call path (new class and pure python yaml every call), kept only
+# to benchmark against
+def LegacyOrderedYamlLoad(stream, Loader=yaml.Loader, object_pairs_hook=OrderedDict):
+    class OrderedLoader(Loader):
+        pass
+    def construct_mapping(loader, node):
+        loader.flatten_mapping(node)
+        return object_pairs_hook(loader.construct_pairs(node))
+    OrderedLoader.add_constructor(
+        yaml.resolver.BaseResolver.DEFAULT_MAPPING_TAG,
+        construct_mapping)
+    return yaml.load(stream, OrderedLoader)
+
+def LegacyOrderedYamlDump(data, stream=None, Dumper=yaml.Dumper, **kwds):
+    class OrderedDumper(Dumper):
+        pass
+    def _dict_representer(dumper, data):
+        return dumper.represent_mapping(
+            yaml.resolver.BaseResolver.DEFAULT_MAPPING_TAG,
+            list(data.items()))
+    OrderedDumper.add_representer(OrderedDict, _dict_representer)
+    return yaml.dump(data, stream, OrderedDumper, **kwds)
+
+def Benchmark(file_list, number=20):
+    print("yaml backend: {}".format(yaml_backend))
+    print("{:<40s}{:>12s}{:>12s}{:>9s}{:>12s}{:>12s}{:>9s}{:>6s}".format(
+        "file", "load old", "load new", "x", "dump old", "dump new", "x", "same"))
+    totals = [0.0, 0.0, 0.0, 0.0]
+    for f_name in file_list:
+        with open(f_name, 'r') as f:
+            text = f.read()
+        data = OrderedYamlLoad(text)
+        same = (data == LegacyOrderedYamlLoad(text) and
+                OrderedYamlDump(data, default_flow_style=False) ==
+                LegacyOrderedYamlDump(data, default_flow_style=False))
+        # Times are per call in ms
+        t = [1000.*timeit.timeit(func, number=number)/number for func in (
+            lambda: LegacyOrderedYamlLoad(text),
+            lambda: OrderedYamlLoad(text),
+            lambda: LegacyOrderedYamlDump(data, default_flow_style=False),
+            lambda: OrderedYamlDump(data, default_flow_style=False))]
+        totals = [a + b for a, b in zip(totals, t)]
+        print("{:<40s}{:>10.3f}ms{:>10.3f}ms{:>9.1f}{:>10.3f}ms{:>10.3f}ms{:>9.1f}{:>6s}".format(
+            os.path.basename(f_name), t[0], t[1], t[0]/t[1], t[2], t[3], t[2]/t[3],
+            "yes" if same else "NO"))
+    print("{:<40s}{:>10.3f}ms{:>10.3f}ms{:>9.1f}{:>10.3f}ms{:>10.3f}ms{:>9.1f}".format(
+        "total", totals[0], totals[1], totals[0]/totals[1],
+        totals[2], totals[3], totals[2]/totals[3]))
+
+
+##########################################
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        files = sys.argv[1:]
+    else:
+        files = sorted(glob.glob(os.path.join(os.path.dirname(
+            os.path.abspath(__file__)), 'test', 'spindle_chrom', '*.yaml')))
+    Benchmark(files)